@@ -0,0 +1,88 @@
+"""
+Summaries of the samples of a run and comparison of two runs.
+"""
+import math
+from collections import defaultdict
+
+PERCENTILES = (50, 95, 99)
+ALL = 'all'
+
+
+def percentile(values, percent):
+    """The nearest-rank percentile of the sorted `values`"""
+    if not values:
+        return None
+    return values[max(0, math.ceil(percent / 100 * len(values)) - 1)]
+
+
+def summarize_latencies(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    summary = {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': round(len(latencies) / elapsed, 2) if elapsed else None,
+        'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3) if latencies else None,
+    }
+    for percent in PERCENTILES:
+        value = percentile(latencies, percent)
+        summary[f'p{percent}_ms'] = round(value * 1000, 3) if value is not None else None
+    summary['max_ms'] = round(latencies[-1] * 1000, 3) if latencies else None
+    return summary
+
+
+def summarize(samples, elapsed):
+    """
+    Returns the summary of every operation and of all of them given the (operation, seconds,
+    status) samples recorded over `elapsed` seconds. A status of 0 or from 400 is an error.
+    """
+    latencies, errors = defaultdict(list), defaultdict(int)
+    for name, seconds, status in samples:
+        for key in (name, ALL):
+            latencies[key].append(seconds)
+            if not status or status >= 400:
+                errors[key] += 1
+    return {
+        name: summarize_latencies(latencies[name], errors[name], elapsed)
+        for name in sorted(latencies, key=lambda name: (name == ALL, name))
+    }
+
+
+def format_summary(endpoints):
+    columns = ('requests', 'errors', 'rps', 'mean_ms', *[f'p{percent}_ms' for percent in PERCENTILES], 'max_ms')
+    lines = [f"{'endpoint':<12}" + ''.join(f"{column:>11}" for column in columns)]
+    for name, summary in endpoints.items():
+        lines.append(f"{name:<12}" + ''.join(f"{summary[column] if summary[column] is not None else '-':>11}"
+                                             for column in columns))
+    return '\n'.join(lines)
+
+
+def change(before, after):
+    if not before or after is None:
+        return None
+    return (after - before) / before * 100
+
+
+def compare(before, after, threshold=10):
+    """
+    Compares the endpoints of two runs. Returns the lines of the comparison and the regressions,
+    the endpoints whose requests per second dropped or whose p95 rose by more than `threshold`
+    percent.
+    """
+    lines = [f"{'endpoint':<12}{'rps':>24}{'change':>9}{'p95_ms':>24}{'change':>9}"]
+    regressions = []
+    for name in after['endpoints']:
+        if name not in before['endpoints']:
+            continue
+        old, new = before['endpoints'][name], after['endpoints'][name]
+        rps, p95 = change(old['rps'], new['rps']), change(old['p95_ms'], new['p95_ms'])
+        lines.append(
+            f"{name:<12}{old['rps']!s:>11} -> {new['rps']!s:<9}{_percent(rps):>9}"
+            f"{old['p95_ms']!s:>11} -> {new['p95_ms']!s:<9}{_percent(p95):>9}"
+        )
+        if (rps is not None and rps < -threshold) or (p95 is not None and p95 > threshold):
+            regressions.append(name)
+    return lines, regressions
+
+
+def _percent(value):
+    return '-' if value is None else f"{value:+.1f}%"
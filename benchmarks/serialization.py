@@ -0,0 +1,73 @@
+"""
+Rendering of the messages of a thread by `MessageSerializer`, against the generic serializers of
+DRF building a `SenderReceiverSerializer` and loading the sender of every message.
+"""
+import time
+
+from rest_framework import serializers
+from rest_framework.renderers import JSONRenderer
+
+from django_messages_drf.models import Message, Thread
+from django_messages_drf.serializers import MessageSerializer, SenderReceiverSerializer
+
+
+class ReferenceMessageSerializer(MessageSerializer):
+    """`MessageSerializer` through the field machinery of DRF, one sender serializer per message"""
+
+    class Meta(MessageSerializer.Meta):
+        list_serializer_class = serializers.ListSerializer
+
+    def get_sender(self, instance):
+        serializer = SenderReceiverSerializer(context=self.context)
+        return serializers.ModelSerializer.to_representation(serializer, instance.sender)
+
+    def to_representation(self, instance):
+        return serializers.ModelSerializer.to_representation(self, instance)
+
+
+def render_reference(thread, user, select_related=False):
+    messages = Message.objects.filter(thread=thread).order_by('sent_at', 'pk')
+    if select_related:
+        messages = messages.select_related('sender')
+    return ReferenceMessageSerializer(messages, many=True, context={'user': user}).data
+
+
+def render(thread, user):
+    messages = Message.objects.filter(thread=thread).order_by('sent_at', 'pk')
+    return MessageSerializer(messages, many=True, context={'user': user}).data
+
+
+def best_of(func, repeat, *args):
+    """The fastest of `repeat` calls in milliseconds, with the result of the last one"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        timings.append((time.perf_counter() - start) * 1000)
+    return min(timings), result
+
+
+def run_serialization(repeat=5):
+    """
+    Renders the largest thread of the database with both serializers, checking the JSON is the
+    same. Returns the timings in milliseconds and the speedups, against the reference loading the
+    senders one by one and joining them, as the views do.
+    """
+    thread = Thread.objects.order_by('-seq').first()
+    user = thread.users.first()
+
+    reference_ms, expected = best_of(render_reference, repeat, thread, user)
+    joined_ms, _ = best_of(render_reference, repeat, thread, user, True)
+    fast_ms, data = best_of(render, repeat, thread, user)
+    if JSONRenderer().render(expected) != JSONRenderer().render(data):
+        raise AssertionError("MessageSerializer and the reference serializers render differently")
+
+    return {
+        'messages': len(data),
+        'senders': len({message.sender_id for message in thread.messages.all()}),
+        'reference_ms': round(reference_ms, 3),
+        'reference_joined_ms': round(joined_ms, 3),
+        'fast_ms': round(fast_ms, 3),
+        'speedup': round(reference_ms / fast_ms, 2),
+        'speedup_joined': round(joined_ms / fast_ms, 2),
+    }
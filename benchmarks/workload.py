@@ -0,0 +1,121 @@
+"""
+The mixed workload of the benchmarks, sent through the Django test client by concurrent workers.
+"""
+import multiprocessing
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth import get_user_model
+from django.db import connections
+from django.test import Client
+from django.urls import reverse
+
+from django_messages_drf.models import Message, UserThread
+
+DEFAULT_MIX = {
+    'inbox': 40,
+    'thread': 30,
+    'reply': 15,
+    'new-thread': 5,
+    'edit': 10,
+}
+ERROR = 0
+
+
+class Worker:
+    """
+    A user logged in sending the requests of the workload, chosen by their weight in `mix`. Each
+    request is recorded as (operation, seconds, status), a request raising an exception with the
+    status 0. The operations needing a thread or a message of the user are skipped without them.
+    """
+
+    def __init__(self, user, recipients, mix, seed):
+        self.user = user
+        self.recipients = [recipient for recipient in recipients if recipient != user.pk]
+        self.random = random.Random(seed)
+        self.client = Client()
+        self.client.force_login(user)
+        self.threads = list(
+            UserThread.objects.filter(user=user, deleted=False).values_list('thread__uuid', 'thread_id')[:1000]
+        )
+        self.messages = list(Message.objects.filter(sender=user).values_list('uuid', 'thread_id')[:1000])
+
+        needs = {'thread': self.threads, 'reply': self.threads, 'edit': self.messages, 'new-thread': self.recipients}
+        self.operations = [name for name in mix if mix[name] > 0 and needs.get(name, True)]
+        self.weights = [mix[name] for name in self.operations]
+
+    def inbox(self):
+        return self.client.get(reverse("django_messages_drf:inbox"))
+
+    def thread(self):
+        uuid, _ = self.random.choice(self.threads)
+        return self.client.get(reverse("django_messages_drf:thread", kwargs={'uuid': uuid}))
+
+    def reply(self):
+        uuid, _ = self.random.choice(self.threads)
+        url = reverse("django_messages_drf:thread-send", kwargs={
+            'uuid': uuid, 'user_id': self.random.choice(self.recipients or [self.user.pk])
+        })
+        return self.client.post(url, {'subject': "Benchmark", 'message': "A reply of the benchmark"})
+
+    def new_thread(self):
+        url = reverse("django_messages_drf:thread-create", kwargs={'user_id': self.random.choice(self.recipients)})
+        return self.client.post(url, {'subject': "Benchmark", 'message': "A new thread of the benchmark"})
+
+    def edit(self):
+        uuid, thread_id = self.random.choice(self.messages)
+        url = reverse("django_messages_drf:message-edit", kwargs={'user_id': self.user.pk, 'thread_id': thread_id})
+        return self.client.put(url, {'uuid': str(uuid), 'content': "Edited by the benchmark"}, content_type='application/json')
+
+    def run(self, requests, warmup=0):
+        """Sends `warmup` requests and then `requests` recorded ones"""
+        samples = []
+        started = time.time()
+        for i in range(warmup + requests):
+            if i == warmup:
+                started = time.time()
+            name = self.random.choices(self.operations, self.weights)[0]
+            start = time.perf_counter()
+            try:
+                status = getattr(self, name.replace('-', '_'))().status_code
+            except Exception:
+                status = ERROR
+            elapsed = time.perf_counter() - start
+            if i >= warmup:
+                samples.append((name, elapsed, status))
+        return samples, started, time.time()
+
+
+def run_worker(index, users, mix, requests, warmup, seed):
+    try:
+        user = get_user_model().objects.get(pk=users[index % len(users)])
+        return Worker(user, users, mix, seed + index).run(requests, warmup)
+    finally:
+        connections.close_all()
+
+
+def run_workload(workers, requests, warmup=0, mix=None, mode='thread', seed=0):
+    """
+    Runs `workers` workers in threads or in forked processes, each sending `requests` requests as
+    one of the seeded users. Returns the samples of every worker and the seconds between the first
+    recorded request and the last one.
+    """
+    mix = mix or DEFAULT_MIX
+    users = list(get_user_model().objects.order_by('pk').values_list('pk', flat=True))
+    args = [(index, users, mix, requests, warmup, seed) for index in range(workers)]
+
+    if mode == 'process':
+        # The children must open their own connections
+        connections.close_all()
+        with multiprocessing.get_context('fork').Pool(workers) as pool:
+            results = pool.starmap(run_worker, args)
+    elif mode == 'thread':
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(lambda arguments: run_worker(*arguments), args))
+    else:
+        raise ValueError(f"Unknown mode: {mode}")
+
+    samples = [sample for worker_samples, _, _ in results for sample in worker_samples]
+    elapsed = max(finished for _, _, finished in results) - min(started for _, started, _ in results)
+    return samples, elapsed
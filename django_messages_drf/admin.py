@@ -1,11 +1,11 @@
 from django.contrib import admin
 
-from .models import Message, UserThread
+from .models import ArchivedMessage, Message, UserThread
 
 
 class UserThreadAdmin(admin.ModelAdmin):
-    list_display = ["thread", "user", "unread", "deleted"]
-    list_filter = ["unread", "deleted"]
+    list_display = ["thread", "user", "last_read_seq", "deleted"]
+    list_filter = ["deleted"]
     raw_id_fields = ["user"]
 
 
@@ -17,3 +17,4 @@ class MessageAdmin(admin.ModelAdmin):
 
 admin.site.register(UserThread, UserThreadAdmin)
 admin.site.register(Message, MessageAdmin)
+admin.site.register(ArchivedMessage, MessageAdmin)
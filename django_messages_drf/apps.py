@@ -5,4 +5,8 @@ from django.utils.translation import gettext_lazy as _
 class MessagesDrfConfig(BaseAppConfig):
     name = "django_messages_drf"
     label = "django_messages_drf"
+    default_auto_field = "django.db.models.AutoField"
     verbose_name = _("Django Messages DRF")
+
+    def ready(self):
+        from . import receivers  # noqa: F401
@@ -0,0 +1,18 @@
+from django.urls import path
+
+from . import async_views, views
+
+app_name = "django_messages_drf"
+
+urlpatterns = [
+    path('inbox/', async_views.AsyncInboxListApiView.as_view(), name='inbox'),
+    path('message/thread/<uuid>/', async_views.AsyncThreadListApiView.as_view(), name='thread'),
+    path('message/group/send/', views.GroupThreadCreateApiView.as_view(), name='thread-group-create'),
+    path('message/thread/<user_id>/send/', async_views.AsyncThreadCRUDApiView.as_view(), name='thread-create'),
+    path('message/thread/<uuid>/<user_id>/send/', async_views.AsyncThreadCRUDApiView.as_view(), name='thread-send'),
+    path('message/thread/<user_id>/<thread_id>/edit/', async_views.AsyncEditMessageApiView.as_view(), name='message-edit'),
+    path('thread/<uuid>/delete', async_views.AsyncThreadCRUDApiView.as_view(), name='thread-delete'),
+    path('threads/batch/', views.ThreadBatchApiView.as_view(), name='thread-batch'),
+    path('search/', views.SearchApiView.as_view(), name='search'),
+    path('stream/', async_views.AsyncMessageStreamApiView.as_view(), name='stream'),
+]
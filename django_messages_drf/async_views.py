@@ -0,0 +1,225 @@
+"""
+Async counterparts of the views of `views.py` to be served under ASGI. The database is queried
+with the async ORM so a worker can keep many requests open while waiting on it.
+
+The urls are available in `django_messages_drf.async_urls`.
+"""
+import time
+from uuid import UUID
+
+from asgiref.sync import sync_to_async
+from rest_framework import status
+from rest_framework.exceptions import NotFound, PermissionDenied
+from rest_framework.response import Response
+
+from .brokers import get_broker
+from .cache import invalidate_users
+from .mixins import AsyncViewMixin
+from .models import Message, Thread
+from .renderers import EventStreamRenderer
+from .serializers import MessageSerializer
+from .views import (
+    EditMessageApiView,
+    InboxListApiView,
+    MessageStreamApiView,
+    ThreadCRUDApiView,
+    ThreadListApiView,
+)
+
+
+class AsyncInboxListApiView(AsyncViewMixin, InboxListApiView):
+    """
+    Returns the Inbox the logged in User
+    """
+
+    async def get(self, request, *args, **kwargs):
+        return await self.aconditional_response(
+            lambda: self.acached_response('inbox', self.aget_inbox, user=request.user.pk)
+        )
+
+    async def aget_inbox(self):
+        queryset = self.filter_queryset(self.get_queryset())
+
+        page = await self.apaginate_queryset(queryset)
+        if page is not None:
+            serializer = self.get_serializer(page, many=True)
+            return self.get_paginated_response(await self.adata(serializer))
+
+        serializer = self.get_serializer([thread async for thread in queryset], many=True)
+        return Response(await self.adata(serializer))
+
+
+class AsyncThreadListApiView(AsyncViewMixin, ThreadListApiView):
+    """
+    Gets a given thread and a window of its messages, the newest by default.
+    """
+
+    async def aget_thread(self):
+        """Async version of `get_thread`"""
+        return await self.apply_query_requirements(Thread.objects.filter(uuid=self.kwargs.get('uuid'))).afirst()
+
+    async def get(self, request, *args, **kwargs):
+        try:
+            thread_uuid = UUID(str(kwargs.get('uuid')))
+        except ValueError:
+            raise NotFound()
+        return await self.aconditional_response(
+            lambda: self.acached_response('thread', self.aget_window, thread=thread_uuid, user=request.user.pk)
+        )
+
+    async def aget_window(self):
+        instance = await self.aget_thread()
+        if not instance:
+            raise NotFound()
+
+        self.thread = instance
+        context = self.get_serializer_context()
+        context['messages'] = await self.apaginate_queryset(
+            self.apply_query_requirements(instance.messages.all(), 'messages')
+        )
+
+        serializer = self.serializer_class(instance, context=context)
+        data = await self.adata(serializer)
+        if context['messages'] is None:
+            return Response(data, status=status.HTTP_200_OK)
+        return self.get_paginated_response(data)
+
+
+class AsyncThreadCRUDApiView(AsyncViewMixin, ThreadCRUDApiView):
+    """
+    Creates a new thread with a given user or replies to a thread.
+    """
+
+    async def post(self, request, uuid=None, *args, **kwargs):
+        """
+        Replies a mensage in given thread
+        """
+        thread = await self.aget_thread() if uuid else None
+        user = await self.aget_user()
+
+        if not user:
+            raise NotFound()
+
+        serializer = self.serializer_class(data=request.data)
+        await self.ais_valid(serializer)
+
+        subject = serializer.data.get('subject') or thread.subject
+        if not thread:
+            msg = await Message.anew_message(
+                from_user=self.request.user, to_users=[user], subject=subject,
+                content=serializer.data.get('message')
+            )
+
+        else:
+            msg = await Message.anew_reply(thread, self.request.user, serializer.data.get('message'))
+            if subject != thread.subject:
+                # Only a new subject is saved, the search index of the thread is rewritten on save
+                thread.subject = subject
+                await thread.asave(update_fields=['subject', 'modified_at'])
+
+        message = MessageSerializer(msg, context=self.get_serializer_context())
+        return Response(await self.adata(message), status=status.HTTP_200_OK)
+
+    async def delete(self, request, *args, **kwargs):
+        """
+        Flags a thread as deleted from the system.
+        """
+        thread = await self.aget_thread()
+        if not thread:
+            raise NotFound()
+
+        await thread.userthread_set.filter(user=request.user).aupdate(deleted=True)
+        await sync_to_async(invalidate_users)([request.user.pk])
+        return Response(status=status.HTTP_200_OK)
+
+
+class AsyncEditMessageApiView(AsyncViewMixin, EditMessageApiView):
+    """
+    Edits a message sent from a user in a given thread
+    """
+    thread = None
+
+    async def aget_instance(self, user, message_uuid):
+        """
+        Checks of the message exists
+        """
+        try:
+            return await Message.objects.aget(sender=user, uuid=message_uuid)
+        except Message.DoesNotExist:
+            return
+
+    def get_serializer_context(self):
+        context = super(EditMessageApiView, self).get_serializer_context()
+        context.update({
+            'thread': self.thread,
+        })
+        return context
+
+    async def put(self, request, user_id, thread_id, *args, **kwargs):
+        """
+        Edits a mensage in given thread.
+        """
+        user = await self.aget_user()
+
+        if not user:
+            raise NotFound()
+
+        if (not user.pk == request.user.pk):
+            raise PermissionDenied()
+
+        instance = await self.aget_instance(user, request.data.get('uuid'))
+        if not instance:
+            raise NotFound()
+
+        self.thread = await self.aget_thread_by_id()
+        serializer = self.serializer_class(instance, data=request.data, context=self.get_serializer_context())
+        await self.ais_valid(serializer)
+        instance = await sync_to_async(serializer.save)()
+
+        message = MessageSerializer(instance, context=self.get_serializer_context())
+        return Response(await self.adata(message), status=status.HTTP_200_OK)
+
+
+class AsyncMessageStreamApiView(AsyncViewMixin, MessageStreamApiView):
+    """
+    Pushes the events of the messages sent to the threads of the logged in user. The stream is an
+    async generator waiting on the broker with `Subscription.aget`, so under ASGI the events reach
+    the client as they are published and an idle stream doesn't hold a thread.
+    """
+
+    async def asubscribe(self, user_id):
+        # The subscriptions of some brokers open a connection to the database
+        return await sync_to_async(get_broker().subscribe)(user_id)
+
+    async def apoll(self, subscription):
+        """Async version of `poll`"""
+        event = await subscription.aget(timeout=self.get_timeout())
+        events = []
+        while event is not None:
+            events.append(event)
+            event = await subscription.aget(timeout=0)
+        return events
+
+    async def astream(self, user_id):
+        deadline = time.monotonic() + self.get_max_age()
+        subscription = await self.asubscribe(user_id)
+        try:
+            yield ': connected\n\n'
+            while (remaining := deadline - time.monotonic()) > 0:
+                yield self.format_event(await subscription.aget(timeout=min(self.get_timeout(), remaining)))
+        finally:
+            await sync_to_async(subscription.close)()
+
+    async def get(self, request, *args, **kwargs):
+        user_id = request.user.pk
+        await sync_to_async(self.release_connections)()
+
+        if request.accepted_renderer.format == EventStreamRenderer.format:
+            return self.stream_response(self.astream(user_id))
+
+        subscription = await self.asubscribe(user_id)
+        try:
+            events = await self.apoll(subscription)
+        finally:
+            await sync_to_async(subscription.close)()
+        return Response({'events': events}, status=status.HTTP_200_OK)
@@ -0,0 +1,311 @@
+"""
+Brokers delivering the events of new messages to the streams of the participants.
+
+The subscriptions are waited on with `get` by the sync views and with `aget` by the async ones,
+which wait on the event loop without holding a thread.
+
+The broker is given by the `DJANGO_MESSAGES_DRF_EVENT_BROKER` setting and its keyword arguments
+by `DJANGO_MESSAGES_DRF_EVENT_BROKER_OPTIONS`. Waiting for an event doesn't query the database,
+therefore an idle stream has no cost for the database.
+
+- `InProcessBroker`: the default, the events are delivered to the streams of the same process.
+- `LocalSocketBroker`: the events are sent over unix datagram sockets in a directory, delivering
+them to every process of the same host.
+- `PostgresNotifyBroker`: the events are sent with `NOTIFY` and delivered to every process
+connected to the database.
+"""
+import asyncio
+import glob
+import json
+import os
+import queue
+import select
+import socket
+import tempfile
+import threading
+import uuid
+
+from django.conf import settings
+from django.db import connections
+from django.utils.module_loading import import_string
+
+from asgiref.sync import sync_to_async
+
+DEFAULT_BROKER = 'django_messages_drf.brokers.InProcessBroker'
+
+
+class BaseBroker:
+    """
+    Publishes events to the users and subscribes to the events of a user. The events are
+    dictionaries serializable to JSON.
+    """
+
+    def publish(self, user_ids, event):
+        raise NotImplementedError('publish() must be implemented.')
+
+    def subscribe(self, user_id):
+        """Returns a `Subscription` to the events of a given user"""
+        raise NotImplementedError('subscribe() must be implemented.')
+
+
+class Subscription:
+    """
+    The events of a user. Must be closed, it can be used as a context manager.
+    """
+
+    def get(self, timeout=None):
+        """Waits for the next event up to `timeout` seconds and returns it or None"""
+        raise NotImplementedError('get() must be implemented.')
+
+    async def aget(self, timeout=None):
+        """Async version of `get`, waits in a thread unless the subscription waits on the loop"""
+        return await sync_to_async(self.get, thread_sensitive=False)(timeout)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class InProcessSubscription(Subscription):
+
+    def __init__(self, broker, user_id, maxsize):
+        self.broker = broker
+        self.user_id = user_id
+        self.queue = queue.Queue(maxsize=maxsize)
+        # The (loop, asyncio.Event) of a pending `aget`, woken up by `notify`.
+        self.waiter = None
+
+    def get(self, timeout=None):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return
+
+    async def aget(self, timeout=None):
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+        self.waiter = (loop, ready)
+        try:
+            # Checked once the waiter is set so an event published meanwhile isn't missed.
+            if self.queue.empty():
+                await asyncio.wait_for(ready.wait(), timeout)
+            return self.queue.get_nowait()
+        except (asyncio.TimeoutError, queue.Empty):
+            return
+        finally:
+            self.waiter = None
+
+    def notify(self):
+        """Wakes up the pending `aget`, from any thread"""
+        waiter = self.waiter
+        if waiter is not None:
+            loop, ready = waiter
+            try:
+                loop.call_soon_threadsafe(ready.set)
+            except RuntimeError:
+                # The loop is closed
+                pass
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class InProcessBroker(BaseBroker):
+    """
+    Delivers the events to the subscriptions of the current process. Suitable for a single
+    worker. The events of a slow subscriber are dropped once `maxsize` events are queued.
+    """
+
+    def __init__(self, maxsize=100):
+        self.maxsize = maxsize
+        self.subscriptions = {}
+        self.lock = threading.Lock()
+
+    def publish(self, user_ids, event):
+        with self.lock:
+            subscriptions = [s for user_id in user_ids for s in self.subscriptions.get(str(user_id), ())]
+        for subscription in subscriptions:
+            try:
+                subscription.queue.put_nowait(event)
+            except queue.Full:
+                pass
+            subscription.notify()
+
+    def subscribe(self, user_id):
+        subscription = InProcessSubscription(self, str(user_id), self.maxsize)
+        with self.lock:
+            self.subscriptions.setdefault(subscription.user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.user_id, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self.subscriptions.pop(subscription.user_id, None)
+
+
+class LocalSocketSubscription(Subscription):
+
+    def __init__(self, path, buffer_size):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(path)
+
+    def get(self, timeout=None):
+        self.socket.settimeout(timeout)
+        try:
+            return json.loads(self.socket.recv(self.buffer_size))
+        except (socket.timeout, BlockingIOError):
+            return
+
+    async def aget(self, timeout=None):
+        self.socket.setblocking(False)
+        try:
+            data = await asyncio.wait_for(asyncio.get_running_loop().sock_recv(self.socket, self.buffer_size), timeout)
+        except asyncio.TimeoutError:
+            return
+        return json.loads(data)
+
+    def close(self):
+        self.socket.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class LocalSocketBroker(BaseBroker):
+    """
+    Every subscription binds a unix datagram socket in `directory` and the events are sent to the
+    sockets of the users. Delivers the events to every worker of the same host. The sockets left
+    behind by a dead process are removed on the next publish.
+    """
+
+    def __init__(self, directory=None, buffer_size=65536):
+        self.directory = directory or os.path.join(tempfile.gettempdir(), 'django-messages-drf')
+        self.buffer_size = buffer_size
+        os.makedirs(self.directory, exist_ok=True)
+
+    def get_prefix(self, user_id):
+        return os.path.join(self.directory, f"{user_id}.")
+
+    def publish(self, user_ids, event):
+        data = json.dumps(event).encode()
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sender:
+            sender.setblocking(False)
+            for user_id in user_ids:
+                for path in glob.glob(f"{glob.escape(self.get_prefix(user_id))}*.sock"):
+                    try:
+                        sender.sendto(data, path)
+                    except (ConnectionRefusedError, FileNotFoundError):
+                        self.remove(path)
+                    except BlockingIOError:
+                        pass
+
+    def remove(self, path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def subscribe(self, user_id):
+        return LocalSocketSubscription(f"{self.get_prefix(user_id)}{uuid.uuid4().hex}.sock", self.buffer_size)
+
+
+class PostgresNotifySubscription(Subscription):
+
+    def __init__(self, broker, channel):
+        self.connection = connections.create_connection(broker.using)
+        self.connection.set_autocommit(True)
+        with self.connection.cursor() as cursor:
+            cursor.execute(f"LISTEN {self.connection.ops.quote_name(channel)}")
+        self.raw = self.connection.connection
+        self.pending = []
+
+    def get(self, timeout=None):
+        if not self.pending:
+            if hasattr(self.raw, 'poll'):
+                # psycopg2
+                if select.select([self.raw], [], [], timeout) != ([], [], []):
+                    self.raw.poll()
+                    while self.raw.notifies:
+                        self.pending.append(self.raw.notifies.pop(0).payload)
+            else:
+                # psycopg >= 3.2
+                self.pending.extend(notify.payload for notify in self.raw.notifies(timeout=timeout, stop_after=1))
+        if self.pending:
+            return json.loads(self.pending.pop(0))
+
+    async def aget(self, timeout=None):
+        if self.pending or not hasattr(self.raw, 'poll'):
+            return await super().aget(timeout)
+
+        # psycopg2: waits for the socket of the connection to be readable on the loop
+        loop = asyncio.get_running_loop()
+        readable = asyncio.Event()
+        loop.add_reader(self.raw, readable.set)
+        try:
+            await asyncio.wait_for(readable.wait(), timeout)
+        except asyncio.TimeoutError:
+            return
+        finally:
+            loop.remove_reader(self.raw)
+        return self.get(timeout=0)
+
+    def close(self):
+        self.connection.close()
+
+
+class PostgresNotifyBroker(BaseBroker):
+    """
+    Sends the events with `pg_notify` to a channel per user. Every subscription holds a
+    connection to the database listening to the channel of the user, waiting on the socket of
+    the connection without running queries.
+    """
+
+    def __init__(self, using='default', prefix='dmdrf'):
+        self.using = using
+        self.prefix = prefix
+
+    def get_channel(self, user_id):
+        return f"{self.prefix}_{user_id}"
+
+    def publish(self, user_ids, event):
+        data = json.dumps(event)
+        with connections[self.using].cursor() as cursor:
+            for user_id in user_ids:
+                cursor.execute("SELECT pg_notify(%s, %s)", [self.get_channel(user_id), data])
+
+    def subscribe(self, user_id):
+        return PostgresNotifySubscription(self, self.get_channel(user_id))
+
+
+_brokers = {}
+
+
+def get_broker():
+    """Returns the broker given by the settings, one instance per process"""
+    path = getattr(settings, 'DJANGO_MESSAGES_DRF_EVENT_BROKER', DEFAULT_BROKER)
+    if path not in _brokers:
+        options = getattr(settings, 'DJANGO_MESSAGES_DRF_EVENT_BROKER_OPTIONS', {})
+        _brokers[path] = import_string(path)(**options)
+    return _brokers[path]
+
+
+def message_event(message, thread, reply):
+    """The event of a message sent"""
+    return {
+        'type': 'message',
+        'thread': str(thread.uuid),
+        'message': str(message.uuid),
+        'sender': str(message.sender_id),
+        'sent_at': message.sent_at.isoformat(),
+        'reply': reply,
+    }
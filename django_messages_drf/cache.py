@@ -0,0 +1,154 @@
+"""
+Cache of the responses of `InboxListApiView` and `ThreadListApiView`.
+
+Enabled by the `DJANGO_MESSAGES_DRF_RESPONSE_CACHE` setting. The data of a response is cached
+under a key made of version counters, one per user and one per thread, and the request:
+
+- inbox: the user and its version and the query string.
+- thread: the thread and its version, the user and its version and the query string.
+
+Nothing is deleted, the counters are bumped once the transaction is committed, on `message_sent`
+and the edits of a message for the thread and its participants, and on the deletes and the
+changes of the read state for the user. The stale responses are never read again and expire.
+
+The version of a user is also the validator of the inbox with `DJANGO_MESSAGES_DRF_CONDITIONAL_GET`,
+the counters are bumped when either setting is enabled.
+
+The cache is the one of `DJANGO_MESSAGES_DRF_RESPONSE_CACHE_ALIAS` or, by default, a local memory
+cache of the process evicting the least recently used responses past
+`DJANGO_MESSAGES_DRF_RESPONSE_CACHE_MAX_ENTRIES`.
+"""
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+
+from .models import UserThread
+
+PREFIX = 'dmdrf'
+
+
+def is_enabled():
+    return getattr(settings, 'DJANGO_MESSAGES_DRF_RESPONSE_CACHE', False)
+
+
+def is_versioned():
+    """The versions are read by the cached responses and by the ETags of the conditional requests"""
+    return is_enabled() or getattr(settings, 'DJANGO_MESSAGES_DRF_CONDITIONAL_GET', False)
+
+
+class ResponseCache:
+    """
+    Caches the data of the responses in `cache` for `timeout` seconds and counts the hits and the
+    misses of the process.
+    """
+
+    def __init__(self, cache, timeout=300):
+        self.cache = cache
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def version_key(self, kind, pk):
+        return f"{PREFIX}:v:{kind}:{pk}"
+
+    def get_versions(self, keys):
+        """
+        The versions of the given keys. A missing version, never bumped or evicted, starts from
+        the current time so the responses cached under an evicted version are never read again.
+        """
+        versions = self.cache.get_many(keys)
+        for key in keys:
+            if key not in versions:
+                self.cache.add(key, time.time_ns(), timeout=None)
+                versions[key] = self.cache.get(key)
+        return [versions[key] for key in keys]
+
+    def bump(self, kind, pks):
+        for pk in set(pks):
+            key = self.version_key(kind, pk)
+            try:
+                self.cache.incr(key)
+            except ValueError:
+                self.cache.set(key, time.time_ns(), timeout=None)
+
+    def get_key(self, name, request, **versioned):
+        """
+        The key of the response `name` for the request, given the objects of `versioned`, `user`
+        and `thread`, the thread by uuid.
+        """
+        keys = [self.version_key(kind, pk) for kind, pk in versioned.items()]
+        versions = self.get_versions(keys)
+        parts = [f"{kind}={pk}@{version}" for (kind, pk), version in zip(versioned.items(), versions)]
+        query = hashlib.md5(request.META.get('QUERY_STRING', '').encode()).hexdigest()
+        return f"{PREFIX}:{name}:{':'.join(parts)}:{query}"
+
+    def get(self, key):
+        data = self.cache.get(key)
+        with self.lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return data
+
+    def set(self, key, data):
+        self.cache.set(key, data, timeout=self.timeout)
+
+    def stats(self):
+        """The hits and the misses of the process"""
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+    def reset_stats(self):
+        with self.lock:
+            self.hits = self.misses = 0
+
+
+_caches = {}
+
+
+def get_response_cache():
+    """Returns the cache given by the settings, one instance per process"""
+    alias = getattr(settings, 'DJANGO_MESSAGES_DRF_RESPONSE_CACHE_ALIAS', None)
+    if alias not in _caches:
+        timeout = getattr(settings, 'DJANGO_MESSAGES_DRF_RESPONSE_CACHE_TIMEOUT', 300)
+        if alias:
+            cache = caches[alias]
+        else:
+            max_entries = getattr(settings, 'DJANGO_MESSAGES_DRF_RESPONSE_CACHE_MAX_ENTRIES', 10000)
+            cache = LocMemCache('django_messages_drf', {'OPTIONS': {'MAX_ENTRIES': max_entries}})
+        _caches[alias] = ResponseCache(cache, timeout=timeout)
+    return _caches[alias]
+
+
+def get_user_version(user_id):
+    """The version of a user, bumped by every change of its inbox"""
+    cache = get_response_cache()
+    return cache.get_versions([cache.version_key('user', user_id)])[0]
+
+
+def invalidate_users(user_ids, using=None):
+    """Bumps the versions of the users once the transaction is committed"""
+    if not is_versioned():
+        return
+    user_ids = list(user_ids)
+    transaction.on_commit(lambda: get_response_cache().bump('user', user_ids), using=using)
+
+
+def invalidate_thread(thread, using=None):
+    """Bumps the version of the thread and of its participants once the transaction is committed"""
+    if not is_versioned():
+        return
+
+    def bump():
+        cache = get_response_cache()
+        cache.bump('thread', [thread.uuid])
+        cache.bump('user', UserThread.objects.filter(thread_id=thread.pk).values_list('user_id', flat=True))
+
+    transaction.on_commit(bump, using=using)
@@ -0,0 +1,177 @@
+"""
+Generation of large datasets of users, threads and messages for staging and benchmarks.
+
+The rows are inserted in batches, the users and the threads with `bulk_create` and the
+participants and the messages with `executemany`, without signals, password hashing per user or
+indexing. The messages are indexed for the search with the `rebuild_message_index` command.
+"""
+import random
+import re
+from datetime import timedelta
+from uuid import uuid4
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.db import connection, transaction
+from django.db.models import OuterRef, Subquery
+from django.utils import timezone
+
+from .models import Message, Thread, UserThread
+
+WORDS = (
+    "hello", "thanks", "meeting", "tomorrow", "project", "review", "update", "question", "call",
+    "invoice", "weekend", "deadline", "draft", "photos", "lunch", "report", "flight", "budget",
+)
+
+
+class Distribution:
+    """
+    A distribution of positive integers given as a constant (`3`), a uniform range (`2-5`) or
+    weighted values (`2:70,3:20,10:10`).
+    """
+
+    def __init__(self, values, weights=None):
+        self.values = list(values)
+        self.weights = weights
+
+    @classmethod
+    def parse(cls, value):
+        value = str(value).strip()
+        if re.fullmatch(r'\d+', value):
+            return cls([int(value)])
+        match = re.fullmatch(r'(\d+)\s*-\s*(\d+)', value)
+        if match:
+            low, high = sorted(map(int, match.groups()))
+            return cls(range(low, high + 1))
+        if re.fullmatch(r'\d+:\d+(\s*,\s*\d+:\d+)*', value):
+            pairs = [tuple(map(int, item.split(':'))) for item in value.split(',')]
+            return cls([v for v, _ in pairs], [w for _, w in pairs])
+        raise ValueError(f"Invalid distribution: {value}")
+
+    def sample(self, rng):
+        if len(self.values) == 1:
+            return self.values[0]
+        if self.weights is None:
+            return rng.choice(self.values)
+        return rng.choices(self.values, self.weights)[0]
+
+
+def as_distribution(value):
+    return value if isinstance(value, Distribution) else Distribution.parse(value)
+
+
+def insert_rows(model, fields, rows):
+    """
+    Inserts the tuples of `rows`, ordered as `fields`, with a single `executemany` skipping the
+    model instances. The values must be adapted to the database.
+    """
+    quote = connection.ops.quote_name
+    columns = ', '.join(quote(model._meta.get_field(field).column) for field in fields)
+    placeholders = ', '.join(['%s'] * len(fields))
+    with connection.cursor() as cursor:
+        cursor.executemany(f"INSERT INTO {quote(model._meta.db_table)} ({columns}) VALUES ({placeholders})", rows)
+
+
+def create_users(count, prefix='dataset', password=None, batch_size=5000):
+    """
+    Inserts `count` users named after `prefix` and numbered after the existing ones, sharing a
+    password hashed once, unusable by default. Returns the ids of the users.
+    """
+    User = get_user_model()
+    start = User.objects.filter(username__startswith=f"{prefix}-").count()
+    hashed = make_password(password)
+    ids = []
+    for offset in range(0, count, batch_size):
+        users = [
+            User(username=f"{prefix}-{start + i}", password=hashed)
+            for i in range(offset, min(offset + batch_size, count))
+        ]
+        with transaction.atomic():
+            User.objects.bulk_create(users)
+        if connection.features.can_return_rows_from_bulk_insert:
+            ids.extend(user.pk for user in users)
+        else:
+            names = [user.username for user in users]
+            ids.extend(User.objects.filter(username__in=names).order_by('pk').values_list('pk', flat=True))
+    return ids
+
+
+def create_threads(users, count, participants, messages, unread_ratio, deleted_ratio, rng, days, now):
+    """
+    Inserts `count` threads with their participants and messages. Returns the number of
+    participants and of messages inserted.
+    """
+    threads, members, timelines = [], [], []
+    for _ in range(count):
+        size = min(max(participants.sample(rng), 2), len(users))
+        length = max(messages.sample(rng), 1)
+        start = now - timedelta(seconds=rng.randrange(days * 86400 or 1))
+        sent = sorted(start + timedelta(seconds=rng.randrange(max(int((now - start).total_seconds()), 1)))
+                      for _ in range(length))
+        threads.append(Thread(subject=' '.join(rng.sample(WORDS, 3)).capitalize(), seq=length, last_message_at=sent[-1]))
+        members.append(rng.sample(users, size))
+        timelines.append(sent)
+
+    Thread.objects.bulk_create(threads)
+    if not connection.features.can_return_rows_from_bulk_insert:
+        uuids = {thread.uuid: thread for thread in threads}
+        for uuid, pk in Thread.objects.filter(uuid__in=list(uuids)).values_list('uuid', 'pk'):
+            uuids[uuid].pk = pk
+
+    new_uuid = (lambda: str(uuid4())) if connection.features.has_native_uuid_field else (lambda: uuid4().hex)
+    adapt_datetime = connection.ops.adapt_datetimefield_value
+    user_threads, thread_messages = [], []
+    for thread, people, sent in zip(threads, members, timelines):
+        for user in people:
+            unread = rng.random() < unread_ratio
+            user_threads.append((
+                new_uuid(), thread.pk, user, rng.random() < deleted_ratio,
+                rng.randrange(thread.seq) if unread else thread.seq, adapt_datetime(now),
+            ))
+        for seq, sent_at in enumerate(sent, start=1):
+            thread_messages.append((
+                new_uuid(), thread.pk, rng.choice(people), adapt_datetime(sent_at), seq,
+                ' '.join(rng.choices(WORDS, k=rng.randint(3, 12))).capitalize(),
+            ))
+
+    insert_rows(UserThread, ('uuid', 'thread', 'user', 'deleted', 'last_read_seq', 'modified_at'), user_threads)
+    insert_rows(Message, ('uuid', 'thread', 'sender', 'sent_at', 'seq', 'content'), thread_messages)
+    latest = Message.objects.filter(thread=OuterRef('pk'), seq=OuterRef('seq')).values('pk')[:1]
+    Thread.objects.filter(pk__in=[thread.pk for thread in threads]).update(last_sent_message=Subquery(latest))
+    return len(user_threads), len(thread_messages)
+
+
+def generate_dataset(users=1000, threads=10000, participants=2, messages=20, unread_ratio=0.2, deleted_ratio=0.05,
+                     seed=0, days=365, prefix='dataset', password=None, batch_size=1000, log=None):
+    """
+    Generates `users` users and `threads` threads between them, inserted by batches of
+    `batch_size` threads in their own transaction. `participants` and `messages` are the
+    distributions of the participants and of the messages of each thread (see `Distribution`).
+    `unread_ratio` of the participants have unread messages and `deleted_ratio` of them deleted
+    the thread. The messages are spread over the last `days`. The same `seed` generates the same
+    threads, participants and messages, apart from the uuids. Returns the number of rows inserted
+    by model.
+    """
+    if users < 2:
+        raise ValueError("At least two users are required")
+    rng = random.Random(seed)
+    participants, messages = as_distribution(participants), as_distribution(messages)
+    now = timezone.now()
+
+    ids = create_users(users, prefix=prefix, password=password, batch_size=max(batch_size, 1000))
+    totals = {'users': len(ids), 'threads': 0, 'user_threads': 0, 'messages': 0}
+    if log:
+        log(f"users: {totals['users']}")
+
+    for offset in range(0, threads, batch_size):
+        count = min(batch_size, threads - offset)
+        with transaction.atomic():
+            user_threads, thread_messages = create_threads(
+                ids, count, participants, messages, unread_ratio, deleted_ratio, rng, days, now
+            )
+        totals['threads'] += count
+        totals['user_threads'] += user_threads
+        totals['messages'] += thread_messages
+        if log:
+            log(f"threads: {totals['threads']}, messages: {totals['messages']}")
+    return totals
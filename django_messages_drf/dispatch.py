@@ -0,0 +1,165 @@
+"""
+Dispatch of the `message_sent` receivers.
+
+The mode is given by the `DJANGO_MESSAGES_DRF_SIGNAL_DISPATCH` setting:
+
+- `sync`: the default, the receivers run inside the transaction of the message.
+- `on_commit`: the receivers run once the transaction is committed, in the same thread.
+- `deferred`: the receivers run once the transaction is committed on the backend of
+`DJANGO_MESSAGES_DRF_SIGNAL_BACKEND`, a bounded thread pool by default.
+
+Receivers decorated with `synchronous` always run inside the transaction. Outside of the `sync`
+mode every receiver is timed and its failures are logged without affecting the others.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, transaction
+from django.utils.module_loading import import_string
+
+from asgiref.sync import async_to_sync, iscoroutinefunction
+
+from .signals import message_sent
+
+log = logging.getLogger(__name__)
+
+SYNC = 'sync'
+ON_COMMIT = 'on_commit'
+DEFERRED = 'deferred'
+DEFAULT_BACKEND = 'django_messages_drf.dispatch.ThreadPoolBackend'
+
+
+def synchronous(receiver):
+    """
+    Marks a receiver of `message_sent` to run inside the transaction of the message regardless
+    of the dispatch mode.
+
+    Example:
+        ```
+        @receiver(message_sent)
+        @synchronous
+        def my_receiver(sender, message, thread, reply, **kwargs):
+            ...
+        ```
+    """
+    receiver.message_sent_synchronous = True
+    return receiver
+
+
+class BaseBackend:
+    """Runs the receivers of a deferred dispatch"""
+
+    def submit(self, func, *args, **kwargs):
+        raise NotImplementedError('submit() must be implemented.')
+
+
+class ImmediateBackend(BaseBackend):
+    """Runs the receivers right away in the thread that committed the transaction"""
+
+    def submit(self, func, *args, **kwargs):
+        func(*args, **kwargs)
+
+
+class ThreadPoolBackend(BaseBackend):
+    """
+    Runs the receivers on a pool of `max_workers` threads. At most `max_pending` dispatches are
+    queued, once full the dispatch runs in the thread that committed the transaction.
+    The database connections of the worker are closed after each dispatch.
+    """
+
+    def __init__(self, max_workers=4, max_pending=1000):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='django-messages-drf')
+        self.slots = threading.BoundedSemaphore(max_pending)
+
+    def submit(self, func, *args, **kwargs):
+        if not self.slots.acquire(blocking=False):
+            log.warning("The message_sent dispatch queue is full, running it in the current thread")
+            return func(*args, **kwargs)
+        return self.executor.submit(self.run, func, *args, **kwargs)
+
+    def run(self, func, *args, **kwargs):
+        try:
+            func(*args, **kwargs)
+        finally:
+            connections.close_all()
+            self.slots.release()
+
+
+_backends = {}
+
+
+def get_backend():
+    """Returns the backend given by the settings, one instance per process"""
+    path = getattr(settings, 'DJANGO_MESSAGES_DRF_SIGNAL_BACKEND', DEFAULT_BACKEND)
+    if path not in _backends:
+        options = getattr(settings, 'DJANGO_MESSAGES_DRF_SIGNAL_BACKEND_OPTIONS', {})
+        _backends[path] = import_string(path)(**options)
+    return _backends[path]
+
+
+def get_mode():
+    return getattr(settings, 'DJANGO_MESSAGES_DRF_SIGNAL_DISPATCH', SYNC)
+
+
+def get_receivers(sender):
+    """The live receivers of `message_sent`"""
+    receivers = message_sent._live_receivers(sender)
+    if isinstance(receivers, tuple):
+        # Django >= 5.0 splits the sync and async receivers
+        receivers = [*receivers[0], *receivers[1]]
+    return receivers
+
+
+def call_receiver(receiver, sender, **kwargs):
+    if iscoroutinefunction(receiver):
+        receiver = async_to_sync(receiver)
+    return receiver(signal=message_sent, sender=sender, **kwargs)
+
+
+def run_receiver(receiver, sender, **kwargs):
+    """Runs a receiver, logging its duration and its failure"""
+    start = time.perf_counter()
+    try:
+        call_receiver(receiver, sender, **kwargs)
+    except Exception:
+        log.exception("The message_sent receiver %r failed", receiver)
+    finally:
+        elapsed = (time.perf_counter() - start) * 1000
+        slow = getattr(settings, 'DJANGO_MESSAGES_DRF_SLOW_RECEIVER_MS', 500)
+        log.log(logging.WARNING if elapsed > slow else logging.DEBUG,
+                "The message_sent receiver %r took %.1fms", receiver, elapsed)
+
+
+def run_receivers(receivers, sender, **kwargs):
+    for receiver in receivers:
+        run_receiver(receiver, sender, **kwargs)
+
+
+def send_message_sent(sender, **kwargs):
+    """
+    Sends `message_sent` with the mode of `DJANGO_MESSAGES_DRF_SIGNAL_DISPATCH`. Must be called
+    inside the transaction of the message.
+    """
+    mode = get_mode()
+    if mode == SYNC:
+        return message_sent.send(sender=sender, **kwargs)
+    if mode not in (ON_COMMIT, DEFERRED):
+        raise ImproperlyConfigured(f"Unknown DJANGO_MESSAGES_DRF_SIGNAL_DISPATCH: {mode}")
+
+    deferred = []
+    for receiver in get_receivers(sender):
+        if getattr(receiver, 'message_sent_synchronous', False):
+            call_receiver(receiver, sender, **kwargs)
+        else:
+            deferred.append(receiver)
+
+    if not deferred:
+        return
+    if mode == DEFERRED:
+        transaction.on_commit(lambda: get_backend().submit(run_receivers, deferred, sender, **kwargs))
+    else:
+        transaction.on_commit(lambda: run_receivers(deferred, sender, **kwargs))
@@ -0,0 +1,198 @@
+"""
+Opt-in timing of the requests of the views built on `RequireUserContextView`.
+
+Enabled by the `DJANGO_MESSAGES_DRF_INSTRUMENTATION` setting, every request records the number of
+queries, the time spent in the database, paginating, serializing and in the whole view. The
+timings are returned in the `Server-Timing` header and sent to the sink of
+`DJANGO_MESSAGES_DRF_INSTRUMENTATION_SINK`, the log by default, with the keyword arguments of
+`DJANGO_MESSAGES_DRF_INSTRUMENTATION_SINK_OPTIONS`:
+
+- `LoggingSink`: logs every request, or only the ones slower than `slow_ms`.
+- `MemorySink`: keeps the latest `size` requests in memory.
+- `CallableSink`: calls a function, or the dotted path of one, with the metrics.
+
+When disabled the views only read the setting.
+"""
+import logging
+import time
+from collections import deque
+from contextlib import ExitStack, asynccontextmanager, contextmanager
+
+from django.conf import settings
+from django.db import connections
+from django.utils.module_loading import import_string
+
+from asgiref.sync import sync_to_async
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SINK = 'django_messages_drf.instrumentation.LoggingSink'
+
+
+def is_enabled():
+    return getattr(settings, 'DJANGO_MESSAGES_DRF_INSTRUMENTATION', False)
+
+
+class RequestMetrics:
+    """
+    The metrics of a request. `timings` holds the milliseconds of the phases of the view, e.g.
+    `paginate` and `serialize`, `db_ms` the time of the queries and `total_ms` of the view.
+    """
+
+    def __init__(self, view, method, path):
+        self.view = view
+        self.method = method
+        self.path = path
+        self.status = None
+        self.queries = 0
+        self.db_ms = 0.0
+        self.timings = {}
+        self.total_ms = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        """Counts and times the queries, as an `execute_wrapper` of the connections"""
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.db_ms += (time.perf_counter() - start) * 1000
+
+    @contextmanager
+    def record_queries(self):
+        """Counts and times the queries of the connections of the current thread in the block"""
+        with ExitStack() as stack:
+            for alias in connections:
+                stack.enter_context(connections[alias].execute_wrapper(self))
+            yield
+
+    @contextmanager
+    def measure(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + (time.perf_counter() - start) * 1000
+
+    def server_timing(self):
+        """The value of the `Server-Timing` header"""
+        metrics = [f'db;dur={self.db_ms:.2f};desc="{self.queries} queries"']
+        metrics.extend(f'{name};dur={value:.2f}' for name, value in self.timings.items())
+        metrics.append(f'view;dur={self.total_ms:.2f}')
+        return ', '.join(metrics)
+
+    def as_dict(self):
+        return {
+            'view': self.view,
+            'method': self.method,
+            'path': self.path,
+            'status': self.status,
+            'queries': self.queries,
+            'db_ms': round(self.db_ms, 3),
+            'timings': {name: round(value, 3) for name, value in self.timings.items()},
+            'total_ms': round(self.total_ms, 3),
+        }
+
+
+@contextmanager
+def instrument(view, request):
+    """
+    Records the metrics of the request of the view for the duration of the block and sends them
+    to the sink once finished.
+    """
+    metrics = RequestMetrics(view.__class__.__name__, request.method, request.path)
+    start = time.perf_counter()
+    try:
+        with metrics.record_queries():
+            yield metrics
+    finally:
+        finish(metrics, start)
+
+
+@asynccontextmanager
+async def ainstrument(view, request):
+    """
+    Async version of `instrument`. The queries are recorded in the thread running the sync code
+    of the request, where the async ORM runs them.
+    """
+    metrics = RequestMetrics(view.__class__.__name__, request.method, request.path)
+    start = time.perf_counter()
+    recording = metrics.record_queries()
+    await sync_to_async(recording.__enter__)()
+    try:
+        yield metrics
+    finally:
+        await sync_to_async(recording.__exit__)(None, None, None)
+        finish(metrics, start)
+
+
+def finish(metrics, start):
+    """Sends the metrics of the request started at `start` to the sink"""
+    metrics.total_ms = (time.perf_counter() - start) * 1000
+    try:
+        get_sink().record(metrics)
+    except Exception:
+        log.exception("The instrumentation sink failed")
+
+
+class BaseSink:
+    """Receives the metrics of the requests"""
+
+    def record(self, metrics):
+        raise NotImplementedError('record() must be implemented.')
+
+
+class LoggingSink(BaseSink):
+    """
+    Logs the metrics of the requests slower than `slow_ms`, every request by default, with the
+    metrics in the `metrics` attribute of the record.
+    """
+
+    def __init__(self, logger=__name__, level=logging.INFO, slow_ms=None):
+        self.logger = logging.getLogger(logger)
+        self.level = logging.getLevelName(level) if isinstance(level, str) else level
+        self.slow_ms = slow_ms
+
+    def record(self, metrics):
+        if self.slow_ms is not None and metrics.total_ms < self.slow_ms:
+            return
+        self.logger.log(
+            self.level, "%s %s %s: %d queries in %.1fms, %.1fms in total",
+            metrics.method, metrics.path, metrics.status, metrics.queries, metrics.db_ms, metrics.total_ms,
+            extra={'metrics': metrics.as_dict()}
+        )
+
+
+class MemorySink(BaseSink):
+    """Keeps the metrics of the latest `size` requests, the oldest are dropped"""
+
+    def __init__(self, size=1000):
+        self.records = deque(maxlen=size)
+
+    def record(self, metrics):
+        self.records.append(metrics)
+
+    def clear(self):
+        self.records.clear()
+
+
+class CallableSink(BaseSink):
+    """Calls `func`, a callable or its dotted path, with the metrics of every request"""
+
+    def __init__(self, func):
+        self.func = import_string(func) if isinstance(func, str) else func
+
+    def record(self, metrics):
+        self.func(metrics)
+
+
+_sinks = {}
+
+
+def get_sink():
+    """Returns the sink given by the settings, one instance per process"""
+    path = getattr(settings, 'DJANGO_MESSAGES_DRF_INSTRUMENTATION_SINK', DEFAULT_SINK)
+    if path not in _sinks:
+        options = getattr(settings, 'DJANGO_MESSAGES_DRF_INSTRUMENTATION_SINK_OPTIONS', {})
+        _sinks[path] = import_string(path)(**options)
+    return _sinks[path]
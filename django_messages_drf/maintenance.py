@@ -0,0 +1,142 @@
+"""
+Retention of the messages. The work is done in batches of bounded size, each one in its own
+transaction, so it can run while the application is serving and be resumed after an interruption.
+"""
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+
+from .models import ArchivedMessage, Message, Thread, UserThread
+
+ARCHIVED_FIELDS = ('id', 'uuid', 'thread_id', 'sender_id', 'sent_at', 'content', 'seq')
+
+
+def get_archive_settings():
+    """The default ages of `archive_messages`, in days"""
+    return (
+        getattr(settings, 'DJANGO_MESSAGES_DRF_ARCHIVE_AFTER_DAYS', None),
+        getattr(settings, 'DJANGO_MESSAGES_DRF_ARCHIVE_IDLE_DAYS', None),
+    )
+
+
+def archivable_messages(older_than=None, idle_for=None, now=None):
+    """
+    The messages sent before `older_than` ago or in threads without activity for `idle_for`, both
+    timedeltas. The latest message of every thread is kept so the inbox never reads the archive.
+    """
+    if older_than is None and idle_for is None:
+        raise ValueError("Either older_than or idle_for must be given")
+
+    now = now or timezone.now()
+    conditions = Q()
+    if older_than is not None:
+        conditions |= Q(sent_at__lt=now - older_than)
+    if idle_for is not None:
+        conditions |= Q(thread__last_message_at__lt=now - idle_for)
+
+    latest = Thread.objects.filter(last_sent_message=OuterRef('pk'))
+    return Message.objects.filter(conditions).exclude(Exists(latest))
+
+
+def archive_messages(older_than=None, idle_for=None, batch_size=1000, max_batches=None, log=None):
+    """
+    Moves the `archivable_messages` to `ArchivedMessage` in batches of `batch_size`, ordered by
+    the primary key, up to `max_batches`. The rows of a batch are locked, copied and deleted in a
+    single transaction. Returns the number of messages archived.
+    """
+    queryset = archivable_messages(older_than=older_than, idle_for=idle_for)
+    archived = batches = last = 0
+
+    while max_batches is None or batches < max_batches:
+        ids = list(queryset.filter(pk__gt=last).order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            break
+
+        with transaction.atomic():
+            rows = Message.objects.select_for_update().filter(pk__in=ids).values(*ARCHIVED_FIELDS)
+            ArchivedMessage.objects.bulk_create([ArchivedMessage(**row) for row in rows])
+            Message.objects.filter(pk__in=ids).delete()
+
+        archived += len(ids)
+        batches += 1
+        last = ids[-1]
+        if log:
+            log(f"Archived {archived} messages")
+    return archived
+
+
+def deleted_threads():
+    """
+    The threads none of the participants has in the inbox. The anti-join is resolved by the
+    (thread, deleted) index of `UserThread`.
+    """
+    active = UserThread.objects.filter(thread=OuterRef('pk'), deleted=False)
+    return Thread.objects.exclude(Exists(active))
+
+
+def count_thread_rows(thread_ids):
+    """The rows of the given threads, by table"""
+    return {
+        'threads': len(thread_ids),
+        'messages': Message.objects.filter(thread__in=thread_ids).count(),
+        'archived_messages': ArchivedMessage.objects.filter(thread__in=thread_ids).count(),
+        'user_threads': UserThread.objects.filter(thread__in=thread_ids).count(),
+    }
+
+
+def delete_threads(thread_ids):
+    """
+    Deletes the given threads with their messages and participants, returns the rows deleted.
+    The rows collected by the deletion only load their primary key.
+    """
+    Thread.objects.filter(pk__in=thread_ids).update(last_sent_message=None)
+    return {
+        'messages': Message.objects.filter(thread__in=thread_ids).only('pk').delete()[0],
+        'archived_messages': ArchivedMessage.objects.filter(thread__in=thread_ids).delete()[0],
+        'user_threads': UserThread.objects.filter(thread__in=thread_ids).delete()[0],
+        'threads': Thread.objects.filter(pk__in=thread_ids).only('pk').delete()[0],
+    }
+
+
+def purge_deleted_threads(chunk_size=100, sleep=0, max_chunks=None, dry_run=False, throttle=None, log=None):
+    """
+    Deletes the `deleted_threads` with their messages, archived messages and participants in
+    chunks of `chunk_size` threads, ordered by the primary key, up to `max_chunks`.
+
+    Every chunk is deleted in its own transaction, where the threads are locked and checked
+    again so a thread replied meanwhile is kept. Between the chunks the purge waits `sleep`
+    seconds and calls `throttle`, a callable that may block, e.g. until the replicas catch up.
+
+    With `dry_run` nothing is deleted. Returns the number of rows, by table.
+    """
+    totals = {'threads': 0, 'messages': 0, 'archived_messages': 0, 'user_threads': 0}
+    chunks = last = 0
+
+    while max_chunks is None or chunks < max_chunks:
+        if chunks and not dry_run:
+            if sleep:
+                time.sleep(sleep)
+            if throttle:
+                throttle()
+
+        ids = list(deleted_threads().filter(pk__gt=last).order_by('pk').values_list('pk', flat=True)[:chunk_size])
+        if not ids:
+            break
+
+        if dry_run:
+            counts = count_thread_rows(ids)
+        else:
+            with transaction.atomic():
+                locked = list(deleted_threads().select_for_update().filter(pk__in=ids).values_list('pk', flat=True))
+                counts = delete_threads(locked)
+
+        for table, count in counts.items():
+            totals[table] += count
+        chunks += 1
+        last = ids[-1]
+        if log:
+            log(", ".join(f"{table}: {count}" for table, count in totals.items()))
+    return totals
@@ -0,0 +1,44 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...maintenance import archive_messages, get_archive_settings
+
+
+class Command(BaseCommand):
+    help = (
+        "Moves the messages older than a given age, or of the threads idle for a given time, to the "
+        "archive in batches. The latest message of every thread is kept."
+    )
+
+    def add_arguments(self, parser):
+        after_days, idle_days = get_archive_settings()
+        parser.add_argument(
+            '--older-than', type=int, default=after_days, metavar='DAYS',
+            help="Archives the messages sent before the given days (default: DJANGO_MESSAGES_DRF_ARCHIVE_AFTER_DAYS).",
+        )
+        parser.add_argument(
+            '--idle', type=int, default=idle_days, metavar='DAYS',
+            help="Archives the threads without activity for the given days (default: DJANGO_MESSAGES_DRF_ARCHIVE_IDLE_DAYS).",
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help="The number of messages moved by each transaction (default: 1000).",
+        )
+        parser.add_argument(
+            '--max-batches', type=int, default=None,
+            help="Stops after the given number of batches, the next run resumes.",
+        )
+
+    def handle(self, *args, **options):
+        if options['older_than'] is None and options['idle'] is None:
+            raise CommandError("Either --older-than or --idle must be given.")
+
+        count = archive_messages(
+            older_than=timedelta(days=options['older_than']) if options['older_than'] is not None else None,
+            idle_for=timedelta(days=options['idle']) if options['idle'] is not None else None,
+            batch_size=options['batch_size'],
+            max_batches=options['max_batches'],
+            log=self.stdout.write if options['verbosity'] > 1 else None,
+        )
+        self.stdout.write(self.style.SUCCESS(f"Archived {count} messages"))
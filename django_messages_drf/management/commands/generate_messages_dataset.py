@@ -0,0 +1,68 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ...datasets import Distribution, generate_dataset
+
+
+def ratio(value):
+    value = float(value)
+    if not 0 <= value <= 1:
+        raise ValueError(value)
+    return value
+
+
+class Command(BaseCommand):
+    help = (
+        "Generates users, threads, participants and messages in bulk for staging and benchmarks. "
+        "The distributions are a constant (3), a uniform range (2-5) or weighted values (2:70,3:20,10:10)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000, help="The users to create (default: 1000).")
+        parser.add_argument('--threads', type=int, default=10000, help="The threads to create (default: 10000).")
+        parser.add_argument(
+            '--participants', type=Distribution.parse, default='2',
+            help="The distribution of the participants of each thread (default: 2).",
+        )
+        parser.add_argument(
+            '--messages', type=Distribution.parse, default='1-40',
+            help="The distribution of the messages of each thread (default: 1-40).",
+        )
+        parser.add_argument(
+            '--unread-ratio', type=ratio, default=0.2,
+            help="The ratio of the participants with unread messages (default: 0.2).",
+        )
+        parser.add_argument(
+            '--deleted-ratio', type=ratio, default=0.05,
+            help="The ratio of the participants who deleted the thread (default: 0.05).",
+        )
+        parser.add_argument('--days', type=int, default=365, help="The days the messages are spread over (default: 365).")
+        parser.add_argument('--seed', type=int, default=0, help="The seed of the generator (default: 0).")
+        parser.add_argument('--prefix', default='dataset', help="The prefix of the usernames (default: dataset).")
+        parser.add_argument('--password', default=None, help="The password of every user, unusable by default.")
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help="The threads inserted by each transaction (default: 1000).",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            totals = generate_dataset(
+                users=options['users'],
+                threads=options['threads'],
+                participants=options['participants'],
+                messages=options['messages'],
+                unread_ratio=options['unread_ratio'],
+                deleted_ratio=options['deleted_ratio'],
+                seed=options['seed'],
+                days=options['days'],
+                prefix=options['prefix'],
+                password=options['password'],
+                batch_size=options['batch_size'],
+                log=self.stdout.write if options['verbosity'] > 1 else None,
+            )
+        except ValueError as exc:
+            raise CommandError(exc)
+        self.stdout.write(self.style.SUCCESS(
+            f"Generated {totals['users']} users, {totals['threads']} threads, {totals['user_threads']} "
+            f"participants and {totals['messages']} messages. Run rebuild_message_index to search them."
+        ))
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+
+from ...maintenance import purge_deleted_threads
+
+
+class Command(BaseCommand):
+    help = (
+        "Deletes the threads deleted by all the participants with their messages in chunks. "
+        "The chunk size bounds the time the rows are locked and the sleep between the chunks "
+        "lets the replicas catch up."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size', type=int, default=100,
+            help="The number of threads deleted by each transaction (default: 100).",
+        )
+        parser.add_argument(
+            '--sleep', type=float, default=0,
+            help="Seconds to wait between the chunks (default: 0).",
+        )
+        parser.add_argument(
+            '--max-chunks', type=int, default=None,
+            help="Stops after the given number of chunks, the next run resumes.",
+        )
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help="Reports the rows that would be deleted without deleting them.",
+        )
+
+    def handle(self, *args, **options):
+        totals = purge_deleted_threads(
+            chunk_size=options['chunk_size'],
+            sleep=options['sleep'],
+            max_chunks=options['max_chunks'],
+            dry_run=options['dry_run'],
+            log=self.stdout.write if options['verbosity'] > 1 else None,
+        )
+        verb = "Would delete" if options['dry_run'] else "Deleted"
+        self.stdout.write(self.style.SUCCESS(
+            f"{verb} {totals['threads']} threads, {totals['messages']} messages, "
+            f"{totals['archived_messages']} archived messages and {totals['user_threads']} participants"
+        ))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from ...search import get_search_backend, rebuild_index
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the search index of the messages and the subjects of the threads in batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help="The number of rows indexed by each transaction (default: 1000).",
+        )
+
+    def handle(self, *args, **options):
+        backend = get_search_backend()
+        self.stdout.write(f"Rebuilding the index of {backend.__class__.__name__}")
+        log = self.stdout.write if options['verbosity'] > 1 else None
+        threads, messages = rebuild_index(batch_size=options['batch_size'], log=log)
+        self.stdout.write(self.style.SUCCESS(f"Indexed {threads} threads and {messages} messages"))
@@ -0,0 +1,38 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:20
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+import django.db.models.deletion
+
+
+def backfill_last_message(apps, schema_editor):
+    """Stores the latest message of every existing thread."""
+    Thread = apps.get_model('django_messages_drf', 'Thread')
+    Message = apps.get_model('django_messages_drf', 'Message')
+
+    latest = Message.objects.filter(thread=OuterRef('pk')).order_by('-sent_at', '-pk')
+    Thread.objects.using(schema_editor.connection.alias).update(
+        last_message_at=Subquery(latest.values('sent_at')[:1]),
+        last_sent_message=Subquery(latest.values('pk')[:1]),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_messages_drf', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='thread',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='thread',
+            name='last_sent_message',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='django_messages_drf.message'),
+        ),
+        migrations.RunPython(backfill_last_message, migrations.RunPython.noop),
+    ]
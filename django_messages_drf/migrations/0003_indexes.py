@@ -0,0 +1,41 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:31
+
+from django.db import migrations, models
+import uuid
+
+from ._operations import AddIndexConcurrently, AddUniqueConcurrently
+
+
+class Migration(migrations.Migration):
+    # The indexes are built CONCURRENTLY on PostgreSQL, which can't run inside a transaction.
+    atomic = False
+
+    dependencies = [
+        ('django_messages_drf', '0002_thread_last_message'),
+    ]
+
+    operations = [
+        AddUniqueConcurrently(
+            model_name='message',
+            name='uuid',
+            field=models.UUIDField(default=uuid.uuid4, editable=False, unique=True),
+        ),
+        AddUniqueConcurrently(
+            model_name='thread',
+            name='uuid',
+            field=models.UUIDField(default=uuid.uuid4, editable=False, unique=True),
+        ),
+        AddUniqueConcurrently(
+            model_name='userthread',
+            name='uuid',
+            field=models.UUIDField(default=uuid.uuid4, editable=False, unique=True),
+        ),
+        AddIndexConcurrently(
+            model_name='message',
+            index=models.Index(fields=['thread', 'sent_at'], name='dmdrf_message_thread_sent_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='userthread',
+            index=models.Index(fields=['user', 'deleted', 'unread', 'thread'], name='dmdrf_userthread_inbox_idx'),
+        ),
+    ]
@@ -0,0 +1,101 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:32
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+import django.utils.timezone
+
+from ._operations import AlterModelBases
+
+
+def copy_audit_fields(apps, schema_editor):
+    """Copies the audit fields from the parent table into the thread table."""
+    Thread = apps.get_model('django_messages_drf', 'Thread')
+    AuditModel = apps.get_model('django_messages_drf', 'AuditModel')
+
+    audit = AuditModel.objects.filter(pk=OuterRef('pk'))
+    Thread.objects.using(schema_editor.connection.alias).update(
+        created_at=Subquery(audit.values('created_at')[:1]),
+        modified_at=Subquery(audit.values('modified_at')[:1]),
+    )
+
+
+def restore_audit_model(apps, schema_editor):
+    """Recreates the parent rows from the audit fields of the threads."""
+    Thread = apps.get_model('django_messages_drf', 'Thread')
+    AuditModel = apps.get_model('django_messages_drf', 'AuditModel')
+    alias = schema_editor.connection.alias
+
+    threads = Thread.objects.using(alias).values_list('pk', flat=True).iterator()
+    AuditModel.objects.using(alias).bulk_create((AuditModel(pk=pk) for pk in threads), batch_size=1000)
+
+    # The dates are set afterwards as `auto_now_add` and `auto_now` override them on creation.
+    thread = Thread.objects.filter(pk=OuterRef('pk'))
+    AuditModel.objects.using(alias).update(
+        created_at=Subquery(thread.values('created_at')[:1]),
+        modified_at=Subquery(thread.values('modified_at')[:1]),
+    )
+
+
+def reset_thread_sequence(apps, schema_editor):
+    """
+    On PostgreSQL the identity added to `id` starts from 1, it continues from the existing threads.
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        "SELECT setval(pg_get_serial_sequence('django_messages_drf_thread', 'id'), COALESCE(MAX(id), 1)) "
+        "FROM django_messages_drf_thread"
+    )
+
+
+class Migration(migrations.Migration):
+    """
+    `Thread` was a multi-table child of the concrete `AuditModel`. The audit fields now live on
+    the thread table and the parent link becomes the primary key `id`, keeping its values so the
+    foreign keys pointing to the threads remain valid.
+    """
+
+    dependencies = [
+        ('django_messages_drf', '0003_indexes'),
+    ]
+
+    operations = [
+        AlterModelBases('Thread', (models.Model,)),
+        migrations.AlterField(
+            model_name='thread',
+            name='auditmodel_ptr',
+            field=models.IntegerField(primary_key=True, serialize=False, db_column='auditmodel_ptr_id'),
+        ),
+        migrations.AddField(
+            model_name='thread',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='thread',
+            name='modified_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.RunPython(copy_audit_fields, restore_audit_model),
+        migrations.RenameField(
+            model_name='thread',
+            old_name='auditmodel_ptr',
+            new_name='id',
+        ),
+        # The column is renamed in place, the foreign keys pointing to it follow the rename.
+        migrations.AlterField(
+            model_name='thread',
+            name='id',
+            field=models.IntegerField(primary_key=True, serialize=False),
+        ),
+        migrations.AlterField(
+            model_name='thread',
+            name='id',
+            field=models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID'),
+        ),
+        migrations.RunPython(reset_thread_sequence, migrations.RunPython.noop),
+        migrations.DeleteModel(
+            name='AuditModel',
+        ),
+    ]
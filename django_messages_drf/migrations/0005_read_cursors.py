@@ -0,0 +1,109 @@
+# Generated by Django 4.2.30 on 2026-10-18 14:05
+
+from django.db import migrations, models
+from django.db.models import Exists, Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Greatest, Least
+
+BATCH_SIZE = 1000
+
+
+def number_messages(apps, schema_editor):
+    """
+    Numbers the messages of every thread by the order they were sent and moves the read cursors:
+    a read thread is read up to the latest message and an unread one up to the latest message of
+    the user, which is the last time the thread was marked as read.
+
+    The messages are numbered walking the threads by batches of `BATCH_SIZE`, reading the ids of
+    their messages in order and writing the numbers with `bulk_update`.
+    """
+    Thread = apps.get_model('django_messages_drf', 'Thread')
+    UserThread = apps.get_model('django_messages_drf', 'UserThread')
+    Message = apps.get_model('django_messages_drf', 'Message')
+    alias = schema_editor.connection.alias
+
+    last = 0
+    while True:
+        thread_ids = list(
+            Thread.objects.using(alias).filter(pk__gt=last).order_by('pk').values_list('pk', flat=True)[:BATCH_SIZE]
+        )
+        if not thread_ids:
+            break
+        last = thread_ids[-1]
+
+        rows = Message.objects.using(alias).filter(thread_id__in=thread_ids).order_by(
+            'thread_id', 'sent_at', 'pk'
+        ).values_list('pk', 'thread_id')
+        messages, latest = [], {}
+        for pk, thread_id in rows.iterator(chunk_size=BATCH_SIZE):
+            latest[thread_id] = latest.get(thread_id, 0) + 1
+            messages.append(Message(pk=pk, seq=latest[thread_id]))
+        Message.objects.using(alias).bulk_update(messages, ['seq'], batch_size=BATCH_SIZE)
+        threads = [Thread(pk=pk, seq=seq) for pk, seq in latest.items()]
+        Thread.objects.using(alias).bulk_update(threads, ['seq'], batch_size=BATCH_SIZE)
+
+    thread_seq = Subquery(Thread.objects.filter(pk=OuterRef('thread')).values('seq')[:1])
+    UserThread.objects.using(alias).filter(unread=False).update(last_read_seq=thread_seq)
+
+    own = Message.objects.filter(thread=OuterRef('thread'), sender=OuterRef('user')).order_by().values(
+        'thread'
+    ).annotate(latest=Max('seq')).values('latest')
+    UserThread.objects.using(alias).filter(unread=True).update(
+        last_read_seq=Least(
+            Coalesce(Subquery(own), 0),
+            Greatest(thread_seq - 1, 0),
+            output_field=models.PositiveIntegerField(),
+        )
+    )
+
+
+def restore_unread(apps, schema_editor):
+    """A thread is unread when the user hasn't read up to its latest message."""
+    Thread = apps.get_model('django_messages_drf', 'Thread')
+    UserThread = apps.get_model('django_messages_drf', 'UserThread')
+
+    behind = Thread.objects.filter(pk=OuterRef('thread'), seq__gt=OuterRef('last_read_seq'))
+    UserThread.objects.using(schema_editor.connection.alias).update(unread=Exists(behind))
+
+
+class Migration(migrations.Migration):
+    """
+    Replaces the unread flag of the participants by a read cursor over the numbered messages of
+    the thread. The new indexes are built by 0006.
+    """
+
+    dependencies = [
+        ('django_messages_drf', '0004_thread_audit_fields'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='thread',
+            name='seq',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='seq',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='userthread',
+            name='last_read_seq',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(number_messages, restore_unread),
+        migrations.RemoveIndex(
+            model_name='userthread',
+            name='dmdrf_userthread_inbox_idx',
+        ),
+        # A default allows the column to be added back when reversing.
+        migrations.AlterField(
+            model_name='userthread',
+            name='unread',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RemoveField(
+            model_name='userthread',
+            name='unread',
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.30 on 2026-10-18 14:06
+
+from django.db import migrations, models
+
+from ._operations import AddIndexConcurrently
+
+
+class Migration(migrations.Migration):
+    # The indexes are built CONCURRENTLY on PostgreSQL, which can't run inside a transaction.
+    atomic = False
+
+    dependencies = [
+        ('django_messages_drf', '0005_read_cursors'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='userthread',
+            index=models.Index(fields=['user', 'deleted', 'thread'], name='dmdrf_userthread_inbox_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='message',
+            index=models.Index(fields=['thread', 'seq'], name='dmdrf_message_thread_seq_idx'),
+        ),
+    ]
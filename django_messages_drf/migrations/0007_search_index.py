@@ -0,0 +1,53 @@
+from django.db import migrations, OperationalError
+
+SQLITE_TABLES = (
+    ('django_messages_drf_message_fts', 'content'),
+    ('django_messages_drf_thread_fts', 'subject'),
+)
+
+POSTGRES_TABLES = (
+    ('django_messages_drf_message_search', 'message_id', 'django_messages_drf_message'),
+    ('django_messages_drf_thread_search', 'thread_id', 'django_messages_drf_thread'),
+)
+
+
+def create_search_tables(apps, schema_editor):
+    """
+    Creates the tables of the search backend of the database. Without FTS5 on SQLite, or on any
+    other database, the search falls back to `SimpleSearchBackend`.
+    """
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        for table, column in SQLITE_TABLES:
+            try:
+                schema_editor.execute(
+                    f"CREATE VIRTUAL TABLE {table} USING fts5({column}, tokenize = 'unicode61 remove_diacritics 2')"
+                )
+            except OperationalError:
+                return
+    elif vendor == 'postgresql':
+        for table, key, target in POSTGRES_TABLES:
+            schema_editor.execute(
+                f"CREATE TABLE {table} ("
+                f"{key} integer PRIMARY KEY REFERENCES {target} (id) ON DELETE CASCADE, "
+                f"document tsvector NOT NULL)"
+            )
+            schema_editor.execute(f"CREATE INDEX {table}_gin ON {table} USING GIN (document)")
+
+
+def drop_search_tables(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    tables = {'sqlite': SQLITE_TABLES, 'postgresql': POSTGRES_TABLES}.get(vendor, ())
+    for table, *_ in tables:
+        schema_editor.execute(f"DROP TABLE IF EXISTS {table}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_messages_drf', '0006_read_cursor_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_tables, drop_search_tables),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:09
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('django_messages_drf', '0007_search_index'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='message',
+            options={},
+        ),
+        migrations.CreateModel(
+            name='ArchivedMessage',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('uuid', models.UUIDField(default=uuid.uuid4, editable=False, unique=True)),
+                ('sent_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('content', models.TextField()),
+                ('seq', models.PositiveIntegerField(default=0, editable=False)),
+                ('sender', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_messages', to=settings.AUTH_USER_MODEL)),
+                ('thread', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_messages', to='django_messages_drf.thread')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['thread', 'sent_at'], name='dmdrf_archived_thread_sent_idx')],
+            },
+        ),
+    ]
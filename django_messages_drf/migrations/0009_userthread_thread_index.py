@@ -0,0 +1,19 @@
+from django.db import migrations, models
+
+from ._operations import AddIndexConcurrently
+
+
+class Migration(migrations.Migration):
+    # The index is built CONCURRENTLY on PostgreSQL, which can't run inside a transaction.
+    atomic = False
+
+    dependencies = [
+        ('django_messages_drf', '0008_archived_messages'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='userthread',
+            index=models.Index(fields=['thread', 'deleted'], name='dmdrf_userthread_thread_idx'),
+        ),
+    ]
@@ -0,0 +1,108 @@
+"""
+Migration operations that avoid locking the tables on PostgreSQL by building the indexes
+CONCURRENTLY. On any other database they behave as the operations they extend.
+
+The migrations using them must declare `atomic = False`.
+"""
+from django.db import NotSupportedError
+from django.db.migrations import AddIndex, AlterField
+from django.db.migrations.operations.base import Operation
+
+
+class ConcurrentlyMixin:
+
+    def is_concurrent(self, schema_editor):
+        if schema_editor.connection.vendor != 'postgresql':
+            return False
+        if schema_editor.connection.in_atomic_block:
+            raise NotSupportedError(
+                "The %s operation cannot be executed inside a transaction "
+                "(set atomic = False on the migration)." % self.__class__.__name__
+            )
+        return True
+
+
+class AddIndexConcurrently(ConcurrentlyMixin, AddIndex):
+    """Creates an index with CREATE INDEX CONCURRENTLY on PostgreSQL"""
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if not self.is_concurrent(schema_editor):
+            return super().database_forwards(app_label, schema_editor, from_state, to_state)
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            schema_editor.add_index(model, self.index, concurrently=True)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if not self.is_concurrent(schema_editor):
+            return super().database_backwards(app_label, schema_editor, from_state, to_state)
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            schema_editor.remove_index(model, self.index, concurrently=True)
+
+
+class AddUniqueConcurrently(ConcurrentlyMixin, AlterField):
+    """
+    Alters a field to be unique. On PostgreSQL the unique index is built CONCURRENTLY and then
+    attached to the table as the unique constraint, which only takes a brief lock.
+    """
+
+    def get_constraint_name(self, schema_editor, model):
+        field = model._meta.get_field(self.name)
+        return schema_editor._create_index_name(model._meta.db_table, [field.column], suffix='_uniq')
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if not self.is_concurrent(schema_editor):
+            return super().database_forwards(app_label, schema_editor, from_state, to_state)
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, model):
+            return
+
+        quote = schema_editor.quote_name
+        table = quote(model._meta.db_table)
+        column = quote(model._meta.get_field(self.name).column)
+        name = quote(self.get_constraint_name(schema_editor, model))
+
+        # An interrupted build leaves an INVALID index behind, drop it before retrying.
+        schema_editor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+        schema_editor.execute(f"CREATE UNIQUE INDEX CONCURRENTLY {name} ON {table} ({column})")
+        schema_editor.execute(f"ALTER TABLE {table} ADD CONSTRAINT {name} UNIQUE USING INDEX {name}")
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if not self.is_concurrent(schema_editor):
+            return super().database_backwards(app_label, schema_editor, from_state, to_state)
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            quote = schema_editor.quote_name
+            schema_editor.execute("ALTER TABLE %s DROP CONSTRAINT %s" % (
+                quote(model._meta.db_table), quote(self.get_constraint_name(schema_editor, model))
+            ))
+
+
+class AlterModelBases(Operation):
+    """
+    Changes the bases of a model in the migration state. There is no change in the database,
+    it is used to detach a model from a multi-table inheritance parent before its parent link is
+    altered.
+    """
+    reduces_to_sql = True
+    reversible = True
+
+    def __init__(self, name, bases):
+        self.name = name
+        self.bases = bases
+
+    def deconstruct(self):
+        return (self.__class__.__qualname__, [self.name, self.bases], {})
+
+    def state_forwards(self, app_label, state):
+        state.models[app_label, self.name.lower()].bases = self.bases
+        state.reload_model(app_label, self.name.lower(), delay=True)
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        pass
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        pass
+
+    def describe(self):
+        return "Alter the bases of %s" % self.name
@@ -1,14 +1,83 @@
+import hashlib
+from contextlib import nullcontext
+
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.decorators import classonlymethod
+from django.utils.http import quote_etag
 
+from asgiref.sync import (
+    iscoroutinefunction,
+    markcoroutinefunction,
+    sync_to_async,
+)
+from rest_framework import status
 from rest_framework.generics import GenericAPIView
+from rest_framework.response import Response
 
+from . import cache, instrumentation
 from .models import Thread
+from .requirements import (
+    QueryRequirements,
+    get_query_requirements,
+    warn_lazy_loads,
+)
 
 
 class RequireUserContextView(GenericAPIView):
     """
-    Handles with Generics of views
+    Handles with Generics of views.
+
+    With `DJANGO_MESSAGES_DRF_INSTRUMENTATION` the queries and the time of the view, of
+    `paginate_queryset` and of `serialize` are recorded in `self.metrics` and returned in the
+    `Server-Timing` header.
+
+    The querysets rendered get the query requirements declared by the serializer of the view
+    with `apply_query_requirements`. With `DEBUG` the queries run by `serialize` are logged.
     """
+    metrics = None
+
+    def dispatch(self, request, *args, **kwargs):
+        if not instrumentation.is_enabled():
+            return super().dispatch(request, *args, **kwargs)
+
+        with instrumentation.instrument(self, request) as self.metrics:
+            response = super().dispatch(request, *args, **kwargs)
+            self.metrics.status = response.status_code
+        response['Server-Timing'] = self.metrics.server_timing()
+        return response
+
+    def measure(self, name):
+        """Times the block as the phase `name` of the request when instrumented"""
+        if self.metrics is None:
+            return nullcontext()
+        return self.metrics.measure(name)
+
+    def paginate_queryset(self, queryset):
+        with self.measure('paginate'):
+            return super().paginate_queryset(queryset)
+
+    def serialize(self, serializer):
+        """Returns the data of the serializer"""
+        with self.measure('serialize'), self.check_lazy_loads(serializer):
+            return serializer.data
+
+    def check_lazy_loads(self, serializer):
+        """Logs the queries run by the serializer in the block with `DEBUG`"""
+        if not settings.DEBUG:
+            return nullcontext()
+        return warn_lazy_loads(self, serializer)
+
+    def get_query_requirements(self, name=None):
+        """The query requirements of the serializer of the view, or the ones of `related[name]`"""
+        requirements = get_query_requirements(self.get_serializer_class())
+        if name is None:
+            return requirements
+        return requirements.related.get(name, QueryRequirements())
+
+    def apply_query_requirements(self, queryset, name=None):
+        return self.get_query_requirements(name).apply(queryset, self.get_serializer_context())
 
     def get_serializer(self, *args, **kwargs):
         """
@@ -28,6 +97,194 @@ class RequireUserContextView(GenericAPIView):
         return context
 
 
+class ResponseCacheMixin:
+    """
+    Caches the data of the successful responses with `DJANGO_MESSAGES_DRF_RESPONSE_CACHE`, under
+    the versions of the given user and thread (see `django_messages_drf.cache`).
+    """
+
+    def cached_response(self, name, build, **versioned):
+        """Returns the cached response `name` or the one of `build`, caching it"""
+        if not cache.is_enabled():
+            return build()
+
+        key, response = self.get_cached_response(name, **versioned)
+        if response is not None:
+            return response
+        return self.set_cached_response(key, build())
+
+    async def acached_response(self, name, build, **versioned):
+        """Async version of `cached_response`, `build` is a coroutine function"""
+        if not cache.is_enabled():
+            return await build()
+
+        key, response = await sync_to_async(self.get_cached_response)(name, **versioned)
+        if response is not None:
+            return response
+        return await sync_to_async(self.set_cached_response)(key, await build())
+
+    def get_cached_response(self, name, **versioned):
+        """The key of the response `name` and the cached response, or None"""
+        response_cache = cache.get_response_cache()
+        with self.measure('cache'):
+            key = response_cache.get_key(name, self.request, **versioned)
+            data = response_cache.get(key)
+        if data is None:
+            return key, None
+        return key, Response(data, status=status.HTTP_200_OK)
+
+    def set_cached_response(self, key, response):
+        if response.status_code == status.HTTP_200_OK:
+            cache.get_response_cache().set(key, response.data)
+        return response
+
+
+class ConditionalGetMixin:
+    """
+    Answers the conditional requests, `If-None-Match`, with a 304 before building the response
+    when `DJANGO_MESSAGES_DRF_CONDITIONAL_GET` is enabled.
+
+    `get_validators` returns what the response depends on, or None, computed with a single query.
+    The ETag is the hash of the validators with the user, the query string and the format of the
+    response. There is no `Last-Modified`: a date has a precision of a second, a message sent in
+    the same second as the response would be answered with a 304.
+    """
+
+    def get_validators(self):
+        return None
+
+    def get_etag(self, validators):
+        request = self.request
+        parts = (
+            self.__class__.__name__, request.user.pk, request.META.get('QUERY_STRING', ''),
+            request.accepted_renderer.format, validators,
+        )
+        return quote_etag(hashlib.md5(repr(parts).encode()).hexdigest())
+
+    def conditional_response(self, build):
+        """Returns a 304 when the client has the current response, otherwise the one of `build`"""
+        if not getattr(settings, 'DJANGO_MESSAGES_DRF_CONDITIONAL_GET', False):
+            return build()
+
+        conditional = self.check_conditions()
+        if conditional is None:
+            return build()
+
+        etag, response = conditional
+        if response is None:
+            response = build()
+        return self.set_validators(response, etag)
+
+    async def aconditional_response(self, build):
+        """Async version of `conditional_response`, `build` is a coroutine function"""
+        if not getattr(settings, 'DJANGO_MESSAGES_DRF_CONDITIONAL_GET', False):
+            return await build()
+
+        conditional = await sync_to_async(self.check_conditions)()
+        if conditional is None:
+            return await build()
+
+        etag, response = conditional
+        if response is None:
+            response = await build()
+        return self.set_validators(response, etag)
+
+    def check_conditions(self):
+        """The ETag of the response with the 304 when the client has it, None without validators"""
+        validators = self.get_validators()
+        if validators is None:
+            return None
+
+        etag = self.get_etag(validators)
+        return etag, get_conditional_response(self.request, etag=etag)
+
+    def set_validators(self, response, etag):
+        """Sets the ETag on the successful and the not modified responses"""
+        if response.status_code not in (status.HTTP_200_OK, status.HTTP_304_NOT_MODIFIED):
+            return response
+
+        response['ETag'] = etag
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+
+class AsyncViewMixin:
+    """
+    Runs the DRF dispatch as a coroutine so the handlers can be declared with `async def` and
+    await the async ORM instead of holding a thread of the sync-to-async pool while waiting on
+    the database.
+
+    The authentication, permissions and throttles may hit the database (sessions, users) and
+    run in a thread before the handler. Serializers may load relations lazily, therefore the
+    data is rendered in a thread as well with `adata`.
+
+    Meant for the views built on `RequireUserContextView` and for `MessageStreamApiView`,
+    instrumented as the sync ones.
+    """
+
+    @classonlymethod
+    def as_view(cls, **initkwargs):
+        view = super().as_view(**initkwargs)
+        # The csrf_exempt wrapper of DRF is a plain function in Django < 5.0
+        return markcoroutinefunction(view)
+
+    async def dispatch(self, request, *args, **kwargs):
+        if not instrumentation.is_enabled():
+            return await self.adispatch(request, *args, **kwargs)
+
+        async with instrumentation.ainstrument(self, request) as self.metrics:
+            response = await self.adispatch(request, *args, **kwargs)
+            self.metrics.status = response.status_code
+        response['Server-Timing'] = self.metrics.server_timing()
+        return response
+
+    async def adispatch(self, request, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        request = self.initialize_request(request, *args, **kwargs)
+        self.request = request
+        self.headers = self.default_response_headers
+
+        try:
+            await sync_to_async(self.initial)(request, *args, **kwargs)
+
+            if request.method.lower() in self.http_method_names:
+                handler = getattr(self, request.method.lower(), self.http_method_not_allowed)
+            else:
+                handler = self.http_method_not_allowed
+
+            if iscoroutinefunction(handler):
+                response = await handler(request, *args, **kwargs)
+            else:
+                response = await sync_to_async(handler)(request, *args, **kwargs)
+
+        except Exception as exc:
+            response = self.handle_exception(exc)
+
+        self.response = self.finalize_response(request, response, *args, **kwargs)
+        return self.response
+
+    async def apaginate_queryset(self, queryset):
+        """
+        Returns a page of results or None if the pagination is disabled. Uses the
+        `apaginate_queryset` of the paginator when available, otherwise runs it in a thread.
+        """
+        if self.paginator is None:
+            return None
+        with self.measure('paginate'):
+            if hasattr(self.paginator, 'apaginate_queryset'):
+                return await self.paginator.apaginate_queryset(queryset, self.request, view=self)
+            return await sync_to_async(self.paginator.paginate_queryset)(queryset, self.request, view=self)
+
+    async def adata(self, serializer):
+        """Returns the data of a serializer with `serialize`"""
+        return await sync_to_async(self.serialize)(serializer)
+
+    async def ais_valid(self, serializer):
+        """Validates a serializer raising the errors, the validators may query the database"""
+        return await sync_to_async(serializer.is_valid)(raise_exception=True)
+
+
 class ThreadMixin: # pragma: no cover
     """
     Everything related with a thread, is placed here.
@@ -53,6 +310,27 @@ class ThreadMixin: # pragma: no cover
         except Thread.DoesNotExist:
             return
 
+    async def aget_thread(self):
+        """Async version of `get_thread`"""
+        try:
+            return await Thread.objects.aget(uuid=self.kwargs.get('uuid'))
+        except Thread.DoesNotExist:
+            return
+
+    async def aget_user(self):
+        """Async version of `get_user`"""
+        try:
+            return await get_user_model().objects.aget(pk=self.kwargs.get('user_id'))
+        except get_user_model().DoesNotExist:
+            return
+
+    async def aget_thread_by_id(self):
+        """Async version of `get_thead_by_id`"""
+        try:
+            return await Thread.objects.aget(id=self.kwargs.get('thread_id'))
+        except Thread.DoesNotExist:
+            return
+
 
 class CurrentThreadDefault: # pragma: no cover
     requires_context = True
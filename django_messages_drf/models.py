@@ -2,15 +2,114 @@ import logging
 from uuid import uuid4
 
 from django.conf import settings
+from django.contrib.auth import get_user_model
 from django.db import OperationalError, models, transaction
+from django.db.models import F, Max, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce, Greatest, Substr
 from django.utils import timezone
 
-from .signals import message_sent
+from asgiref.sync import sync_to_async
+
+from .dispatch import send_message_sent
 from .utils import AuditModel
 
 log = logging.getLogger(__name__)
 
 
+class ThreadQuerySet(models.QuerySet):
+    """
+    Lazy querysets for the threads of a given user. Everything here is resolved by the
+    database which allows the pagination to fetch only the rows of the page.
+    """
+
+    def inbox_for(self, user):
+        """Threads in the inbox of a given user"""
+        return self.filter(userthread__user=user, userthread__deleted=False)
+
+    def deleted_for(self, user):
+        """Threads deleted by a given user"""
+        return self.filter(userthread__user=user, userthread__deleted=True)
+
+    def unread_for(self, user):
+        """Threads in the inbox of a given user with unread messages"""
+        return self.filter(
+            userthread__user=user, userthread__deleted=False, userthread__last_read_seq__lt=F("seq")
+        )
+
+    def with_latest_activity(self):
+        """
+        Annotates `latest_activity` and orders by it, newest first. The stored `last_message_at`
+        is used when available, falling back to the newest message and lastly to the creation
+        date of the thread.
+        """
+        queryset = self
+        if "latest_activity" not in queryset.query.annotations:
+            newest = Message.objects.filter(thread=OuterRef("pk")).order_by().values("thread").annotate(
+                newest=Max("sent_at")
+            ).values("newest")
+            queryset = queryset.annotate(latest_activity=Coalesce("last_message_at", Subquery(newest), "created_at"))
+        return queryset.order_by("-latest_activity", "-pk")
+
+    def with_inbox_data(self, user):
+        """
+        Annotates everything the inbox renders for a given user so a page is fetched in a
+        single query, see `inbox_annotations`.
+        """
+        return self.annotate(**self.inbox_annotations(user))
+
+    @staticmethod
+    def inbox_annotations(user):
+        """
+        The annotations of the inbox of a given user:
+
+        - `total_unread`: the number of messages the user hasn't read.
+        - `first_message_at`: when the first message was sent, archived or not.
+        - `last_message_snippet`: the first 50 characters of the latest message.
+        - `last_sender_id` and `last_sender_<field>`: the sender of the latest message, where the
+        fields are the ones from `LAST_SENDER_FIELDS` existing in the user model.
+        """
+        messages = Message.objects.filter(thread=OuterRef("pk"))
+        latest = messages.order_by("-sent_at", "-pk")
+        cursor = UserThread.objects.filter(thread=OuterRef("pk"), user=user).values("last_read_seq")[:1]
+
+        archived = ArchivedMessage.objects.filter(thread=OuterRef("pk"))
+
+        annotations = {
+            "total_unread": Coalesce(F("seq") - Subquery(cursor), 0, output_field=models.IntegerField()),
+            "first_message_at": Coalesce(
+                Subquery(archived.order_by("sent_at", "pk").values("sent_at")[:1]),
+                Subquery(messages.order_by("sent_at", "pk").values("sent_at")[:1]),
+            ),
+            "last_message_snippet": Subquery(
+                latest.annotate(snippet=Substr("content", 1, 50)).values("snippet")[:1]
+            ),
+            "last_sender_id": Subquery(latest.values("sender")[:1]),
+        }
+        for field_name in last_sender_fields():
+            annotations[f"last_sender_{field_name}"] = Subquery(latest.values(f"sender__{field_name}")[:1])
+        return annotations
+
+    def activity_for(self, user):
+        """
+        The `seq`, `last_message_at` and `modified_at` of the first thread of the queryset with the
+        `last_read_seq` of the user, in a single query, or None. Changes with the messages sent,
+        edited and read.
+        """
+        cursor = UserThread.objects.filter(thread=OuterRef("pk"), user=user).values("last_read_seq")[:1]
+        return self.annotate(last_read_seq=Subquery(cursor)).values(
+            "pk", "seq", "last_message_at", "modified_at", "last_read_seq"
+        ).first()
+
+
+LAST_SENDER_FIELDS = ("first_name", "last_name")
+
+
+def last_sender_fields():
+    """Returns the `LAST_SENDER_FIELDS` declared by the user model"""
+    user_fields = {field.name for field in get_user_model()._meta.concrete_fields}
+    return [field_name for field_name in LAST_SENDER_FIELDS if field_name in user_fields]
+
+
 class Thread(AuditModel):
     """Main model where a thread is created. This model only contains a subject
     and a ManyToMany relationship with the users.
@@ -20,49 +119,142 @@ class Thread(AuditModel):
 
     A `uuid` field is declared as a way to
     """
-    uuid = models.UUIDField(blank=False, null=False, editable=False, default=uuid4)
+    uuid = models.UUIDField(blank=False, null=False, editable=False, default=uuid4, unique=True)
     subject = models.CharField(max_length=150)
     users = models.ManyToManyField(settings.AUTH_USER_MODEL, through="UserThread")
 
+    # Denormalized latest activity, maintained by `Message.new_message` and `Message.new_reply`.
+    last_message_at = models.DateTimeField(null=True, blank=True, editable=False)
+    last_sent_message = models.ForeignKey(
+        "Message", null=True, blank=True, editable=False, related_name="+", on_delete=models.SET_NULL
+    )
+    # The `seq` of the latest message, the messages of a thread are numbered from 1.
+    seq = models.PositiveIntegerField(default=0, editable=False)
+
+    objects = ThreadQuerySet.as_manager()
+
     @classmethod
     def inbox(cls, user):
         """Returns the inbox of a given user"""
-        return cls.objects.filter(userthread__user=user, userthread__deleted=False)
+        return cls.objects.inbox_for(user).with_latest_activity()
+
+    @classmethod
+    async def ainbox(cls, user, limit, offset=0):
+        """
+        A page of `inbox`, the `limit` threads after `offset`, fetched with the async ORM. The
+        queryset of `inbox` is lazy and can also be iterated with `async for`.
+        """
+        return [thread async for thread in cls.inbox(user)[offset:offset + limit]]
 
     @classmethod
     def deleted(cls, user):
         """Returns the deleted messages of a given user"""
-        return cls.objects.filter(userthread__user=user, userthread__deleted=True)
+        return cls.objects.deleted_for(user).with_latest_activity()
 
     @classmethod
     def unread(cls, user):
         """Returns all the unread messages of a given user"""
-        return cls.objects.filter(
-            userthread__user=user,
-            userthread__deleted=False,
-            userthread__unread=True
-        )
+        return cls.objects.unread_for(user).with_latest_activity()
 
     @property
     def first_message(self):
-        """Returns the first message"""
-        return self.messages.all()[0]
+        """Returns the first message, from the archive when it was archived"""
+        return self.archived_messages.order_by("sent_at", "pk").first() or self.messages.order_by("sent_at", "pk")[0]
+
+    def get_first_message_at(self):
+        """Returns when the first message was sent, reading the annotated value when available"""
+        if hasattr(self, "first_message_at"):
+            return self.first_message_at
+        return self.first_message.sent_at
+
+    def get_last_sender(self):
+        """
+        Returns the sender of the latest message. When the latest message is loaded with the
+        thread its sender is returned. When the thread comes from `ThreadQuerySet.with_inbox_data`
+        the user is built from the annotations without querying, any other field is deferred.
+        """
+        if Thread.last_sent_message.is_cached(self) and self.last_sent_message is not None:
+            return self.last_sent_message.sender
+        if not hasattr(self, "last_sender_id"):
+            message = self.last_message()
+            return message.sender if message else None
+        if self.last_sender_id is None:
+            return
+        User = get_user_model()
+        values = {User._meta.pk.attname: self.last_sender_id}
+        values.update({
+            field_name: getattr(self, f"last_sender_{field_name}") for field_name in last_sender_fields()
+        })
+        field_names = [field.attname for field in User._meta.concrete_fields if field.attname in values]
+        return User.from_db(self._state.db, field_names, [values[name] for name in field_names])
 
     @property
     def latest_message(self):
         """Returs the last message"""
+        if self.last_sent_message_id:
+            return self.last_sent_message
         return self.messages.order_by("-sent_at")[0]
 
+    def get_latest_activity(self):
+        """
+        Returns the date of the latest message, reading the annotated `latest_activity` or the
+        stored value when available.
+        """
+        activity = getattr(self, "latest_activity", None) or self.last_message_at
+        if activity:
+            return activity
+        message = self.last_message()
+        return message.sent_at if message else self.created_at
+
     @classmethod
     def ordered(cls, objs):
         """
         Returns the iterable ordered the correct way, this is a class method
         because we don"t know what the type of the iterable will be.
+
+        Querysets are ordered by the database and remain lazy, any other iterable is sorted
+        in memory using the stored latest activity.
         """
+        if isinstance(objs, ThreadQuerySet):
+            return objs.with_latest_activity()
         objs = list(objs)
-        objs.sort(key=lambda o: o.latest_message.sent_at, reverse=True)
+        objs.sort(key=lambda o: o.get_latest_activity(), reverse=True)
         return objs
 
+    def touch(self):
+        """Updates `modified_at` without saving the thread, e.g. when one of its messages is edited"""
+        self.modified_at = timezone.now()
+        Thread.objects.filter(pk=self.pk).update(modified_at=self.modified_at)
+
+    def set_last_message(self, message):
+        """
+        Stores the given message as the latest activity of the thread. The update is conditional
+        so a message sent earlier than the stored one never overrides it.
+        """
+        updated = Thread.objects.filter(pk=self.pk).filter(
+            Q(last_message_at__isnull=True) | Q(last_message_at__lte=message.sent_at)
+        ).update(last_message_at=message.sent_at, last_sent_message=message)
+        if updated:
+            self.last_message_at = message.sent_at
+            self.last_sent_message = message
+
+    def next_seq(self):
+        """
+        Increments the message sequence of the thread and returns it. The row stays locked until
+        the end of the transaction so concurrent replies get consecutive numbers.
+        """
+        Thread.objects.filter(pk=self.pk).update(seq=F("seq") + 1)
+        self.seq = Thread.objects.filter(pk=self.pk).values_list("seq", flat=True).get()
+        return self.seq
+
+    def mark_read(self, user):
+        """Marks every message of the thread as read by the user, updating a single row"""
+        from .cache import invalidate_users
+
+        updated = self.userthread_set.filter(user=user).update(last_read_seq=UserThread.read_cursor())
+        invalidate_users([user.pk])
+        return updated
+
     @classmethod
     def get_thread_users(cls):
         """Returns all the users from the thread"""
@@ -76,15 +268,18 @@ class Thread(AuditModel):
         particulary useful for showing the earliest message sent in a thread between two different
         users
         """
-        try:
-            return self.messages.exclude(sender=user_to_exclude).earliest('sent_at')
-        except Message.DoesNotExist:
-            return
+        for queryset in (self.archived_messages, self.messages):
+            try:
+                return queryset.exclude(sender=user_to_exclude).earliest('sent_at', 'pk')
+            except queryset.model.DoesNotExist:
+                pass
 
     def last_message(self):
         """
         Returns the latest message of the thread. Is the reverse of the `earliest_message`
         """
+        if self.last_sent_message_id:
+            return self.last_sent_message
         try:
             return self.messages.all().latest('sent_at')
         except Message.DoesNotExist:
@@ -108,43 +303,137 @@ class Thread(AuditModel):
 
     def unread_messages(self, user):
         """
-        Gets the unread messages from User in a given Thread.
+        Gets the unread messages from User in a given Thread, the ones after the read cursor of
+        the user.
 
         Example:
             ```
             t = Thread.objects.first()
             user = User.objects.first()
-            unread = t.uread_messages(user)
+            unread = t.unread_messages(user).count()
             ```
         """
-        return self.userthread_set.filter(user=user, deleted=False, unread=True, thread=self)
+        cursor = self.userthread_set.filter(user=user, deleted=False).values("last_read_seq")[:1]
+        return self.messages.filter(seq__gt=Subquery(cursor))
+
+    def first_unread_message(self, user):
+        """
+        Returns the first message the user hasn't read. None when the thread is read.
+        """
+        return self.unread_messages(user).order_by("seq").first()
 
     def is_user_first_message(self, user):
         """
         Checks if the user started the thread
         :return: Bool
         """
-        try:
-            message = self.messages.earliest('sent_at')
-        except Message.DoesNotExist:
+        message = self.earliest_message()
+        if not message:
             return False
-        return bool(message.sender.pk == user.pk)
+        return bool(message.sender_id == user.pk)
 
     def __str__(self):
         return f"Subject: {self.subject}: {', '.join([str(user) for user in self.users.all()])}"
 
 
+class UserThreadQuerySet(models.QuerySet):
+    """
+    Applies state changes, such as read or deleted, to many threads of a user at once.
+    The changes are done in chunks of `Message.bulk_batch_size` with a single UPDATE per chunk.
+    """
+
+    def update(self, **values):
+        """Updates the rows, setting their `modified_at` unless given"""
+        values.setdefault("modified_at", timezone.now())
+        return super().update(**values)
+
+    def update_by_threads(self, thread_uuids, batch_size=None, **values):
+        """
+        Updates the rows of the given thread uuids, returning the number of rows affected.
+
+        Example:
+            ```
+            UserThread.objects.filter(user=user).update_by_threads(uuids, deleted=True)
+            ```
+        """
+        batch_size = batch_size or Message.bulk_batch_size()
+        thread_uuids = list(thread_uuids)
+        updated = 0
+        for start in range(0, len(thread_uuids), batch_size):
+            threads = Thread.objects.filter(uuid__in=thread_uuids[start:start + batch_size]).values("pk")
+            updated += self.filter(thread_id__in=threads).update(**values)
+        return updated
+
+    def update_in_batches(self, batch_size=None, **values):
+        """
+        Updates every row of the queryset walking it by primary key, returning the number of rows
+        affected. Each chunk selects the primary keys and updates them.
+        """
+        batch_size = batch_size or Message.bulk_batch_size()
+        queryset = self.order_by("pk")
+        last_pk = None
+        updated = 0
+        while True:
+            chunk = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+            pks = list(chunk.values_list("pk", flat=True)[:batch_size])
+            if not pks:
+                return updated
+            updated += UserThread.objects.filter(pk__in=pks).update(**values)
+            last_pk = pks[-1]
+
+
 class UserThread(models.Model):
     """Maps the user and the thread. This model was used to override the default ManyToMany
     relationship table generated by django.
     """
-    uuid = models.UUIDField(blank=False, null=False, default=uuid4, editable=False,)
+    uuid = models.UUIDField(blank=False, null=False, default=uuid4, editable=False, unique=True)
 
     thread = models.ForeignKey(Thread, on_delete=models.CASCADE)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
 
-    unread = models.BooleanField()
+    # The `seq` of the latest message read by the user.
+    last_read_seq = models.PositiveIntegerField(default=0)
     deleted = models.BooleanField()
+    # Set by every save and queryset update, the inbox validators depend on it.
+    modified_at = models.DateTimeField(auto_now=True)
+
+    objects = UserThreadQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user", "deleted", "thread"], name="dmdrf_userthread_inbox_idx"),
+            models.Index(fields=["thread", "deleted"], name="dmdrf_userthread_thread_idx"),
+        ]
+
+    @property
+    def unread_count(self):
+        """The number of messages of the thread the user hasn't read"""
+        return max(self.thread.seq - self.last_read_seq, 0)
+
+    @property
+    def unread(self):
+        return self.unread_count > 0
+
+    @classmethod
+    def read_cursor(cls):
+        """
+        The `seq` of the thread of the row, to be used on updates marking the thread as read.
+
+        Example:
+            ```
+            UserThread.objects.filter(user=user).update(last_read_seq=UserThread.read_cursor())
+            ```
+        """
+        return Subquery(Thread.objects.filter(pk=OuterRef("thread_id")).values("seq")[:1])
+
+    @classmethod
+    def unread_cursor(cls):
+        """The cursor before the latest message, to be used on updates marking it as unread"""
+        return Subquery(
+            Thread.objects.filter(pk=OuterRef("thread_id")).values(
+                cursor=Greatest(F("seq") - 1, 0, output_field=models.PositiveIntegerField())
+            )[:1]
+        )
 
     def __str__(self):
         return f"Thread: {self.thread}, User: {self.user}"
@@ -154,59 +443,118 @@ class Message(models.Model):
     """
     Message model where creates threads, user threads and mapping between them.
     """
-    uuid = models.UUIDField(blank=False, null=False, default=uuid4, editable=False)
+    uuid = models.UUIDField(blank=False, null=False, default=uuid4, editable=False, unique=True)
     thread = models.ForeignKey(Thread, related_name="messages", on_delete=models.CASCADE)
     sender = models.ForeignKey(settings.AUTH_USER_MODEL, related_name="sent_messages", on_delete=models.CASCADE)
     sent_at = models.DateTimeField(default=timezone.now)
     content = models.TextField()
+    # Position of the message in the thread, from 1.
+    seq = models.PositiveIntegerField(default=0, editable=False)
 
     @classmethod
     def default_new_message_deleted(cls):
         return getattr(settings, 'DJANGO_MESSAGES_MARK_NEW_THREAD_MESSAGE_AS_DELETED', True)
 
+    @classmethod
+    def bulk_batch_size(cls):
+        return getattr(settings, 'DJANGO_MESSAGES_DRF_BULK_BATCH_SIZE', 500)
+
     @classmethod
     def new_reply(cls, thread, user, content):
         """
-        Create a new reply for an existing Thread. Mark thread as unread for all other participants,
-        and mark thread as read by replier. We want an atomic operation as we can't afford having
-        lost data between tables and causing problems with data integrity.
+        Create a new reply for an existing Thread. The message gets the next `seq` of the thread,
+        which makes it unread for the other participants, and the read cursor of the replier is
+        moved to it. Only the participant rows that were deleted are written besides the one of
+        the replier. We want an atomic operation as we can't afford having lost data between
+        tables and causing problems with data integrity.
         """
         with transaction.atomic():
             try:
-                msg = cls.objects.create(thread=thread, sender=user, content=content)
-                thread.userthread_set.exclude(user=user).update(deleted=False, unread=True)
-                thread.userthread_set.filter(user=user).update(deleted=False, unread=False)
-                message_sent.send(sender=cls, message=msg, thread=thread, reply=True)
+                seq = thread.next_seq()
+                msg = cls.objects.create(thread=thread, sender=user, content=content, seq=seq)
+                thread.userthread_set.exclude(user=user).filter(deleted=True).update(deleted=False)
+                thread.userthread_set.filter(user=user).update(deleted=False, last_read_seq=seq)
+                thread.set_last_message(msg)
+                send_message_sent(sender=cls, message=msg, thread=thread, reply=True)
             except OperationalError as e:
                 log.exception(e)
                 return
         return msg
 
+    @classmethod
+    async def anew_reply(cls, thread, user, content):
+        """
+        Async version of `new_reply`. The async ORM doesn't support transactions yet, so the
+        atomic block runs in a thread.
+        """
+        return await sync_to_async(cls.new_reply)(thread, user, content)
+
     @classmethod
     def new_message(cls, from_user, to_users, subject, content):
         """
         Create a new Message and Thread. Mark thread as unread for all recipients, and
         mark thread as read and deleted from inbox by creator. We want an atomic operation as we
         also can't afford having lost data between tables and causing problems with data integrity.
+
+        The participants are inserted with `bulk_create` in batches of `bulk_batch_size`.
         """
         with transaction.atomic():
             try:
-                thread = Thread.objects.create(subject=subject)
-                for user in to_users:
-                    thread.userthread_set.create(user=user, deleted=False, unread=True)
-                thread.userthread_set.create(user=from_user, deleted=cls.default_new_message_deleted(), unread=False)
-                msg = cls.objects.create(thread=thread, sender=from_user, content=content)
-                message_sent.send(sender=cls, message=msg, thread=thread, reply=False)
+                thread = Thread.objects.create(subject=subject, seq=1)
+                user_threads = [UserThread(thread=thread, user=user, deleted=False, last_read_seq=0) for user in to_users]
+                user_threads.append(
+                    UserThread(thread=thread, user=from_user, deleted=cls.default_new_message_deleted(), last_read_seq=1)
+                )
+                UserThread.objects.bulk_create(user_threads, batch_size=cls.bulk_batch_size())
+                msg = cls.objects.create(thread=thread, sender=from_user, content=content, seq=1)
+                thread.set_last_message(msg)
+                send_message_sent(sender=cls, message=msg, thread=thread, reply=False)
             except OperationalError as e:
                 log.exception(e)
                 return
         return msg
 
+    @classmethod
+    async def anew_message(cls, from_user, to_users, subject, content):
+        """
+        Async version of `new_message`. The async ORM doesn't support transactions yet, so the
+        atomic block runs in a thread.
+        """
+        return await sync_to_async(cls.new_message)(from_user, to_users, subject, content)
+
     class Meta:
-        ordering = ("sent_at",)
+        indexes = [
+            models.Index(fields=["thread", "sent_at"], name="dmdrf_message_thread_sent_idx"),
+            models.Index(fields=["thread", "seq"], name="dmdrf_message_thread_seq_idx"),
+        ]
 
     def get_absolute_url(self):
         return self.thread.get_absolute_url()
 
     def __str__(self):
         return f"{self.uuid}"
+
+
+class ArchivedMessage(models.Model):
+    """
+    A message moved out of `Message` by `maintenance.archive_messages`. The rows have the same
+    shape and keep the id of the message, therefore the archived and the hot messages of a thread
+    are ordered together by (`sent_at`, id).
+    """
+    id = models.IntegerField(primary_key=True)
+    uuid = models.UUIDField(blank=False, null=False, default=uuid4, editable=False, unique=True)
+    thread = models.ForeignKey(Thread, related_name="archived_messages", on_delete=models.CASCADE)
+    sender = models.ForeignKey(
+        settings.AUTH_USER_MODEL, related_name="archived_messages", on_delete=models.CASCADE
+    )
+    sent_at = models.DateTimeField(default=timezone.now)
+    content = models.TextField()
+    seq = models.PositiveIntegerField(default=0, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["thread", "sent_at"], name="dmdrf_archived_thread_sent_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.uuid}"
@@ -18,8 +18,32 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import hashlib
+import json
+import logging
+import math
+import time
+from base64 import b64decode, b64encode
+from uuid import UUID
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.paginator import InvalidPage
+from django.db import connections
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from django.utils.translation import gettext_lazy as _
+
+from asgiref.sync import sync_to_async
 from rest_framework import pagination
+from rest_framework.exceptions import NotFound
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from .dispatch import ThreadPoolBackend
+
+log = logging.getLogger(__name__)
 
 
 class Pagination(pagination.PageNumberPagination):
@@ -37,8 +61,8 @@ class Pagination(pagination.PageNumberPagination):
     })
     """
 
-    def get_paginated_response(self, data):
-        return Response({
+    def get_paginated_data(self, data):
+        return {
             'links': {
                 'next': self.get_next_link(),
                 'previous': self.get_previous_link()
@@ -49,12 +73,542 @@ class Pagination(pagination.PageNumberPagination):
                 'next_page': self.page.number + 1 if self.page.has_next() else None,
                 'page_size': self.page_size
             },
-            'count': self.page.paginator.count,
-            'total_pages': self.page.paginator.num_pages,
+            'count': self.get_count(),
+            'total_pages': self.get_total_pages(),
             'next': self.page.has_next(),
             'previous': self.page.has_previous(),
             'results': data
-        })
+        }
+
+    def get_count(self):
+        return self.page.paginator.count
+
+    def get_total_pages(self):
+        return self.page.paginator.num_pages
+
+    def get_paginated_response(self, data):
+        return Response(self.get_paginated_data(data))
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        """
+        Async version of `paginate_queryset`. The count and the rows of the page are fetched
+        with the async ORM.
+        """
+        self.request = request
+        page_size = self.get_page_size(request)
+        if not page_size:
+            return None
+
+        paginator = self.django_paginator_class(queryset, page_size)
+        paginator.count = await queryset.acount()
+        page_number = self.get_page_number(request, paginator)
+
+        try:
+            self.page = paginator.page(page_number)
+        except InvalidPage as exc:
+            msg = self.invalid_page_message.format(page_number=page_number, message=str(exc))
+            raise NotFound(msg)
+
+        self.page.object_list = [obj async for obj in self.page.object_list]
+        if paginator.num_pages > 1 and self.template is not None:
+            self.display_page_controls = True
+
+        return self.page.object_list
+
+
+class NoCountPage:
+    """A page of `NoCountPagination`, knowing if there is a next page without the count"""
+
+    def __init__(self, object_list, number, has_next):
+        self.object_list = object_list
+        self.number = number
+        self._has_next = has_next
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self.number > 1
+
+    def next_page_number(self):
+        return self.number + 1
+
+    def previous_page_number(self):
+        return self.number - 1
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+class NoCountPagination(Pagination):
+    """
+    Page number paginator without COUNT(*). The page fetches `page_size + 1` rows, the extra row
+    telling if there is a next page.
+
+    The envelope is the same as `Pagination` where 'count' and 'total_pages' are None.
+    """
+
+    def get_page_bounds(self, request):
+        """The page number and its offset, a 404 for invalid or out of range page numbers"""
+        page_number = request.query_params.get(self.page_query_param) or 1
+        try:
+            page_number = int(page_number)
+            if page_number < 1:
+                raise ValueError(page_number)
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_page_message.format(page_number=page_number, message=_('Invalid page.')))
+        return page_number, (page_number - 1) * self.page_size
+
+    def get_page(self, rows, page_number):
+        if not rows and page_number > 1:
+            raise NotFound(self.invalid_page_message.format(page_number=page_number, message=_('That page contains no results')))
+        return NoCountPage(rows[:self.page_size], page_number, len(rows) > self.page_size)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        page_number, offset = self.get_page_bounds(request)
+        self.page = self.get_page(list(queryset[offset:offset + self.page_size + 1]), page_number)
+        return self.page.object_list
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        page_number, offset = self.get_page_bounds(request)
+        rows = [obj async for obj in queryset[offset:offset + self.page_size + 1]]
+        self.page = self.get_page(rows, page_number)
+        return self.page.object_list
+
+    def get_count(self):
+        return None
+
+    def get_total_pages(self):
+        return None
+
+
+class EstimatedCountPagination(NoCountPagination):
+    """
+    Page number paginator reporting an estimated count. The pages are fetched as
+    `NoCountPagination`, the count is read from the cache of `DJANGO_MESSAGES_DRF_COUNT_CACHE`
+    by the SQL of the queryset.
+
+    - A count older than `count_max_age` seconds is returned and refreshed in the background.
+    - Without a count, the estimate of the planner is returned on PostgreSQL and the count is
+    computed in the background, other databases count once in the request.
+
+    The count is never below the rows already seen by the page.
+    """
+    count_max_age = 60
+    count_timeout = 24 * 60 * 60
+    count_backend = None
+
+    def get_cache(self):
+        return caches[getattr(settings, 'DJANGO_MESSAGES_DRF_COUNT_CACHE', 'default')]
+
+    def get_count_key(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        return 'dmdrf:count:' + hashlib.md5(repr((queryset.db, sql, params)).encode()).hexdigest()
+
+    def get_backend(self):
+        if EstimatedCountPagination.count_backend is None:
+            EstimatedCountPagination.count_backend = ThreadPoolBackend(max_workers=1, max_pending=100)
+        return EstimatedCountPagination.count_backend
+
+    def estimate_count(self, queryset):
+        """The number of rows estimated by the planner of PostgreSQL, otherwise None"""
+        connection = connections[queryset.db]
+        if connection.vendor != 'postgresql':
+            return None
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+            plan = cursor.fetchone()[0]
+        plan = json.loads(plan) if isinstance(plan, str) else plan
+        return int(plan[0]['Plan']['Plan Rows'])
+
+    def refresh_count(self, queryset, key):
+        count = queryset.count()
+        self.get_cache().set(key, (count, time.time()), timeout=self.count_timeout)
+        return count
+
+    def schedule_refresh(self, queryset, key):
+        """Refreshes the count in the background, once at a time per key"""
+        if self.get_cache().add(f'{key}:refreshing', True, timeout=self.count_max_age):
+            self.get_backend().submit(self.run_refresh, queryset, key)
+
+    def run_refresh(self, queryset, key):
+        try:
+            self.refresh_count(queryset, key)
+        except Exception:
+            log.exception("Counting %s failed", key)
+        finally:
+            self.get_cache().delete(f'{key}:refreshing')
+
+    def get_estimated_count(self, queryset):
+        queryset = queryset.order_by()
+        key = self.get_count_key(queryset)
+        cached = self.get_cache().get(key)
+        if cached is not None:
+            count, counted_at = cached
+            if time.time() - counted_at > self.count_max_age:
+                self.schedule_refresh(queryset, key)
+            return count
+
+        estimate = self.estimate_count(queryset)
+        if estimate is None:
+            return self.refresh_count(queryset, key)
+        self.schedule_refresh(queryset, key)
+        return estimate
+
+    def paginate_queryset(self, queryset, request, view=None):
+        page = super().paginate_queryset(queryset, request, view=view)
+        if page is not None:
+            self.count = self.get_estimated_count(queryset)
+        return page
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        page = await super().apaginate_queryset(queryset, request, view=view)
+        if page is not None:
+            self.count = await sync_to_async(self.get_estimated_count)(queryset)
+        return page
+
+    def get_count(self):
+        # The rows already seen are a lower bound of the count, whatever the estimate.
+        seen = (self.page.number - 1) * self.page_size + len(self.page) + self.page.has_next()
+        return max(self.count, seen)
+
+    def get_total_pages(self):
+        return max(math.ceil(self.get_count() / self.page_size), 1)
+
+
+class CursorPagination(pagination.BasePagination):
+    """
+    Keyset paginator for the inbox. Pages are fetched by the position of the latest activity
+    instead of an offset, therefore no COUNT(*) is issued and the pages don't shift when new
+    messages arrive.
+
+    The cursor is the (latest activity, id) of the last thread of the page, or of the first one
+    for the previous page, so threads with the same latest activity are neither skipped nor
+    repeated. Only `page_size + 1` threads are fetched.
+
+    The envelope is the same as `Pagination` where the links carry opaque cursors and
+    'count' and 'total_pages' are always None.
+    """
+    page_size = api_settings.PAGE_SIZE
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = _('Invalid cursor')
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if not self.page_size:
+            return None
+
+        self.request = request
+        self.cursor = self.decode_cursor(request)
+        self.reverse = self.cursor is not None and self.cursor[2]
+        if self.reverse:
+            activity, pk, _reverse = self.cursor
+            queryset = queryset.order_by('latest_activity', 'pk').filter(
+                Q(latest_activity__gt=activity) | Q(latest_activity=activity, pk__gt=pk)
+            )
+        else:
+            queryset = queryset.order_by('-latest_activity', '-pk')
+            if self.cursor is not None:
+                activity, pk, _reverse = self.cursor
+                queryset = queryset.filter(Q(latest_activity__lt=activity) | Q(latest_activity=activity, pk__lt=pk))
+
+        page = list(queryset[:self.page_size + 1])
+        has_more = len(page) > self.page_size
+        self.page = page[:self.page_size]
+        if self.reverse:
+            self.page.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, self.cursor is not None
+        return self.page
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            activity, pk, reverse = json.loads(b64decode(encoded.encode('ascii')))
+            activity, pk = parse_datetime(activity), int(pk)
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if activity is None:
+            raise NotFound(self.invalid_cursor_message)
+        return activity, pk, bool(reverse)
+
+    def encode_cursor(self, thread, reverse):
+        data = json.dumps([thread.latest_activity.isoformat(), thread.pk, reverse]).encode('ascii')
+        return b64encode(data).decode('ascii')
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.page[-1], False))
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.page[0], True))
+
+    def get_paginated_data(self, data):
+        return {
+            'links': {
+                'next': self.get_next_link(),
+                'previous': self.get_previous_link()
+            },
+            'pagination': {
+                'page_size': self.page_size
+            },
+            'count': None,
+            'total_pages': None,
+            'next': self.has_next,
+            'previous': self.has_previous,
+            'results': data
+        }
+
+    def get_paginated_response(self, data):
+        return Response(self.get_paginated_data(data))
+
+
+class MessageWindowPagination(pagination.BasePagination):
+    """
+    Returns a window over the messages of a thread, oldest first, and merges it with the thread
+    rendered by the view.
+
+    - By default the newest `page_size` messages.
+    - `?before=<message uuid>`: the messages sent before the given one.
+    - `?after=<message uuid>`: the messages sent after the given one.
+    - `?around=unread`: the messages around the first unread message of the user, or around a
+    given message uuid.
+
+    The position of a message is given by (`sent_at`, id) so no OFFSET or COUNT(*) is issued and
+    only `page_size + 1` rows are fetched. The links carry the cursors to the previous (older)
+    and next (newer) windows.
+
+    When the view has `get_archive_queryset`, the windows past the oldest message continue in
+    the archived messages, which are older than the ones of the queryset.
+    """
+    page_size = 50
+    max_page_size = 200
+    page_size_query_param = 'page_size'
+    before_query_param = 'before'
+    after_query_param = 'after'
+    around_query_param = 'around'
+    around_unread = 'unread'
+    invalid_cursor_message = _('Invalid cursor')
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.has_before = self.has_after = False
+
+        queryset = queryset.order_by('sent_at', 'pk')
+        self.archive = self.get_archive(view)
+        before = request.query_params.get(self.before_query_param)
+        after = request.query_params.get(self.after_query_param)
+        around = request.query_params.get(self.around_query_param)
+
+        if before:
+            self.window = self.get_before(queryset, self.get_anchor(queryset, before), self.page_size)
+            self.has_after = True
+        elif after:
+            self.window = self.get_after(queryset, self.get_anchor(queryset, after), self.page_size)
+            self.has_before = True
+        elif around:
+            if around == self.around_unread:
+                thread = getattr(view, 'thread', None)
+                anchor = thread.first_unread_message(request.user) if thread else None
+            else:
+                anchor = self.get_anchor(queryset, around)
+            self.window = self.get_around(queryset, anchor) if anchor else self.get_newest(queryset)
+        else:
+            self.window = self.get_newest(queryset)
+        return self.window
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(page_size, self.max_page_size))
+
+    def get_archive(self, view):
+        """The archived messages of the view, ordered as the queryset, or None"""
+        get_archive_queryset = getattr(view, 'get_archive_queryset', None)
+        if get_archive_queryset is None:
+            return None
+        return get_archive_queryset().order_by('sent_at', 'pk')
+
+    def is_archived(self, message):
+        return self.archive is not None and isinstance(message, self.archive.model)
+
+    def get_anchor(self, queryset, message_uuid):
+        """Returns the message of the cursor, looking into the archive after the queryset"""
+        try:
+            message_uuid = UUID(message_uuid)
+        except ValueError:
+            raise NotFound(self.invalid_cursor_message)
+
+        for source in (queryset, self.archive):
+            if source is None:
+                continue
+            try:
+                return source.get(uuid=message_uuid)
+            except source.model.DoesNotExist:
+                pass
+        raise NotFound(self.invalid_cursor_message)
+
+    def get_before(self, queryset, anchor, size):
+        before = Q(sent_at__lt=anchor.sent_at) | Q(sent_at=anchor.sent_at, pk__lt=anchor.pk)
+        messages = []
+        if not self.is_archived(anchor):
+            messages = list(queryset.filter(before).reverse()[:size + 1])
+        if len(messages) <= size and self.archive is not None:
+            messages += self.archive.filter(before).reverse()[:size + 1 - len(messages)]
+        self.has_before = len(messages) > size
+        return messages[:size][::-1]
+
+    def get_after(self, queryset, anchor, size, include_anchor=False):
+        lookup = 'pk__gte' if include_anchor else 'pk__gt'
+        after = Q(sent_at__gt=anchor.sent_at) | Q(sent_at=anchor.sent_at, **{lookup: anchor.pk})
+        messages = []
+        if self.is_archived(anchor):
+            messages = list(self.archive.filter(after)[:size + 1])
+        if len(messages) <= size:
+            messages += queryset.filter(after)[:size + 1 - len(messages)]
+        self.has_after = len(messages) > size
+        return messages[:size]
+
+    def get_newest(self, queryset):
+        messages = list(queryset.reverse()[:self.page_size + 1])
+        if len(messages) <= self.page_size and self.archive is not None:
+            messages += self.archive.reverse()[:self.page_size + 1 - len(messages)]
+        self.has_before = len(messages) > self.page_size
+        return messages[:self.page_size][::-1]
+
+    def get_around(self, queryset, anchor):
+        """Half of the window before the anchor, the anchor and the messages after it"""
+        size_before = self.page_size // 2
+        before = self.get_before(queryset, anchor, size_before) if size_before else []
+        return before + self.get_after(queryset, anchor, self.page_size - size_before, include_anchor=True)
+
+    def get_next_link(self):
+        if not self.has_after or not self.window:
+            return None
+        url = self.get_base_url()
+        return replace_query_param(url, self.after_query_param, self.window[-1].uuid)
+
+    def get_previous_link(self):
+        if not self.has_before or not self.window:
+            return None
+        url = self.get_base_url()
+        return replace_query_param(url, self.before_query_param, self.window[0].uuid)
+
+    def get_base_url(self):
+        url = self.request.build_absolute_uri()
+        for param in (self.before_query_param, self.after_query_param, self.around_query_param):
+            url = remove_query_param(url, param)
+        return url
+
+    def get_paginated_data(self, data):
+        return {
+            **data,
+            'links': {
+                'next': self.get_next_link(),
+                'previous': self.get_previous_link()
+            },
+            'pagination': {
+                'page_size': self.page_size
+            },
+            'next': self.has_after,
+            'previous': self.has_before,
+        }
+
+    def get_paginated_response(self, data):
+        return Response(self.get_paginated_data(data))
+
+
+class SearchCursorPagination(pagination.BasePagination):
+    """
+    Keyset paginator for the `SearchResults` of `search.py`, the best ranked first. The cursor of
+    the next page is the (rank, id) of the last result so only `page_size + 1` hits are fetched.
+
+    The envelope is the same as `CursorPagination`, there is no link to the previous page.
+    The page size is its own, the `PAGE_SIZE` of `REST_FRAMEWORK` doesn't apply.
+    """
+    page_size = 20
+    page_size_from_settings = False
+    max_page_size = 100
+    page_size_query_param = 'page_size'
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = _('Invalid cursor')
+
+    def paginate_queryset(self, results, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.cursor = self.decode_cursor(request)
+
+        page = results.fetch(self.page_size + 1, after=self.cursor)
+        self.has_next = len(page) > self.page_size
+        self.page = page[:self.page_size]
+        return self.page
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(page_size, self.max_page_size))
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            rank, pk = json.loads(b64decode(encoded.encode('ascii')))
+            return float(rank), int(pk)
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, message):
+        data = json.dumps([message.search_rank, message.pk]).encode('ascii')
+        return b64encode(data).decode('ascii')
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.page[-1]))
+
+    def get_paginated_data(self, data):
+        return {
+            'links': {
+                'next': self.get_next_link(),
+                'previous': None
+            },
+            'pagination': {
+                'page_size': self.page_size
+            },
+            'count': None,
+            'total_pages': None,
+            'next': self.has_next,
+            'previous': self.cursor is not None,
+            'results': data
+        }
+
+    def get_paginated_response(self, data):
+        return Response(self.get_paginated_data(data))
 
 
 class SimplePagination(pagination.PageNumberPagination): # pragma: no cover
@@ -45,11 +45,12 @@ class DjangoMessageDRFAuthMixin(AccessMixin, APIView): # pragma: no cover
     def __init__(self, *args, **kwargs) -> None:
         """
         Checks if the views contain the `permissions` attribute and overrides the
-        `permission_classes`.
+        `permission_classes`. The page size of the pagination is the `PAGE_SIZE` of
+        `REST_FRAMEWORK` unless the pagination sets `page_size_from_settings` to False.
         """
         super().__init__(*args, **kwargs)
         self.permission_classes = self.permissions
-        if self.pagination_class:
+        if self.pagination_class and getattr(self.pagination_class, 'page_size_from_settings', True):
             try:
                 rest_settings = settings.REST_FRAMEWORK
             except AttributeError:
@@ -0,0 +1,61 @@
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from .brokers import get_broker, message_event
+from .cache import invalidate_thread
+from .dispatch import synchronous
+from .models import Message, Thread
+from .search import get_search_backend
+from .signals import message_sent
+
+
+@receiver(message_sent)
+@synchronous
+def publish_message_sent(sender, message, thread, reply, **kwargs):
+    """
+    Publishes the message to the streams of the participants of the thread once the transaction
+    is committed. Synchronous as it defers itself, the event isn't delayed by the dispatch.
+    """
+    event = message_event(message, thread, reply)
+
+    def publish():
+        user_ids = thread.userthread_set.values_list('user_id', flat=True)
+        get_broker().publish(list(user_ids), event)
+
+    transaction.on_commit(publish)
+
+
+@receiver(message_sent)
+@synchronous
+def invalidate_message_sent(sender, message, thread, reply, **kwargs):
+    """
+    Bumps the cached responses of the thread and of its participants once the transaction is
+    committed. Synchronous so the sender never reads a stale response, whatever the dispatch.
+    """
+    invalidate_thread(thread)
+
+
+@receiver(post_save, sender=Message)
+def message_edited(sender, instance, created=False, using=None, **kwargs):
+    """
+    Touches the thread of an edited message, changing the validators of the conditional requests,
+    and bumps its cached responses
+    """
+    if not created:
+        instance.thread.touch()
+        invalidate_thread(instance.thread, using=using)
+
+
+@receiver(post_save, sender=Message)
+def index_message(sender, instance, update_fields=None, using=None, **kwargs):
+    """Indexes the content of a message for the search once the transaction is committed"""
+    if update_fields is None or 'content' in update_fields:
+        transaction.on_commit(lambda: get_search_backend().index_messages([instance]), using=using)
+
+
+@receiver(post_save, sender=Thread)
+def index_thread(sender, instance, created=False, update_fields=None, using=None, **kwargs):
+    """Indexes the subject of a thread for the search once the transaction is committed"""
+    if created or update_fields is None or 'subject' in update_fields:
+        transaction.on_commit(lambda: get_search_backend().index_threads([instance]), using=using)
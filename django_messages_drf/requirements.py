@@ -0,0 +1,123 @@
+"""
+Declarations of what the serializers read from the querysets they render.
+
+A serializer declares its requirements, the `select_related`, `prefetch_related`, annotations and
+`only` fields, by returning a `QueryRequirements` from the class method `get_query_requirements`.
+The views apply the requirements of their serializer to the querysets they fetch, therefore a
+serializer swapped by the settings gets its relations and annotations without a query per row.
+The requirements of the other querysets rendered, e.g. the messages of a thread, are given by name
+in `related`.
+
+With `DEBUG` the views log the queries run while serializing, the lazy loads that no serializer
+declared.
+"""
+import logging
+from contextlib import ExitStack, contextmanager
+
+from django.db import connections
+from django.db.models import Prefetch
+
+log = logging.getLogger(__name__)
+
+
+def unique(items):
+    return tuple(dict.fromkeys(items))
+
+
+class QueryRequirements:
+    """
+    The requirements of a queryset:
+
+    - `select_related` and `prefetch_related`: the relations, lookups or `Prefetch` objects.
+    - `annotations`: a dict of expressions, or a callable returning one given the context of the
+    serializer.
+    - `only`: the fields to load, all of them when None. The relations of `select_related` are
+    always loaded.
+    - `related`: the requirements of the other querysets rendered, by name.
+
+    The requirements are merged with `|`.
+    """
+
+    def __init__(self, select_related=(), prefetch_related=(), annotations=None, only=None, related=None):
+        self.select_related = unique(select_related)
+        self.prefetch_related = unique(prefetch_related)
+        self.annotations = () if annotations is None else (annotations,)
+        self.only = None if only is None else unique(only)
+        self.related = dict(related or {})
+
+    def __or__(self, other):
+        merged = QueryRequirements(
+            select_related=self.select_related + other.select_related,
+            prefetch_related=self.prefetch_related + other.prefetch_related,
+        )
+        merged.annotations = self.annotations + other.annotations
+        if self.only is not None and other.only is not None:
+            merged.only = unique(self.only + other.only)
+        merged.related = dict(self.related)
+        for name, requirements in other.related.items():
+            merged.related[name] = merged.related[name] | requirements if name in merged.related else requirements
+        return merged
+
+    def nest(self, relation):
+        """
+        The requirements of the model of a forward relation as requirements of the model holding
+        it, e.g. the ones of the sender of a message as ones of the message. The annotations,
+        `only` and the related requirements are left out.
+        """
+        prefetch_related = [
+            Prefetch(f'{relation}__{lookup.prefetch_through}', queryset=lookup.queryset, to_attr=lookup.to_attr)
+            if isinstance(lookup, Prefetch) else f'{relation}__{lookup}'
+            for lookup in self.prefetch_related
+        ]
+        return QueryRequirements(
+            select_related=(relation, *(f'{relation}__{lookup}' for lookup in self.select_related)),
+            prefetch_related=prefetch_related,
+        )
+
+    def get_annotations(self, context=None):
+        annotations = {}
+        for declared in self.annotations:
+            annotations.update(declared(context or {}) if callable(declared) else declared)
+        return annotations
+
+    def apply(self, queryset, context=None):
+        """Returns the queryset with the requirements, `context` is the one of the serializer"""
+        if self.select_related:
+            queryset = queryset.select_related(*self.select_related)
+        if self.prefetch_related:
+            queryset = queryset.prefetch_related(*self.prefetch_related)
+        annotations = self.get_annotations(context)
+        if annotations:
+            queryset = queryset.annotate(**annotations)
+        if self.only is not None:
+            queryset = queryset.only(*self.only, *self.select_related)
+        return queryset
+
+
+def get_query_requirements(serializer_class):
+    """The requirements declared by the serializer class, none when it doesn't declare them"""
+    declare = getattr(serializer_class, 'get_query_requirements', None)
+    if declare is None:
+        return QueryRequirements()
+    return declare()
+
+
+@contextmanager
+def warn_lazy_loads(view, serializer):
+    """Logs the queries run in the block, serializing for the view with the serializer"""
+    queries = []
+
+    def record(execute, sql, params, many, context):
+        queries.append(sql)
+        return execute(sql, params, many, context)
+
+    with ExitStack() as stack:
+        for alias in connections:
+            stack.enter_context(connections[alias].execute_wrapper(record))
+        yield
+
+    for sql in queries:
+        log.warning(
+            "%s ran a query while serializing with %s, a lazy load not declared by its query requirements: %s",
+            view.__class__.__name__, getattr(serializer, 'child', serializer).__class__.__name__, sql
+        )
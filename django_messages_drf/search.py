@@ -0,0 +1,304 @@
+"""
+Full-text search over the messages and the subjects of the threads of a user.
+
+The index is given by the `DJANGO_MESSAGES_DRF_SEARCH_BACKEND` setting and its keyword arguments
+by `DJANGO_MESSAGES_DRF_SEARCH_BACKEND_OPTIONS`. By default the backend of the database is used:
+
+- `SQLiteSearchBackend`: FTS5 tables ranked with bm25.
+- `PostgresSearchBackend`: `tsvector` tables with GIN indexes ranked with `ts_rank`.
+- `SimpleSearchBackend`: `icontains` lookups without an index or ranking, for any other database.
+
+The tables of the built-in backends are created by the migrations. Once the transaction is
+committed, the content of a message is indexed when saved and the subject of a thread when created
+or changed. The subject of a thread
+matches its oldest message not archived. Rows inserted without `save()` are indexed with the
+`rebuild_message_index` command.
+
+The archived messages, moved to `ArchivedMessage` by `archive_messages`, are not searched.
+"""
+import re
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import OuterRef, Q, Subquery
+from django.utils.module_loading import import_string
+
+from .models import Message, Thread, UserThread
+
+BACKENDS = {
+    'sqlite': 'django_messages_drf.search.SQLiteSearchBackend',
+    'postgresql': 'django_messages_drf.search.PostgresSearchBackend',
+}
+DEFAULT_BACKEND = 'django_messages_drf.search.SimpleSearchBackend'
+
+
+class SearchResults:
+    """
+    The lazy results of a search, fetched by pages of the best ranked messages first.
+    """
+
+    def __init__(self, backend, user, terms):
+        self.backend = backend
+        self.user = user
+        self.terms = terms
+        self.queryset = Message.objects.select_related('sender', 'thread')
+
+    def with_queryset(self, queryset):
+        """Fetches the messages found from `queryset`, e.g. with the requirements of a serializer"""
+        self.queryset = queryset
+        return self
+
+    def fetch(self, limit, after=None):
+        """
+        Returns up to `limit` messages ranked after the (rank, id) of `after`, with the rank in
+        `search_rank`.
+        """
+        if not self.terms:
+            return []
+        hits = self.backend.get_hits(self.user, self.terms, limit, after)
+        messages = self.queryset.in_bulk([pk for pk, _ in hits])
+        results = []
+        for pk, rank in hits:
+            if pk in messages:
+                messages[pk].search_rank = rank
+                results.append(messages[pk])
+        return results
+
+
+class BaseSearchBackend:
+    """
+    Indexes the messages and the threads and searches them. `get_hits` returns the ids of the
+    messages of the threads of the user matching every term with their rank, ordered by
+    (rank, id) descending.
+    """
+
+    def __init__(self, using='default'):
+        self.using = using
+
+    @property
+    def connection(self):
+        return connections[self.using]
+
+    def is_available(self):
+        return True
+
+    def get_terms(self, query):
+        return re.findall(r'\w+', query or '')
+
+    def search(self, user, query):
+        return SearchResults(self, user, self.get_terms(query))
+
+    def index_messages(self, messages):
+        """Indexes the content of the given messages"""
+
+    def index_threads(self, threads):
+        """Indexes the subject of the given threads"""
+
+    def clear(self):
+        """Removes everything from the index"""
+
+    def get_hits(self, user, terms, limit, after=None):
+        raise NotImplementedError('get_hits() must be implemented.')
+
+
+class SimpleSearchBackend(BaseSearchBackend):
+    """
+    Searches with `icontains`, scanning the messages of the user. Every result has the same rank
+    so they are ordered by the newest first.
+    """
+
+    def get_hits(self, user, terms, limit, after=None):
+        first = Message.objects.filter(thread=OuterRef('thread')).order_by('seq').values('pk')[:1]
+        content, subject = Q(), Q(pk=Subquery(first))
+        for term in terms:
+            content &= Q(content__icontains=term)
+            subject &= Q(thread__subject__icontains=term)
+
+        threads = UserThread.objects.filter(user=user, deleted=False).values('thread')
+        queryset = Message.objects.filter(content | subject, thread__in=threads)
+        if after:
+            queryset = queryset.filter(pk__lt=after[1])
+        return [(pk, 0.0) for pk in queryset.order_by('-pk').values_list('pk', flat=True)[:limit]]
+
+
+class SQLSearchBackend(BaseSearchBackend):
+    """
+    Base of the backends searching tables of the database. `get_matches` returns the SQL of the
+    (id, score) of the matching messages, the matches of a subject are given to the oldest message
+    of the thread not archived.
+    """
+    message_table = None
+    thread_table = None
+
+    def is_available(self):
+        return self.message_table in self.connection.introspection.table_names()
+
+    def get_matches(self, terms):
+        raise NotImplementedError('get_matches() must be implemented.')
+
+    def get_hits(self, user, terms, limit, after=None):
+        quote = self.connection.ops.quote_name
+        matches, params = self.get_matches(terms)
+        params = [*params, user.pk, False]
+
+        having = ''
+        if after:
+            having = 'HAVING SUM(hits.score) < %s OR (SUM(hits.score) = %s AND hits.id < %s)'
+            params += [after[0], after[0], after[1]]
+
+        sql = f"""
+            SELECT hits.id, SUM(hits.score) AS rank
+            FROM ({matches}) hits
+            INNER JOIN {quote(Message._meta.db_table)} m ON m.id = hits.id
+            INNER JOIN {quote(UserThread._meta.db_table)} ut ON ut.thread_id = m.thread_id
+            WHERE ut.user_id = %s AND ut.deleted = %s
+            GROUP BY hits.id
+            {having}
+            ORDER BY rank DESC, hits.id DESC
+            LIMIT %s
+        """
+        with self.connection.cursor() as cursor:
+            cursor.execute(sql, [*params, limit])
+            return [(pk, float(rank)) for pk, rank in cursor.fetchall()]
+
+    def clear(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {self.message_table}")
+            cursor.execute(f"DELETE FROM {self.thread_table}")
+
+
+class SQLiteSearchBackend(SQLSearchBackend):
+    """
+    Indexes in FTS5 tables keyed by the id of the message and of the thread. The rows of the
+    deleted messages are ignored by the search and removed by `rebuild_message_index`.
+    """
+    message_table = 'django_messages_drf_message_fts'
+    thread_table = 'django_messages_drf_thread_fts'
+
+    def replace(self, table, column, rows):
+        rows = [(pk, text or '') for pk, text in rows]
+        with self.connection.cursor() as cursor:
+            cursor.executemany(f"DELETE FROM {table} WHERE rowid = %s", [(pk,) for pk, _ in rows])
+            cursor.executemany(f"INSERT INTO {table} (rowid, {column}) VALUES (%s, %s)", rows)
+
+    def index_messages(self, messages):
+        self.replace(self.message_table, 'content', [(m.pk, m.content) for m in messages])
+
+    def index_threads(self, threads):
+        self.replace(self.thread_table, 'subject', [(t.pk, t.subject) for t in threads])
+
+    def get_matches(self, terms):
+        match = ' '.join(f'"{term}"' for term in terms)
+        messages = self.connection.ops.quote_name(Message._meta.db_table)
+        sql = f"""
+            SELECT rowid AS id, -bm25({self.message_table}) AS score
+            FROM {self.message_table} WHERE {self.message_table} MATCH %s
+            UNION ALL
+            SELECT m.id AS id, -bm25({self.thread_table}) AS score
+            FROM {self.thread_table}
+            INNER JOIN {messages} m ON m.id = (
+                SELECT f.id FROM {messages} f WHERE f.thread_id = {self.thread_table}.rowid ORDER BY f.seq LIMIT 1
+            )
+            WHERE {self.thread_table} MATCH %s
+        """
+        return sql, [match, match]
+
+
+class PostgresSearchBackend(SQLSearchBackend):
+    """
+    Indexes `tsvector` documents with GIN indexes in tables keyed by the id of the message and of
+    the thread, removed with them. `config` is the text search configuration of the documents
+    and of the queries.
+    """
+    message_table = 'django_messages_drf_message_search'
+    thread_table = 'django_messages_drf_thread_search'
+
+    def __init__(self, using='default', config='simple'):
+        super().__init__(using=using)
+        self.config = config
+
+    def upsert(self, table, key, rows):
+        with self.connection.cursor() as cursor:
+            cursor.executemany(
+                f"INSERT INTO {table} ({key}, document) VALUES (%s, to_tsvector(%s::regconfig, %s)) "
+                f"ON CONFLICT ({key}) DO UPDATE SET document = EXCLUDED.document",
+                [(pk, self.config, text or '') for pk, text in rows]
+            )
+
+    def index_messages(self, messages):
+        self.upsert(self.message_table, 'message_id', [(m.pk, m.content) for m in messages])
+
+    def index_threads(self, threads):
+        self.upsert(self.thread_table, 'thread_id', [(t.pk, t.subject) for t in threads])
+
+    def get_matches(self, terms):
+        query = "plainto_tsquery(%s::regconfig, %s)"
+        messages = self.connection.ops.quote_name(Message._meta.db_table)
+        sql = f"""
+            SELECT s.message_id AS id, ts_rank(s.document, {query})::float8 AS score
+            FROM {self.message_table} s WHERE s.document @@ {query}
+            UNION ALL
+            SELECT m.id AS id, ts_rank(t.document, {query})::float8 AS score
+            FROM {self.thread_table} t
+            INNER JOIN {messages} m ON m.id = (
+                SELECT f.id FROM {messages} f WHERE f.thread_id = t.thread_id ORDER BY f.seq LIMIT 1
+            )
+            WHERE t.document @@ {query}
+        """
+        text = ' '.join(terms)
+        return sql, [self.config, text] * 4
+
+    def clear(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f"TRUNCATE {self.message_table}, {self.thread_table}")
+
+
+_backends = {}
+
+
+def get_search_backend():
+    """
+    Returns the backend given by the settings, one instance per process. Without the setting the
+    backend of the database is used when its tables exist.
+    """
+    path = getattr(settings, 'DJANGO_MESSAGES_DRF_SEARCH_BACKEND', None)
+    options = getattr(settings, 'DJANGO_MESSAGES_DRF_SEARCH_BACKEND_OPTIONS', {})
+    key = path or 'auto'
+    if key not in _backends:
+        if path:
+            backend = import_string(path)(**options)
+        else:
+            vendor = connections[options.get('using', 'default')].vendor
+            backend = import_string(BACKENDS.get(vendor, DEFAULT_BACKEND))(**options)
+            if not backend.is_available():
+                backend = import_string(DEFAULT_BACKEND)(using=backend.using)
+        _backends[key] = backend
+    return _backends[key]
+
+
+def rebuild_index(batch_size=1000, log=None):
+    """
+    Clears the index and indexes every thread and message in batches of `batch_size`, ordered by
+    the primary key. Returns the number of threads and messages indexed.
+    """
+    backend = get_search_backend()
+    backend.clear()
+    counts = []
+    for model, fields, index in ((Thread, ('pk', 'subject'), backend.index_threads),
+                                 (Message, ('pk', 'content'), backend.index_messages)):
+        count, last = 0, None
+        while True:
+            queryset = model.objects.order_by('pk').only(*fields)
+            if last is not None:
+                queryset = queryset.filter(pk__gt=last)
+            batch = list(queryset[:batch_size])
+            if not batch:
+                break
+            with transaction.atomic(using=backend.using):
+                index(batch)
+            count += len(batch)
+            last = batch[-1].pk
+            if log:
+                log(f"{model._meta.verbose_name_plural}: {count}")
+        counts.append(count)
+    return tuple(counts)
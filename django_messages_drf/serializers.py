@@ -1,10 +1,21 @@
+from operator import attrgetter
+
 from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import models
+from django.db.models import Prefetch
+from django.utils.functional import cached_property
 from django.utils.translation import gettext_lazy as _
 
 from rest_framework import serializers
+from rest_framework.fields import SkipField
 
 from .mixins import CurrentThreadDefault
-from .models import Message, Thread
+from .models import Message, Thread, ThreadQuerySet
+from .requirements import QueryRequirements, get_query_requirements
+
+# The fields whose `to_representation` is a builtin
+BUILTIN_CONVERTERS = {serializers.CharField: str, serializers.IntegerField: int}
 
 
 class SenderReceiverSerializer(serializers.ModelSerializer):
@@ -19,19 +30,32 @@ class SenderReceiverSerializer(serializers.ModelSerializer):
         model = get_user_model()
         fields = ('display_name', 'is_user')
 
+    @classmethod
+    def get_query_requirements(cls):
+        return QueryRequirements()
+
     def get_is_user(self, instance):
         return instance.pk == self.user.pk
 
     def get_display_name(self, instance):
         return f"{instance.first_name} {instance.last_name}"
 
+    def to_representation(self, instance):
+        # Built directly unless a subclass renders other fields
+        if self.Meta.fields != SenderReceiverSerializer.Meta.fields:
+            return super().to_representation(instance)
+        return {'display_name': self.get_display_name(instance), 'is_user': self.get_is_user(instance)}
+
 
 class InboxSerializer(serializers.ModelSerializer):
     """
-    Serializer for the list of messages
+    Serializer for the list of messages.
+
+    Reads the annotations from `ThreadQuerySet.with_inbox_data` when available, otherwise
+    falls back to the methods of the thread.
     """
     sender = serializers.SerializerMethodField()
-    sent_at = serializers.DateTimeField(source='first_message.sent_at')
+    sent_at = serializers.DateTimeField(source='get_first_message_at')
     total_unread = serializers.SerializerMethodField()
     last_message = serializers.SerializerMethodField()
 
@@ -43,7 +67,23 @@ class InboxSerializer(serializers.ModelSerializer):
         model = Thread
         fields = ('uuid', 'subject', 'sender', 'sent_at', 'total_unread', 'last_message')
 
+    @classmethod
+    def get_query_requirements(cls):
+        """
+        The annotations of the inbox. A swapped sender serializer gets the sender of the latest
+        message joined with its own requirements instead of the user built from the annotations.
+        """
+        from .settings import SENDER_RECEIVER_SERIALIZER
+
+        requirements = QueryRequirements(annotations=lambda context: ThreadQuerySet.inbox_annotations(context['user']))
+        if SENDER_RECEIVER_SERIALIZER is SenderReceiverSerializer:
+            return requirements
+        sender = get_query_requirements(SENDER_RECEIVER_SERIALIZER).nest('sender').nest('last_sent_message')
+        return requirements | sender
+
     def get_last_message(self, instance): # pragma: no cover
+        if hasattr(instance, 'last_message_snippet'):
+            return instance.last_message_snippet
         message = instance.last_message()
         if message:
             return message.content[:50]
@@ -55,49 +95,177 @@ class InboxSerializer(serializers.ModelSerializer):
 
     def get_sender(self, instance): # pragma: no cover
         serializer = self.sender_receiver_klass(context=self.context)
-        message = instance.last_message()
-        if message:
-            return serializer.to_representation(message.sender)
+        sender = instance.get_last_sender()
+        if sender:
+            return serializer.to_representation(sender)
 
     def get_total_unread(self, instance):
+        if hasattr(instance, 'total_unread'):
+            return instance.total_unread
         return instance.unread_messages(self.user).count()
 
 
+class MessageListSerializer(serializers.ListSerializer):
+    """
+    Renders many messages, the senders not loaded with the messages are fetched in one query.
+    """
+
+    def to_representation(self, data):
+        iterable = data.all() if isinstance(data, models.manager.BaseManager) else data
+        messages = list(iterable)
+        self.child.load_senders(messages)
+        return [self.child.to_representation(message) for message in messages]
+
+
 class MessageSerializer(serializers.ModelSerializer):
     """
-    Renders the messages from a given thread
+    Renders the messages from a given thread.
+
+    The fields are read straight from the message, without the attribute lookups of DRF, and the
+    representation of each sender is built once per request and shared by its messages.
     """
     uuid = serializers.UUIDField()
     sender = serializers.SerializerMethodField()
 
     class Meta:
         model = Message
-        exclude = ('id', 'thread',)
+        exclude = ('id', 'thread', 'seq',)
+        list_serializer_class = MessageListSerializer
 
     @property
     def sender_receiver_klass(self):
         from .settings import SENDER_RECEIVER_SERIALIZER
         return SENDER_RECEIVER_SERIALIZER
 
+    @classmethod
+    def get_query_requirements(cls):
+        from .settings import SENDER_RECEIVER_SERIALIZER
+        return get_query_requirements(SENDER_RECEIVER_SERIALIZER).nest('sender')
+
+    @cached_property
+    def sender_serializer(self):
+        return self.sender_receiver_klass(context=self.context)
+
+    @property
+    def senders(self):
+        """The representations of the senders of the request, by id"""
+        return self.context.setdefault('senders', {})
+
+    def load_senders(self, messages):
+        """Fetches the missing senders of the messages in a single query"""
+        missing = [m for m in messages if m.sender_id not in self.senders and not type(m).sender.is_cached(m)]
+        if not missing:
+            return
+        users = get_user_model().objects.in_bulk({m.sender_id for m in missing})
+        for message in missing:
+            type(message).sender.field.set_cached_value(message, users[message.sender_id])
+
     def get_sender(self, instance):
-        serializer = self.sender_receiver_klass(context=self.context)
-        return serializer.to_representation(instance.sender)
+        senders = self.senders
+        if instance.sender_id not in senders:
+            senders[instance.sender_id] = self.sender_serializer.to_representation(instance.sender)
+        return senders[instance.sender_id]
+
+    @cached_property
+    def readers(self):
+        """
+        The (name, getter, to_representation) of the readable fields. The method fields are
+        called, the fields of the model are read as attributes and the others go through DRF.
+        """
+        concrete = {field.name for field in self.Meta.model._meta.concrete_fields if not field.is_relation}
+        readers = []
+        for field in self._readable_fields:
+            if isinstance(field, serializers.SerializerMethodField):
+                readers.append((field.field_name, getattr(self, field.method_name), None))
+            elif field.source_attrs and len(field.source_attrs) == 1 and field.source in concrete:
+                readers.append((field.field_name, attrgetter(field.source), self.get_converter(field)))
+            else:
+                readers.append((field.field_name, field.get_attribute, field.to_representation))
+        return readers
+
+    def get_converter(self, field):
+        """The `to_representation` of the field, or the builtin doing the same"""
+        if type(field) is serializers.UUIDField and field.uuid_format == 'hex_verbose':
+            return str
+        return BUILTIN_CONVERTERS.get(type(field), field.to_representation)
+
+    def to_representation(self, instance):
+        ret = {}
+        for name, getter, to_representation in self.readers:
+            try:
+                value = getter(instance)
+            except SkipField:
+                continue
+            if value is not None and to_representation is not None:
+                value = to_representation(value)
+            ret[name] = value
+        return ret
+
+
+class SearchResultSerializer(MessageSerializer):
+    """
+    Renders a message found by the search with its thread and its rank
+    """
+    thread = serializers.SerializerMethodField()
+    rank = serializers.FloatField(source='search_rank')
+
+    class Meta:
+        model = Message
+        exclude = ('id', 'seq',)
+        list_serializer_class = MessageListSerializer
+
+    @classmethod
+    def get_query_requirements(cls):
+        return super().get_query_requirements() | QueryRequirements(select_related=('thread',))
+
+    def get_thread(self, instance):
+        return {'uuid': str(instance.thread.uuid), 'subject': instance.thread.subject}
 
 
 class ThreadSerializer(serializers.ModelSerializer): # pragma: no cover
     """
-    Serializer for the thread
+    Serializer for the thread.
+
+    The messages rendered are the ones given by the view in the context, usually a window
+    from `MessageWindowPagination`, or all the messages of the thread otherwise, archived ones
+    included.
     """
     subject = serializers.CharField()
+    participants = serializers.SerializerMethodField()
     messages = serializers.SerializerMethodField()
 
     class Meta:
         model = Thread
-        fields = ('id', 'uuid', 'subject', 'messages')
+        fields = ('id', 'uuid', 'subject', 'participants', 'messages')
+
+    @property
+    def sender_receiver_klass(self):
+        from .settings import SENDER_RECEIVER_SERIALIZER
+        return SENDER_RECEIVER_SERIALIZER
+
+    @classmethod
+    def get_query_requirements(cls):
+        """The participants are prefetched, the requirements of the messages are in `related`"""
+        from .settings import SENDER_RECEIVER_SERIALIZER
+        participants = get_query_requirements(SENDER_RECEIVER_SERIALIZER).apply(get_user_model().objects.all())
+        return QueryRequirements(
+            prefetch_related=(Prefetch('users', queryset=participants),),
+            related={'messages': get_query_requirements(MessageSerializer)},
+        )
+
+    def get_participants(self, instance):
+        serializer = self.sender_receiver_klass(many=True, context=self.context)
+        return serializer.to_representation(instance.users.all())
 
     def get_messages(self, instance):
+        messages = self.context.get('messages')
+        if messages is None:
+            messages = [
+                *instance.archived_messages.select_related('sender').order_by('sent_at', 'pk'),
+                *instance.messages.select_related('sender').order_by('sent_at', 'pk'),
+            ]
         serializer = MessageSerializer(many=True, context=self.context)
-        return serializer.to_representation(instance.messages.all())
+        return serializer.to_representation(messages)
 
 
 class ThreadReplySerializer(serializers.Serializer):
@@ -116,6 +284,72 @@ class ThreadReplySerializer(serializers.Serializer):
     )
 
 
+class GroupMessageSerializer(serializers.Serializer):
+    """
+    Serializer for a new thread sent to a group of users. The recipients are validated with a
+    single `in_bulk` query and the current user is never a recipient.
+    """
+    recipients = serializers.ListField(
+        child=serializers.CharField(), allow_empty=False, error_messages={
+            'empty': _("The recipients cannot be empty"),
+        }
+    )
+    message = serializers.CharField(
+        required=True, allow_null=False, allow_blank=False, error_messages={
+            'blank': _("The message cannot be empty"),
+        }
+    )
+    subject = serializers.CharField(
+        required=True, allow_null=False, allow_blank=False, error_messages={
+            'blank': _("The subject cannot be empty"),
+        }
+    )
+
+    def validate_recipients(self, value):
+        from .settings import MAX_RECIPIENTS
+
+        User = get_user_model()
+        try:
+            ids = list(dict.fromkeys(User._meta.pk.to_python(pk) for pk in value))
+        except DjangoValidationError:
+            raise serializers.ValidationError(_("Invalid recipients"))
+
+        if len(ids) > MAX_RECIPIENTS:
+            raise serializers.ValidationError(
+                _("A message cannot be sent to more than %(max)s recipients") % {'max': MAX_RECIPIENTS}
+            )
+
+        users = User.objects.in_bulk(ids)
+        missing = [str(pk) for pk in ids if pk not in users]
+        if missing:
+            raise serializers.ValidationError(
+                _("The recipients %(missing)s do not exist") % {'missing': ', '.join(missing)}
+            )
+
+        user = self.context.get('user')
+        recipients = [users[pk] for pk in ids if not user or pk != user.pk]
+        if not recipients:
+            raise serializers.ValidationError(_("The recipients cannot be only the sender"))
+        return recipients
+
+
+class ThreadBatchSerializer(serializers.Serializer):
+    """
+    Serializer for an action applied to many threads, given by a list of uuids or by a filter.
+    """
+    ACTIONS = ('read', 'unread', 'delete', 'restore')
+    FILTERS = ('inbox', 'unread', 'deleted')
+
+    action = serializers.ChoiceField(choices=ACTIONS)
+    threads = serializers.ListField(child=serializers.UUIDField(), required=False, allow_empty=False)
+    filter = serializers.ChoiceField(choices=FILTERS, required=False)
+
+    def validate(self, attrs):
+        if ('threads' in attrs) == ('filter' in attrs):
+            raise serializers.ValidationError(_("Either the threads or a filter must be given"))
+        return attrs
+
+
 class EditMessageSerializer(serializers.ModelSerializer):
     """
     Specifically edits a message
@@ -136,11 +370,12 @@ class EditMessageSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Message
-        exclude = ('id',)
+        exclude = ('id', 'seq',)
 
     def update(self, instance, validated_data):
-        instance.content = validated_data.get('content', instance.content)
-        instance.sender = validated_data.get('sender', instance.sender)
-        instance.thread = validated_data.get('thread', instance.thread)
+        # Only assigned when given so the current sender and thread aren't loaded
+        for field in ('content', 'sender', 'thread'):
+            if field in validated_data:
+                setattr(instance, field, validated_data[field])
         instance.save()
         return instance
@@ -1,23 +1,32 @@
 """
 Settings used specifically for django_messages_drf
 """
+from typing import Any
+
 # pragma: no cover
 from django.conf import settings
 from django.utils.module_loading import import_string
-from typing import Any
 
+from .pagination import (
+    MessageWindowPagination,
+    Pagination,
+    SearchCursorPagination,
+)
 from .serializers import (
     EditMessageSerializer,
+    GroupMessageSerializer,
     InboxSerializer,
+    SearchResultSerializer,
     SenderReceiverSerializer,
+    ThreadBatchSerializer,
+    ThreadReplySerializer,
     ThreadSerializer,
-    ThreadReplySerializer
 )
 
 
-def get_serializer_by_settings(default: Any, setting_name: str):
+def get_class_by_settings(default: Any, setting_name: str):
     """
-    Loads the serializer from the given settings or sets the default otherwise.
+    Loads the class from the given settings or sets the default otherwise.
     """
     path: str = None
 
@@ -31,9 +40,27 @@ def get_serializer_by_settings(default: Any, setting_name: str):
     except ImportError as e:  # pragma: no cover
         raise e
 
+
+def get_serializer_by_settings(default: Any, setting_name: str):
+    """
+    Loads the serializer from the given settings or sets the default otherwise.
+    """
+    return get_class_by_settings(default, setting_name)
+
 # Default settings for the serializers
 INBOX_SERIALIZER = get_serializer_by_settings(InboxSerializer, 'DJANGO_MESSAGES_DRF_INBOX_SERIALIZER')
 THREAD_SERIALIZER = get_serializer_by_settings(ThreadSerializer, 'DJANGO_MESSAGES_DRF_THREAD_SERIALIZER')
 THREAD_REPLY_SERIALIZER = get_serializer_by_settings(ThreadReplySerializer, 'DJANGO_MESSAGES_DRF_MESSAGE_SERIALIZER')
 EDIT_MESSAGE_SERIALIZER = get_serializer_by_settings(EditMessageSerializer, 'DJANGO_MESSAGES_DRF_EDIT_MESSAGE_SERIALIZER')
+GROUP_MESSAGE_SERIALIZER = get_serializer_by_settings(GroupMessageSerializer, 'DJANGO_MESSAGES_DRF_GROUP_MESSAGE_SERIALIZER')
+THREAD_BATCH_SERIALIZER = get_serializer_by_settings(ThreadBatchSerializer, 'DJANGO_MESSAGES_DRF_THREAD_BATCH_SERIALIZER')
+SEARCH_SERIALIZER = get_serializer_by_settings(SearchResultSerializer, 'DJANGO_MESSAGES_DRF_SEARCH_SERIALIZER')
 SENDER_RECEIVER_SERIALIZER = get_serializer_by_settings(SenderReceiverSerializer, 'DJANGO_MESSAGES_DRF_SENDER_RECEIVER_SERIALIZER')
+
+# Default settings for the pagination
+INBOX_PAGINATION = get_class_by_settings(Pagination, 'DJANGO_MESSAGES_DRF_INBOX_PAGINATION')
+THREAD_PAGINATION = get_class_by_settings(MessageWindowPagination, 'DJANGO_MESSAGES_DRF_THREAD_PAGINATION')
+SEARCH_PAGINATION = get_class_by_settings(SearchCursorPagination, 'DJANGO_MESSAGES_DRF_SEARCH_PAGINATION')
+
+# Default settings for the behaviours
+MAX_RECIPIENTS = getattr(settings, 'DJANGO_MESSAGES_DRF_MAX_RECIPIENTS', 5000)
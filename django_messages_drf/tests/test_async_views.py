@@ -0,0 +1,286 @@
+import asyncio
+import json
+import time
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.handlers.asgi import ASGIHandler
+from django.core.signals import request_started
+from django.db import close_old_connections
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+import django_messages_drf.tests.factories
+from asgiref.sync import async_to_sync
+
+from ..async_views import AsyncInboxListApiView, AsyncThreadListApiView
+from ..brokers import get_broker
+from ..cache import get_response_cache
+from ..instrumentation import get_sink
+from ..models import Message, Thread, UserThread
+from ..pagination import EstimatedCountPagination
+from ..serializers import ThreadSerializer
+
+
+class AsyncViewsTest(TestCase):
+
+    def setUp(self):
+        self.user = django_messages_drf.tests.factories.UserFactory()
+        self.other = django_messages_drf.tests.factories.UserFactory()
+        self.async_client.force_login(self.user)
+
+    def tearDown(self) -> None:
+        get_user_model().objects.all().delete()
+        Message.objects.all().delete()
+        UserThread.objects.all().delete()
+        Thread.objects.all().delete()
+
+    async def test_user_not_logged_in_cannot_access_inbox(self):
+        """If a user is not logged in, it cannot access an inbox url"""
+        self.async_client.cookies.clear()
+
+        response = await self.async_client.get(reverse("django_messages_drf_async:inbox"))
+
+        self.assertEqual(403, response.status_code)
+
+    async def test_can_get_inbox(self):
+        """The inbox is paginated with the async ORM"""
+        message = await Message.anew_message(self.other, [self.user], "subject", "content")
+
+        response = await self.async_client.get(reverse("django_messages_drf_async:inbox"))
+        data = json.loads(response.content)
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(1, data['count'])
+        self.assertEqual(str(message.thread.uuid), data['results'][0]['uuid'])
+        self.assertEqual([message.thread], await Thread.ainbox(self.user, limit=10))
+
+    def test_ainbox_fetches_a_page(self):
+        """Only the page of the inbox is fetched"""
+        threads = [Message.new_message(self.other, [self.user], f"subject {i}", "content").thread for i in range(3)]
+
+        with self.assertNumQueries(1) as queries:
+            page = async_to_sync(Thread.ainbox)(self.user, limit=2, offset=1)
+
+        self.assertEqual([threads[1], threads[0]], page)
+        self.assertIn('LIMIT 2', queries.captured_queries[0]['sql'])
+
+    @mock.patch.object(AsyncInboxListApiView, 'pagination_class', EstimatedCountPagination)
+    async def test_can_get_inbox_with_estimated_count(self):
+        await Message.anew_message(self.other, [self.user], "subject", "content")
+
+        response = await self.async_client.get(reverse("django_messages_drf_async:inbox"))
+        data = json.loads(response.content)
+
+        self.assertEqual(1, data['count'])
+        self.assertEqual(1, data['total_pages'])
+        self.assertFalse(data['next'])
+
+    @mock.patch.object(AsyncThreadListApiView, 'serializer_class', ThreadSerializer)
+    async def test_can_get_thread(self):
+        """The thread is returned with its messages"""
+        message = await Message.anew_message(self.other, [self.user], "subject", "content")
+        await Message.anew_reply(message.thread, self.user, "reply")
+        url = reverse("django_messages_drf_async:thread", kwargs={'uuid': message.thread.uuid})
+
+        response = await self.async_client.get(url)
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(["content", "reply"], [m['content'] for m in json.loads(response.content)['messages']])
+
+    async def test_thread_not_found(self):
+        """A thread that doesn't exist returns 404"""
+        url = reverse("django_messages_drf_async:thread", kwargs={'uuid': Message().uuid})
+
+        response = await self.async_client.get(url)
+
+        self.assertEqual(404, response.status_code)
+
+    async def test_can_create_and_reply_to_a_thread(self):
+        """A thread can be created and replied"""
+        url = reverse("django_messages_drf_async:thread-create", kwargs={'user_id': self.other.pk})
+
+        response = await self.async_client.post(url, {'subject': 'subject', 'message': 'hello'})
+        thread = await Thread.objects.aget(messages__uuid=json.loads(response.content)['uuid'])
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([thread], await Thread.ainbox(self.other, limit=10))
+
+        url = reverse("django_messages_drf_async:thread-send", kwargs={'uuid': thread.uuid, 'user_id': self.other.pk})
+        response = await self.async_client.post(url, {'subject': 'changed', 'message': 'again'})
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(2, await thread.messages.acount())
+        self.assertEqual('changed', (await Thread.objects.aget(pk=thread.pk)).subject)
+
+    async def test_returns_400_when_missing_message_param(self):
+        """If message not send, throws 400"""
+        url = reverse("django_messages_drf_async:thread-create", kwargs={'user_id': self.other.pk})
+
+        response = await self.async_client.post(url, {'subject': 'subject', 'message': ''})
+
+        self.assertEqual(400, response.status_code)
+        self.assertEqual(0, await Thread.objects.acount())
+
+    async def test_can_delete_a_thread(self):
+        """The thread is flagged as deleted for the user"""
+        message = await Message.anew_message(self.other, [self.user], "subject", "content")
+        url = reverse("django_messages_drf_async:thread-delete", kwargs={'uuid': message.thread.uuid})
+
+        response = await self.async_client.delete(url)
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([], await Thread.ainbox(self.user, limit=10))
+
+    async def test_can_edit_a_message(self):
+        """A user can edit its own message"""
+        message = await Message.anew_message(self.user, [self.other], "subject", "content")
+        url = reverse("django_messages_drf_async:message-edit", kwargs={
+            'user_id': self.user.pk, 'thread_id': message.thread_id
+        })
+
+        response = await self.async_client.put(
+            url, {'uuid': str(message.uuid), 'content': 'edited'}, content_type='application/json'
+        )
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('edited', (await Message.objects.aget(pk=message.pk)).content)
+
+    async def test_cannot_edit_a_message_of_another_user(self):
+        """The user of the url must be the logged in user"""
+        message = await Message.anew_message(self.other, [self.user], "subject", "content")
+        url = reverse("django_messages_drf_async:message-edit", kwargs={
+            'user_id': self.other.pk, 'thread_id': message.thread_id
+        })
+
+        response = await self.async_client.put(
+            url, {'uuid': str(message.uuid), 'content': 'edited'}, content_type='application/json'
+        )
+
+        self.assertEqual(403, response.status_code)
+
+
+@override_settings(
+    DJANGO_MESSAGES_DRF_RESPONSE_CACHE=True,
+    DJANGO_MESSAGES_DRF_CONDITIONAL_GET=True,
+    DJANGO_MESSAGES_DRF_INSTRUMENTATION=True,
+    DJANGO_MESSAGES_DRF_INSTRUMENTATION_SINK='django_messages_drf.instrumentation.MemorySink',
+)
+class AsyncViewsHelpersTest(TestCase):
+    """The async views are cached, answer conditional requests and are instrumented as the sync ones"""
+
+    def setUp(self):
+        self.user = django_messages_drf.tests.factories.UserFactory()
+        self.other = django_messages_drf.tests.factories.UserFactory()
+        self.thread = Message.new_message(self.other, [self.user], "subject", "content").thread
+        self.async_client.force_login(self.user)
+        self.inbox = reverse("django_messages_drf_async:inbox")
+        get_response_cache().cache.clear()
+        get_response_cache().reset_stats()
+        get_sink().clear()
+
+    async def test_inbox_is_cached_until_a_thread_is_deleted(self):
+        first = await self.async_client.get(self.inbox)
+        second = await self.async_client.get(self.inbox)
+
+        self.assertEqual(json.loads(first.content), json.loads(second.content))
+        self.assertEqual({'hits': 1, 'misses': 1}, get_response_cache().stats())
+
+        url = reverse("django_messages_drf_async:thread-delete", kwargs={'uuid': self.thread.uuid})
+        # The request runs in its own thread, the callbacks of its connection run right away
+        with mock.patch('django_messages_drf.cache.transaction.on_commit', lambda func, using=None: func()):
+            await self.async_client.delete(url)
+
+        self.assertEqual(0, json.loads((await self.async_client.get(self.inbox)).content)['count'])
+
+    @mock.patch.object(AsyncThreadListApiView, 'serializer_class', ThreadSerializer)
+    async def test_thread_not_modified(self):
+        url = reverse("django_messages_drf_async:thread", kwargs={'uuid': self.thread.uuid})
+
+        response = await self.async_client.get(url)
+        not_modified = await self.async_client.get(url, headers={'If-None-Match': response.headers['ETag']})
+
+        self.assertEqual(304, not_modified.status_code)
+        self.assertEqual(response.headers['ETag'], not_modified.headers['ETag'])
+
+    async def test_server_timing(self):
+        response = await self.async_client.get(self.inbox)
+
+        [metrics] = get_sink().records
+        self.assertEqual(('AsyncInboxListApiView', 200), (metrics.view, metrics.status))
+        self.assertGreater(metrics.queries, 0)
+        self.assertIn('paginate', metrics.timings)
+        self.assertIn('serialize', metrics.timings)
+        self.assertIn(f'desc="{metrics.queries} queries"', response.headers['Server-Timing'])
+
+
+class AsyncMessageStreamTest(TestCase):
+    """The stream is served by the ASGI handler as the events are published"""
+
+    def setUp(self):
+        self.user = django_messages_drf.tests.factories.UserFactory()
+        self.async_client.force_login(self.user)
+        self.url = reverse("django_messages_drf_async:stream")
+        self.event = {'type': 'message', 'thread': str(self.user.pk)}
+        # As the test client, the connection of the test case is kept by the requests
+        request_started.disconnect(close_old_connections)
+        self.addCleanup(request_started.connect, close_old_connections)
+
+    def get_scope(self, accept):
+        cookie = self.async_client.cookies.output(header='', sep=';').strip()
+        return {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+            'scheme': 'http', 'path': self.url, 'raw_path': self.url.encode(), 'query_string': b'',
+            'root_path': '', 'client': ('127.0.0.1', 1234), 'server': ('testserver', 80),
+            'headers': [(b'host', b'testserver'), (b'accept', accept), (b'cookie', cookie.encode())],
+        }
+
+    async def request(self, accept):
+        """Runs the request in the ASGI handler, returns the queue of the messages sent and the task"""
+        sent = asyncio.Queue()
+        requested = False
+
+        async def receive():
+            nonlocal requested
+            if not requested:
+                requested = True
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+            await asyncio.Event().wait()
+
+        task = asyncio.ensure_future(ASGIHandler()(self.get_scope(accept), receive, sent.put))
+        return sent, task
+
+    async def subscribed(self):
+        while str(self.user.pk) not in get_broker().subscriptions:
+            await asyncio.sleep(0.01)
+
+    async def next_body(self, sent):
+        message = await asyncio.wait_for(sent.get(), 5)
+        while message['type'] != 'http.response.body':
+            message = await asyncio.wait_for(sent.get(), 5)
+        return message
+
+    @override_settings(DJANGO_MESSAGES_DRF_STREAM_MAX_AGE=2, DJANGO_MESSAGES_DRF_STREAM_TIMEOUT=0.5)
+    async def test_events_are_streamed_before_the_max_age(self):
+        start = time.monotonic()
+        sent, task = await self.request(b'text/event-stream')
+
+        self.assertEqual(b': connected\n\n', (await self.next_body(sent))['body'])
+        get_broker().publish([self.user.pk], self.event)
+        body = await self.next_body(sent)
+
+        self.assertEqual(f"event: message\ndata: {json.dumps(self.event)}\n\n".encode(), body['body'])
+        self.assertTrue(body['more_body'])
+        self.assertLess(time.monotonic() - start, 2)
+
+        await asyncio.wait_for(task, 5)
+        self.assertEqual({}, get_broker().subscriptions)
+
+    @override_settings(DJANGO_MESSAGES_DRF_STREAM_TIMEOUT=5)
+    async def test_long_poll_returns_the_events(self):
+        sent, task = await self.request(b'application/json')
+        await asyncio.wait_for(self.subscribed(), 5)
+        get_broker().publish([self.user.pk], self.event)
+        await asyncio.wait_for(task, 5)
+
+        self.assertEqual({'events': [self.event]}, json.loads((await self.next_body(sent))['body']))
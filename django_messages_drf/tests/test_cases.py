@@ -1,9 +1,30 @@
+import os
+import tempfile
+import threading
+from datetime import timedelta
+
+from io import StringIO
+
 from django.contrib.auth import get_user_model
+from django.core.management import CommandError, call_command
+from django.db.models import QuerySet
+from django.db.models.functions import Length
 from django.test import override_settings, TestCase
+from asgiref.sync import async_to_sync
+from rest_framework import serializers
+from rest_framework.renderers import JSONRenderer
 
 import django_messages_drf.tests.factories
 
-from ..models import Message, Thread, UserThread
+from ..brokers import InProcessBroker, LocalSocketBroker, get_broker
+from ..dispatch import ThreadPoolBackend, synchronous
+from ..datasets import Distribution, generate_dataset
+from ..maintenance import archive_messages, purge_deleted_threads
+from ..models import ArchivedMessage, Message, Thread, UserThread
+from ..requirements import QueryRequirements
+from ..search import SimpleSearchBackend, SQLiteSearchBackend, get_search_backend
+from ..serializers import InboxSerializer, MessageSerializer, SenderReceiverSerializer
+from ..signals import message_sent
 
 
 class BaseTest(TestCase):
@@ -63,6 +84,46 @@ class TestMessages(BaseTest):
         self.assertEqual(Thread.unread(self.brosner).count(), 0)
         self.assertEqual(Thread.unread(self.jtauber).count(), 1)
 
+    def test_unread_counts_are_exact(self):
+        """
+        The unread messages are the ones after the read cursor of the user.
+        """
+        thread = Message.new_message(self.brosner, [self.jtauber], "Subject", "first").thread
+        second = Message.new_reply(thread, self.brosner, "second")
+        Message.new_reply(thread, self.brosner, "third")
+        thread = Thread.objects.get(pk=thread.pk)
+        user_thread = thread.userthread_set.get(user=self.jtauber)
+
+        self.assertEqual(3, thread.seq)
+        self.assertEqual(3, user_thread.unread_count)
+        self.assertEqual(3, thread.unread_messages(self.jtauber).count())
+        self.assertEqual(3, Thread.inbox(self.jtauber).with_inbox_data(self.jtauber).get().total_unread)
+        self.assertEqual("first", thread.first_unread_message(self.jtauber).content)
+
+        user_thread.last_read_seq = second.seq
+        user_thread.save()
+
+        self.assertEqual("third", thread.first_unread_message(self.jtauber).content)
+        self.assertEqual(1, thread.mark_read(self.jtauber))
+        self.assertIsNone(thread.first_unread_message(self.jtauber))
+        self.assertEqual(0, Thread.unread(self.jtauber).count())
+
+        Message.new_reply(thread, self.jtauber, "fourth")
+
+        self.assertEqual(1, Thread.inbox(self.brosner).with_inbox_data(self.brosner).get().total_unread)
+
+    def test_reply_restores_deleted_threads(self):
+        """
+        A reply brings the thread back to the inbox of the participants who deleted it.
+        """
+        thread = Message.new_message(self.brosner, [self.jtauber], "Subject", "first").thread
+        thread.userthread_set.filter(user=self.jtauber).update(deleted=True)
+
+        Message.new_reply(thread, self.brosner, "second")
+
+        self.assertEqual([thread], list(Thread.inbox(self.jtauber)))
+        self.assertEqual(2, thread.unread_messages(self.jtauber).count())
+
     def test_ordered(self):
         """
         Ensure Thread ordering is last-sent-first (LIFO).
@@ -77,3 +138,431 @@ class TestMessages(BaseTest):
             self.brosner, [self.jtauber], "Pwnt",
             "Haha I'm spamming your inbox").thread
         self.assertEqual(Thread.ordered([t2, t1, t3]), [t3, t2, t1])
+
+    def test_ordered_queryset(self):
+        """
+        Ordering a queryset is done by the database and keeps it lazy.
+        """
+        t1 = Message.new_message(self.brosner, [self.jtauber], "Subject", "A test message").thread
+        t2 = Message.new_message(self.brosner, [self.jtauber], "Another", "Another message").thread
+        Message.new_reply(t1, self.jtauber, "Bumping the first thread")
+
+        ordered = Thread.ordered(Thread.inbox(self.brosner))
+
+        self.assertNotIsInstance(ordered, list)
+        self.assertEqual(list(ordered), [t1])
+        self.assertEqual(list(Thread.ordered(Thread.inbox(self.jtauber))), [t1, t2])
+
+    def test_latest_activity_is_stored(self):
+        """
+        Sending and replying stores the latest message on the thread.
+        """
+        message = Message.new_message(self.brosner, [self.jtauber], "Subject", "A test message")
+        thread = Thread.objects.get(pk=message.thread.pk)
+
+        self.assertEqual(thread.last_sent_message, message)
+        self.assertEqual(thread.last_message_at, message.sent_at)
+
+        reply = Message.new_reply(thread, self.jtauber, "A reply")
+        thread = Thread.objects.get(pk=thread.pk)
+
+        self.assertEqual(thread.last_sent_message, reply)
+        self.assertEqual(thread.last_message_at, reply.sent_at)
+
+        thread = Thread.objects.get(pk=thread.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(thread.last_message(), reply)
+            self.assertEqual(thread.latest_message, reply)
+
+    def test_inbox_is_ordered_by_latest_activity(self):
+        """
+        The inbox is a lazy queryset ordered by the latest activity, including threads
+        without the stored value.
+        """
+        t1 = Message.new_message(self.brosner, [self.jtauber], "Subject", "A test message").thread
+        t2 = Message.new_message(self.brosner, [self.jtauber], "Another", "Another message").thread
+        Thread.objects.filter(pk=t2.pk).update(last_message_at=None, last_sent_message=None)
+        Message.new_reply(t1, self.jtauber, "Bumping the first thread")
+
+        inbox = Thread.inbox(self.jtauber)
+
+        self.assertIsInstance(inbox, QuerySet)
+        self.assertEqual(list(inbox), [t1, t2])
+        self.assertEqual(list(inbox[1:2]), [t2])
+        self.assertEqual(inbox[1].latest_activity, t2.latest_message.sent_at)
+
+    def test_inbox_data_matches_the_thread_methods(self):
+        """
+        The annotations of the inbox render the same as the per thread methods.
+        """
+        thread = Message.new_message(self.brosner, [self.jtauber], "Subject", "A" * 60).thread
+        Message.new_reply(thread, self.brosner, "A reply from the creator")
+        Message.new_message(self.brosner, [self.jtauber], "Another", "Another message")
+        context = {'user': self.jtauber}
+
+        expected = InboxSerializer(Thread.inbox(self.jtauber), many=True, context=context).data
+        annotated = Thread.inbox(self.jtauber).with_inbox_data(self.jtauber)
+        with self.assertNumQueries(1):
+            data = InboxSerializer(annotated, many=True, context=context).data
+
+        self.assertEqual(expected, data)
+        self.assertEqual(data[0]['total_unread'], 1)
+        self.assertEqual(data[1]['last_message'], "A reply from the creator")
+
+    def test_message_serializer_renders_as_drf(self):
+        """The messages are rendered byte for byte as the generic serializers of DRF, the senders in one query"""
+        thread = Message.new_message(self.brosner, [self.jtauber], "Subject", "Hello").thread
+        Message.new_reply(thread, self.jtauber, "Hi")
+        Message.new_reply(thread, self.brosner, "Bye")
+        messages = list(Message.objects.filter(thread=thread).order_by('sent_at', 'pk'))
+        context = {'user': self.jtauber}
+
+        with self.assertNumQueries(1):
+            data = MessageSerializer(messages, many=True, context=context).data
+
+        reference = MessageSerializer(context={'user': self.jtauber})
+        sender = SenderReceiverSerializer(context=reference.context)
+        reference.get_sender = lambda instance: serializers.ModelSerializer.to_representation(sender, instance.sender)
+        expected = [serializers.ModelSerializer.to_representation(reference, message) for message in messages]
+
+        self.assertEqual(JSONRenderer().render(expected), JSONRenderer().render(data))
+        self.assertIs(data[0]['sender'], data[2]['sender'])
+        self.assertEqual(data[1]['sender'], {'display_name': f"{self.jtauber.first_name} {self.jtauber.last_name}", 'is_user': True})
+
+
+class TestBrokers(BaseTest):
+
+    def test_message_sent_is_published_on_commit(self):
+        """The participants receive the event once the transaction is committed"""
+        with get_broker().subscribe(self.jtauber.pk) as subscription:
+            with self.captureOnCommitCallbacks() as callbacks:
+                message = Message.new_message(self.brosner, [self.jtauber], "Subject", "Hello")
+
+            self.assertIsNone(subscription.get(timeout=0))
+
+            for callback in callbacks:
+                callback()
+            event = subscription.get(timeout=0)
+
+        self.assertEqual(str(message.thread.uuid), event['thread'])
+        self.assertEqual(str(message.uuid), event['message'])
+        self.assertFalse(event['reply'])
+
+    def test_in_process_broker(self):
+        """The events are delivered to the subscriptions of the users only"""
+        broker = InProcessBroker()
+
+        with broker.subscribe(1) as first, broker.subscribe(2) as second:
+            broker.publish([1], {'type': 'message'})
+
+            self.assertEqual({'type': 'message'}, first.get(timeout=0))
+            self.assertIsNone(second.get(timeout=0))
+
+        self.assertEqual({}, broker.subscriptions)
+
+    def test_local_socket_broker(self):
+        """The events are delivered through the sockets of the directory"""
+        with tempfile.TemporaryDirectory() as directory:
+            broker = LocalSocketBroker(directory=directory)
+            open(os.path.join(directory, "1.stale.sock"), "w").close()
+
+            with broker.subscribe(1) as first, broker.subscribe(12) as second:
+                broker.publish([1], {'type': 'message'})
+
+                self.assertEqual({'type': 'message'}, first.get(timeout=1))
+                self.assertIsNone(second.get(timeout=0))
+
+            self.assertEqual([], os.listdir(directory))
+
+    def test_subscriptions_are_awaited(self):
+        """`aget` returns the events published from another thread, None on timeout"""
+        with tempfile.TemporaryDirectory() as directory:
+            for broker in (InProcessBroker(), LocalSocketBroker(directory=directory)):
+                with broker.subscribe(1) as subscription:
+                    publisher = threading.Timer(0.05, broker.publish, [[1], {'type': 'message'}])
+                    publisher.start()
+
+                    self.assertEqual({'type': 'message'}, async_to_sync(subscription.aget)(timeout=5))
+                    self.assertIsNone(async_to_sync(subscription.aget)(timeout=0.01))
+                    publisher.join()
+
+
+class TestDispatch(BaseTest):
+
+    def connect(self, receiver):
+        message_sent.connect(receiver, weak=False)
+        self.addCleanup(message_sent.disconnect, receiver)
+        return receiver
+
+    @override_settings(DJANGO_MESSAGES_DRF_SIGNAL_DISPATCH='on_commit')
+    def test_receivers_run_on_commit(self):
+        """The receivers are deferred to the commit unless they are synchronous"""
+        calls = []
+        self.connect(lambda sender, reply, **kwargs: calls.append(('deferred', reply)))
+        self.connect(synchronous(lambda sender, reply, **kwargs: calls.append(('synchronous', reply))))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Message.new_message(self.brosner, [self.jtauber], "Subject", "Hello")
+
+            self.assertEqual([('synchronous', False)], calls)
+
+        self.assertEqual([('synchronous', False), ('deferred', False)], calls)
+
+    @override_settings(
+        DJANGO_MESSAGES_DRF_SIGNAL_DISPATCH='deferred',
+        DJANGO_MESSAGES_DRF_SIGNAL_BACKEND='django_messages_drf.dispatch.ImmediateBackend',
+    )
+    def test_failing_receiver_is_isolated(self):
+        """A receiver failing is logged and the others still run"""
+        calls = []
+
+        def failing(sender, **kwargs):
+            raise ValueError("failed")
+
+        self.connect(failing)
+        self.connect(lambda sender, message, **kwargs: calls.append(message))
+
+        with self.assertLogs('django_messages_drf.dispatch', level='DEBUG') as logs:
+            with self.captureOnCommitCallbacks(execute=True):
+                message = Message.new_message(self.brosner, [self.jtauber], "Subject", "Hello")
+
+        self.assertEqual([message], calls)
+        self.assertTrue(any('failed' in line and 'ValueError' in line for line in logs.output))
+        self.assertTrue(any('took' in line for line in logs.output))
+
+    def test_thread_pool_backend(self):
+        """The dispatch runs on the pool, or in the current thread once the queue is full"""
+        backend = ThreadPoolBackend(max_workers=1, max_pending=1)
+        started, release = threading.Event(), threading.Event()
+        threads = []
+
+        def blocking():
+            started.set()
+            release.wait(5)
+
+        future = backend.submit(blocking)
+        started.wait(5)
+        with self.assertLogs('django_messages_drf.dispatch', level='WARNING'):
+            backend.submit(lambda: threads.append(threading.current_thread()))
+        release.set()
+        future.result(5)
+
+        self.assertEqual([threading.current_thread()], threads)
+        self.assertTrue(backend.slots.acquire(blocking=False))
+
+
+class TestSearch(BaseTest):
+
+    def test_backend_of_the_database(self):
+        """The FTS5 backend is used on SQLite"""
+        self.assertIsInstance(get_search_backend(), SQLiteSearchBackend)
+
+    def test_simple_backend(self):
+        """The fallback backend searches the content and the subjects of the threads of the user"""
+        thread = Message.new_message(self.brosner, [self.jtauber], "Release", "Shipping today").thread
+        reply = Message.new_reply(thread, self.jtauber, "Shipping tomorrow")
+        Message.new_message(self.brosner, [django_messages_drf.tests.factories.UserFactory()], "Other", "Shipping")
+        results = SimpleSearchBackend().search(self.jtauber, "shipping")
+
+        self.assertEqual([reply, thread.first_message], results.fetch(10))
+        self.assertEqual([thread.first_message], results.fetch(10, after=(0.0, reply.pk)))
+        self.assertEqual([thread.first_message], SimpleSearchBackend().search(self.jtauber, "release").fetch(10))
+
+    def test_simple_backend_skips_the_archived_messages(self):
+        """The subject of a thread is found on its oldest message not archived"""
+        thread = Message.new_message(self.brosner, [self.jtauber], "Release", "Shipping today").thread
+        reply = Message.new_reply(thread, self.jtauber, "Shipping tomorrow")
+        thread.messages.filter(seq=1).update(sent_at=reply.sent_at - timedelta(days=40))
+        archive_messages(older_than=timedelta(days=30))
+
+        self.assertEqual([reply], SimpleSearchBackend().search(self.jtauber, "shipping").fetch(10))
+        self.assertEqual([reply], SimpleSearchBackend().search(self.jtauber, "release").fetch(10))
+
+    def test_rebuild_message_index(self):
+        """The command indexes the rows inserted without save()"""
+        thread = Thread.objects.create(subject="Imported")
+        UserThread.objects.create(thread=thread, user=self.brosner, deleted=False)
+        Message.objects.bulk_create([
+            Message(thread=thread, sender=self.brosner, content=f"Imported message {i}", seq=i + 1)
+            for i in range(3)
+        ])
+        results = get_search_backend().search(self.brosner, "imported")
+
+        self.assertEqual([], results.fetch(10))
+
+        out = StringIO()
+        call_command('rebuild_message_index', batch_size=2, stdout=out)
+
+        self.assertEqual(3, len(results.fetch(10)))
+        self.assertIn("Indexed 1 threads and 3 messages", out.getvalue())
+
+
+class TestArchive(BaseTest):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.thread = Message.new_message(self.brosner, [self.jtauber], "Subject", "first").thread
+        self.replies = [Message.new_reply(self.thread, self.jtauber, f"reply {i}") for i in range(4)]
+        Message.objects.filter(pk__in=[self.thread.first_message.pk, self.replies[0].pk]).update(
+            sent_at=self.replies[0].sent_at - timedelta(days=40)
+        )
+
+    def test_archives_the_old_messages(self):
+        """The messages older than the age are moved in batches, keeping their ids"""
+        first = self.thread.first_message
+
+        self.assertEqual(2, archive_messages(older_than=timedelta(days=30), batch_size=1))
+        self.assertEqual(3, self.thread.messages.count())
+        self.assertEqual([first.pk, self.replies[0].pk], list(ArchivedMessage.objects.order_by('pk').values_list('pk', flat=True)))
+        self.assertEqual(0, archive_messages(older_than=timedelta(days=30)))
+
+        thread = Thread.objects.get(pk=self.thread.pk)
+        inbox = Thread.inbox(self.brosner).with_inbox_data(self.brosner).get()
+
+        self.assertEqual(first.uuid, thread.first_message.uuid)
+        self.assertEqual(first.sent_at, inbox.first_message_at)
+        self.assertTrue(thread.is_user_first_message(self.brosner))
+
+    def test_keeps_the_latest_message(self):
+        """The threads idle are archived but their latest message"""
+        archived = archive_messages(idle_for=timedelta(0), batch_size=2, max_batches=1)
+
+        self.assertEqual(2, archived)
+        self.assertEqual(4, archive_messages(idle_for=timedelta(0)) + archived)
+        self.assertEqual([self.replies[-1]], list(self.thread.messages.all()))
+        self.assertEqual(self.replies[-1], Thread.objects.get(pk=self.thread.pk).last_message())
+
+    def test_archive_messages_command(self):
+        """The command requires an age and archives with it"""
+        out = StringIO()
+
+        with self.assertRaises(CommandError):
+            call_command('archive_messages', stdout=out)
+
+        call_command('archive_messages', older_than=30, stdout=out)
+
+        self.assertIn("Archived 2 messages", out.getvalue())
+
+
+class TestPurge(BaseTest):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.threads = []
+        for i in range(3):
+            thread = Message.new_message(self.brosner, [self.jtauber], f"Subject {i}", "first").thread
+            Message.new_reply(thread, self.jtauber, "reply")
+            self.threads.append(thread)
+        archive_messages(idle_for=timedelta(0))
+        UserThread.objects.filter(thread__in=self.threads[:2]).update(deleted=True)
+        self.threads[2].userthread_set.filter(user=self.brosner).update(deleted=True)
+
+    def test_dry_run_reports_the_counts(self):
+        """Nothing is deleted on a dry run"""
+        totals = purge_deleted_threads(dry_run=True)
+
+        self.assertEqual({'threads': 2, 'messages': 2, 'archived_messages': 2, 'user_threads': 4}, totals)
+        self.assertEqual(3, Thread.objects.count())
+
+    def test_purges_the_threads_deleted_by_everyone(self):
+        """The threads deleted by all the participants are removed in chunks"""
+        throttled = []
+
+        totals = purge_deleted_threads(chunk_size=1, throttle=lambda: throttled.append(True))
+
+        self.assertEqual({'threads': 2, 'messages': 2, 'archived_messages': 2, 'user_threads': 4}, totals)
+        self.assertEqual([self.threads[2]], list(Thread.objects.all()))
+        self.assertEqual(1, Message.objects.count())
+        self.assertEqual(1, ArchivedMessage.objects.count())
+        self.assertEqual(2, len(throttled))
+
+    def test_purge_deleted_threads_command(self):
+        """The command stops after the given chunks"""
+        out = StringIO()
+
+        call_command('purge_deleted_threads', max_chunks=1, chunk_size=1, stdout=out)
+
+        self.assertIn("Deleted 1 threads, 1 messages, 1 archived messages and 2 participants", out.getvalue())
+        self.assertEqual(2, Thread.objects.count())
+
+
+class TestDataset(BaseTest):
+
+    def snapshot(self):
+        return (
+            list(Thread.objects.order_by('pk').values_list('subject', 'seq')),
+            list(UserThread.objects.order_by('pk').values_list('user__username', 'deleted', 'last_read_seq')),
+            list(Message.objects.order_by('pk').values_list('sender__username', 'seq', 'content')),
+        )
+
+    def test_distributions(self):
+        """Constants, ranges and weighted values"""
+        self.assertEqual([3], Distribution.parse('3').values)
+        self.assertEqual([2, 3, 4], Distribution.parse('2-4').values)
+        weighted = Distribution.parse('2:70,10:30')
+        self.assertEqual(([2, 10], [70, 30]), (weighted.values, weighted.weights))
+        with self.assertRaises(ValueError):
+            Distribution.parse('many')
+
+    def test_generates_consistent_threads(self):
+        """The messages are numbered, the latest one is stored and the cursors are in range"""
+        totals = generate_dataset(
+            users=5, threads=7, participants='2-3', messages='1-5', unread_ratio=0.5, deleted_ratio=0.5, batch_size=3
+        )
+
+        self.assertEqual(7, totals['threads'])
+        self.assertEqual(totals['messages'], Message.objects.count())
+        self.assertEqual(totals['user_threads'], UserThread.objects.count())
+        for thread in Thread.objects.all():
+            self.assertEqual(list(range(1, thread.seq + 1)), list(thread.messages.order_by('seq').values_list('seq', flat=True)))
+            self.assertEqual(thread.seq, thread.last_sent_message.seq)
+            self.assertEqual(thread.last_message_at, thread.last_sent_message.sent_at)
+            for user_thread in thread.userthread_set.all():
+                self.assertLessEqual(user_thread.last_read_seq, thread.seq)
+
+    def test_the_seed_is_deterministic(self):
+        """The same seed generates the same rows"""
+        generate_dataset(users=4, threads=5, messages='1-4', seed=7)
+        first = self.snapshot()
+        self.tearDown()
+
+        generate_dataset(users=4, threads=5, messages='1-4', seed=7)
+
+        self.assertEqual(first, self.snapshot())
+
+    def test_generate_messages_dataset_command(self):
+        out = StringIO()
+
+        call_command('generate_messages_dataset', users=3, threads=2, messages='2', stdout=out)
+
+        self.assertIn("Generated 3 users, 2 threads, 4 participants and 4 messages", out.getvalue())
+        with self.assertRaises(CommandError):
+            call_command('generate_messages_dataset', users=1, threads=1, stdout=out)
+
+
+class TestQueryRequirements(BaseTest):
+
+    def test_merge_and_nest(self):
+        sender = QueryRequirements(select_related=('profile',), prefetch_related=('groups',), only=('username',))
+        merged = sender.nest('sender') | QueryRequirements(
+            select_related=('thread', 'sender'), annotations={'length': Length('content')},
+            related={'archived': QueryRequirements(select_related=('sender',))},
+        )
+
+        self.assertEqual(('sender', 'sender__profile', 'thread'), merged.select_related)
+        self.assertEqual(('sender__groups',), merged.prefetch_related)
+        self.assertIsNone(merged.only)
+        self.assertEqual(['length'], list(merged.get_annotations()))
+        self.assertEqual(('sender',), merged.related['archived'].select_related)
+
+    def test_apply(self):
+        Message.new_message(self.brosner, [self.jtauber], "Subject", "Hello")
+        requirements = QueryRequirements(
+            select_related=('sender',), annotations=lambda context: {'length': Length('content')},
+            only=('content',)
+        )
+
+        with self.assertNumQueries(1):
+            message = requirements.apply(Message.objects.all()).get()
+            self.assertEqual((5, self.brosner.username), (message.length, message.sender.username))
+        self.assertEqual({'sent_at', 'uuid', 'seq', 'thread_id'}, message.get_deferred_fields())
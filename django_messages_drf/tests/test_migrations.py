@@ -0,0 +1,60 @@
+from datetime import timedelta
+
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TransactionTestCase
+from django.utils import timezone
+
+
+class MigrationTest(TransactionTestCase):
+    """Runs the migrations of the package over existing rows"""
+    app = 'django_messages_drf'
+
+    def migrate(self, name):
+        executor = MigrationExecutor(connection)
+        target = [(self.app, name)]
+        executor.migrate(target)
+        executor.loader.build_graph()
+        return executor.loader.project_state(target).apps
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes(self.app))
+
+    def test_threads_are_created_after_the_audit_fields_migration(self):
+        apps = self.migrate('0003_indexes')
+        Thread = apps.get_model(self.app, 'Thread')
+        ids = [Thread.objects.create(subject=f"Subject {i}").pk for i in range(3)]
+
+        apps = self.migrate('0004_thread_audit_fields')
+        Thread = apps.get_model(self.app, 'Thread')
+        thread = Thread.objects.create(subject="New")
+
+        self.assertEqual(ids, list(Thread.objects.filter(pk__in=ids).order_by('pk').values_list('pk', flat=True)))
+        self.assertGreater(thread.pk, max(ids))
+
+    def test_messages_are_numbered_by_the_order_they_were_sent(self):
+        apps = self.migrate('0004_thread_audit_fields')
+        User = apps.get_model('auth', 'User')
+        Thread = apps.get_model(self.app, 'Thread')
+        Message = apps.get_model(self.app, 'Message')
+        UserThread = apps.get_model(self.app, 'UserThread')
+        user = User.objects.create(username='numbered')
+        now = timezone.now()
+        threads = [Thread.objects.create(subject=f"Subject {i}") for i in range(2)]
+        UserThread.objects.create(thread=threads[0], user=user, unread=False, deleted=False)
+        messages = [
+            Message.objects.create(thread=threads[0], sender=user, content=str(i), sent_at=now + timedelta(seconds=offset))
+            for i, offset in enumerate((2, 1, 2))
+        ]
+
+        apps = self.migrate('0005_read_cursors')
+        Thread = apps.get_model(self.app, 'Thread')
+        Message = apps.get_model(self.app, 'Message')
+        UserThread = apps.get_model(self.app, 'UserThread')
+
+        self.assertEqual(
+            [2, 1, 3], [Message.objects.get(pk=message.pk).seq for message in messages]
+        )
+        self.assertEqual([3, 0], [Thread.objects.get(pk=thread.pk).seq for thread in threads])
+        self.assertEqual(3, UserThread.objects.get(user_id=user.pk).last_read_seq)
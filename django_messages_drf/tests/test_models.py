@@ -23,6 +23,14 @@ class MessageModelTestCase(BaseTest):
 
         self.assertIsNotNone(thread)
 
+    def test_thread_is_a_single_table(self):
+        """The audit fields live in the thread table"""
+        with self.assertNumQueries(1):
+            thread = Thread.objects.create(subject="subject")
+
+        self.assertIsNotNone(thread.created_at)
+        self.assertNotIn("JOIN", str(Thread.objects.all().query))
+
     def test_can_create_message(self):
         """System can create a message"""
         message = django_messages_drf.tests.factories.MessageFactory()
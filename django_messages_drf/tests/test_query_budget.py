@@ -0,0 +1,226 @@
+"""
+Query budgets of the endpoints of `urls.py`.
+
+Every endpoint is requested against datasets of different sizes and must stay within a fixed
+number of queries, regardless of the number of threads, messages or participants. A failure
+lists the queries grouped by the line of the package that issued them.
+"""
+import json
+import traceback
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import timedelta
+from pathlib import Path
+from unittest import mock
+
+import django.db
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+import django_messages_drf.views
+
+from ..models import Message, Thread, UserThread
+from ..search import get_search_backend
+from ..serializers import ThreadSerializer
+from .utils import GroupSenderSerializer
+
+PACKAGE = Path(__file__).resolve().parent.parent
+TESTS = Path(__file__).resolve().parent
+ORM = Path(django.db.__file__).resolve().parent
+
+
+def seed(users, threads, messages, participants):
+    """
+    Inserts `threads` threads of `messages` messages each between `participants` of the `users`.
+    The first user participates in every thread. Returns the users and the threads.
+    """
+    User = get_user_model()
+    people = User.objects.bulk_create([
+        User(username=f"budget-{i}", first_name="Budget", last_name=str(i)) for i in range(users)
+    ])
+    now = timezone.now()
+    subjects = [f"Subject {i}" for i in range(threads)]
+    Thread.objects.bulk_create([Thread(subject=subject, seq=messages) for subject in subjects])
+    rows = list(Thread.objects.filter(subject__in=subjects).order_by('pk'))
+
+    user_threads, thread_messages = [], []
+    for i, thread in enumerate(rows):
+        members = [people[0], *[people[(i + j) % (users - 1) + 1] for j in range(participants - 1)]]
+        user_threads.extend(
+            UserThread(thread=thread, user=user, deleted=False, last_read_seq=messages // 2) for user in members
+        )
+        thread_messages.extend(
+            Message(
+                thread=thread, sender=members[seq % len(members)], seq=seq + 1,
+                sent_at=now - timedelta(minutes=messages - seq), content=f"Message {seq} of the thread {i}"
+            ) for seq in range(messages)
+        )
+    UserThread.objects.bulk_create(user_threads)
+    Message.objects.bulk_create(thread_messages)
+    for thread in rows:
+        thread.set_last_message(thread.messages.order_by('-sent_at', '-pk').first())
+    return people, rows
+
+
+class QueryRecorder:
+    """
+    Records the queries with the line issuing them, the innermost line of the package or
+    otherwise the caller of the ORM.
+    """
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries.append((self.get_call_site(), sql))
+        return execute(sql, params, many, context)
+
+    def get_call_site(self):
+        caller = None
+        for frame in reversed(traceback.extract_stack()[:-2]):
+            path = Path(frame.filename).resolve()
+            if PACKAGE in path.parents and TESTS not in path.parents:
+                return f"{path.relative_to(PACKAGE.parent)}:{frame.lineno} in {frame.name}"
+            if caller is None and ORM not in path.parents:
+                caller = f"{path}:{frame.lineno} in {frame.name}"
+        return caller
+
+    def report(self):
+        sites = defaultdict(list)
+        for site, sql in self.queries:
+            sites[site].append(sql)
+        lines = []
+        for site, statements in sorted(sites.items(), key=lambda item: -len(item[1])):
+            lines.append(f"{len(statements)}x {site}")
+            lines.extend(f"    {sql}" for sql in dict.fromkeys(statements))
+        return "\n".join(lines)
+
+
+class QueryBudgetMixin:
+    """
+    The datasets are given by `DATASET` as (users, threads, messages per thread, participants
+    per thread). `BUDGETS` is the maximum number of queries of each url name, including the
+    session, the user and the callbacks run on commit.
+    """
+    DATASET = None
+    BUDGETS = {
+        'inbox': 4,
+        'inbox-group-sender': 5,
+        'thread': 8,
+        'thread-create': 14,
+        'thread-group-create': 14,
+        'thread-send': 18,
+        'thread-delete': 4,
+        'thread-batch': 3,
+        'message-edit': 10,
+        'search': 4,
+        'stream': 2,
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users, cls.threads = seed(*cls.DATASET)
+        cls.user = cls.users[0]
+        cls.thread = cls.threads[0]
+        get_search_backend().clear()
+        get_search_backend().index_threads(cls.threads)
+        get_search_backend().index_messages(Message.objects.all())
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    @contextmanager
+    def assertQueryBudget(self, name):
+        recorder = QueryRecorder()
+        with connection.execute_wrapper(recorder), self.captureOnCommitCallbacks(execute=True):
+            yield
+        budget = self.BUDGETS[name]
+        if len(recorder.queries) > budget:
+            self.fail(
+                f"{name} issued {len(recorder.queries)} queries, over the budget of {budget}, with "
+                f"{self.DATASET} (users, threads, messages, participants):\n{recorder.report()}"
+            )
+
+    @mock.patch('django_messages_drf.settings.SENDER_RECEIVER_SERIALIZER', GroupSenderSerializer)
+    def test_inbox_with_a_swapped_sender_serializer(self):
+        """The requirements of the sender serializer are applied to the senders of the inbox"""
+        with self.assertQueryBudget('inbox-group-sender'):
+            response = self.client.get(reverse("django_messages_drf:inbox"))
+        results = response.json()['results']
+        self.assertTrue(results)
+        self.assertEqual({'username', 'groups'}, set(results[0]['sender']))
+
+    def test_inbox(self):
+        with self.assertQueryBudget('inbox'):
+            response = self.client.get(reverse("django_messages_drf:inbox"))
+        self.assertEqual(min(len(self.threads), 50), len(response.json()['results']))
+
+    @mock.patch.object(django_messages_drf.views.ThreadListApiView, 'serializer_class', ThreadSerializer)
+    def test_thread(self):
+        url = reverse("django_messages_drf:thread", kwargs={'uuid': self.thread.uuid})
+        with self.assertQueryBudget('thread'):
+            response = self.client.get(f"{url}?around=unread")
+        self.assertTrue(response.json()['messages'])
+
+    def test_thread_create(self):
+        url = reverse("django_messages_drf:thread-create", kwargs={'user_id': self.users[1].pk})
+        with self.assertQueryBudget('thread-create'):
+            response = self.client.post(url, {'subject': "Budget", 'message': "Hello"})
+        self.assertEqual(200, response.status_code)
+
+    def test_thread_group_create(self):
+        url = reverse("django_messages_drf:thread-group-create")
+        recipients = [str(user.pk) for user in self.users[1:]]
+        with self.assertQueryBudget('thread-group-create'):
+            response = self.client.post(
+                url, {'subject': "Budget", 'message': "Hello", 'recipients': recipients}, content_type='application/json'
+            )
+        self.assertEqual(200, response.status_code)
+
+    def test_thread_send(self):
+        url = reverse("django_messages_drf:thread-send", kwargs={'uuid': self.thread.uuid, 'user_id': self.users[1].pk})
+        with self.assertQueryBudget('thread-send'):
+            response = self.client.post(url, {'subject': "Budget", 'message': "Hello"})
+        self.assertEqual(200, response.status_code)
+
+    def test_thread_delete(self):
+        url = reverse("django_messages_drf:thread-delete", kwargs={'uuid': self.thread.uuid})
+        with self.assertQueryBudget('thread-delete'):
+            response = self.client.delete(url)
+        self.assertEqual(200, response.status_code)
+
+    def test_thread_batch(self):
+        url = reverse("django_messages_drf:thread-batch")
+        threads = [str(thread.uuid) for thread in self.threads]
+        with self.assertQueryBudget('thread-batch'):
+            response = self.client.post(url, {'action': 'read', 'threads': threads}, content_type='application/json')
+        self.assertEqual(len(self.threads), response.json()['count'])
+
+    def test_message_edit(self):
+        message = self.thread.messages.filter(sender=self.user).first()
+        url = reverse("django_messages_drf:message-edit", kwargs={'user_id': self.user.pk, 'thread_id': self.thread.pk})
+        with self.assertQueryBudget('message-edit'):
+            response = self.client.put(url, {'uuid': str(message.uuid), 'content': "Edited"}, content_type='application/json')
+        self.assertEqual(200, response.status_code)
+
+    def test_search(self):
+        with self.assertQueryBudget('search'):
+            response = self.client.get(f"{reverse('django_messages_drf:search')}?q=thread")
+        self.assertTrue(response.json()['results'])
+
+    @override_settings(DJANGO_MESSAGES_DRF_STREAM_TIMEOUT=0)
+    def test_stream(self):
+        with self.assertQueryBudget('stream'):
+            response = self.client.get(reverse("django_messages_drf:stream"))
+        self.assertEqual({'events': []}, json.loads(response.content))
+
+
+class SmallDatasetQueryBudgetTest(QueryBudgetMixin, TestCase):
+    DATASET = (3, 2, 3, 2)
+
+
+class LargeDatasetQueryBudgetTest(QueryBudgetMixin, TestCase):
+    DATASET = (30, 60, 40, 12)
@@ -1,10 +1,19 @@
 import json
+import re
+import threading
+import time
 import uuid
+from datetime import timedelta
+from unittest import mock
 
 from django.contrib.auth import get_user_model
-from django.db import transaction
-from django.test import RequestFactory, TestCase
+from django.contrib.auth.models import Group
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils.http import http_date
 
 import django_messages_drf.tests.factories
 import django_messages_drf.tests.utils
@@ -13,7 +22,22 @@ from django_downloadview.test import setup_view
 from django_webtest import WebTest
 from rest_framework.exceptions import ValidationError
 
+from ..brokers import get_broker
+from ..cache import get_response_cache, invalidate_users
+from ..instrumentation import (
+    CallableSink,
+    LoggingSink,
+    RequestMetrics,
+    get_sink,
+)
+from ..maintenance import archive_messages
 from ..models import Message, Thread, UserThread
+from ..pagination import (
+    CursorPagination,
+    EstimatedCountPagination,
+    NoCountPagination,
+)
+from ..search import get_search_backend
 from ..serializers import InboxSerializer, ThreadSerializer
 
 
@@ -43,6 +67,121 @@ class BaseTest(WebTest):
 
         self.assertEqual(200, response.status_code)
 
+    @override_settings(REST_FRAMEWORK={'PAGE_SIZE': 2})
+    def test_inbox_fetches_only_the_page(self):
+        """The inbox is paginated by the database, newest activity first"""
+        user = django_messages_drf.tests.factories.UserFactory()
+        sender = django_messages_drf.tests.factories.UserFactory()
+        threads = [
+            Message.new_message(sender, [user], f"subject {i}", "content").thread for i in range(3)
+        ]
+        url = reverse("django_messages_drf:inbox")
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.app.get(url, user=user)
+
+        data = json.loads(response.content)
+        page_queries = [q['sql'] for q in queries if re.search(r'LIMIT 2\b', q['sql'])]
+
+        self.assertEqual(3, data['count'])
+        self.assertEqual([str(t.uuid) for t in threads[:0:-1]], [r['uuid'] for r in data['results']])
+        self.assertEqual(1, len(page_queries))
+
+    @override_settings(REST_FRAMEWORK={'PAGE_SIZE': 2})
+    def test_inbox_cursor_pagination(self):
+        """The inbox can be paginated with opaque cursors keyed on the latest activity"""
+        user = django_messages_drf.tests.factories.UserFactory()
+        sender = django_messages_drf.tests.factories.UserFactory()
+        threads = [
+            Message.new_message(sender, [user], f"subject {i}", "content").thread for i in range(5)
+        ]
+        url = reverse("django_messages_drf:inbox")
+
+        uuids = []
+        with mock.patch.object(django_messages_drf.views.InboxListApiView, 'pagination_class', CursorPagination):
+            while url:
+                data = json.loads(self.app.get(url, user=user).content)
+                uuids.extend(result['uuid'] for result in data['results'])
+                url = data['links']['next']
+
+                self.assertIsNone(data['count'])
+                self.assertIsNone(data['total_pages'])
+
+        self.assertEqual([str(t.uuid) for t in reversed(threads)], uuids)
+
+    @override_settings(REST_FRAMEWORK={'PAGE_SIZE': 2})
+    def test_inbox_cursor_pagination_with_the_same_activity(self):
+        """Threads with the same latest activity are neither skipped nor repeated, both ways"""
+        user = django_messages_drf.tests.factories.UserFactory()
+        sender = django_messages_drf.tests.factories.UserFactory()
+        threads = [
+            Message.new_message(sender, [user], f"subject {i}", "content").thread for i in range(5)
+        ]
+        Thread.objects.update(last_message_at=threads[0].last_message_at)
+        url = reverse("django_messages_drf:inbox")
+
+        pages = []
+        with mock.patch.object(django_messages_drf.views.InboxListApiView, 'pagination_class', CursorPagination):
+            while url:
+                data = json.loads(self.app.get(url, user=user).content)
+                pages.append([result['uuid'] for result in data['results']])
+                url = data['links']['next']
+
+            previous = [result['uuid'] for result in json.loads(
+                self.app.get(data['links']['previous'], user=user).content
+            )['results']]
+
+        self.assertEqual([str(t.uuid) for t in reversed(threads)], sum(pages, []))
+        self.assertEqual(pages[-2], previous)
+
+    @override_settings(REST_FRAMEWORK={'PAGE_SIZE': 2})
+    def test_inbox_cursor_pagination_does_not_shift(self):
+        """A message arriving while the inbox is paged doesn't repeat the threads already seen"""
+        user = django_messages_drf.tests.factories.UserFactory()
+        sender = django_messages_drf.tests.factories.UserFactory()
+        threads = [
+            Message.new_message(sender, [user], f"subject {i}", "content").thread for i in range(5)
+        ]
+        url = reverse("django_messages_drf:inbox")
+
+        with mock.patch.object(django_messages_drf.views.InboxListApiView, 'pagination_class', CursorPagination):
+            first = json.loads(self.app.get(url, user=user).content)
+            Message.new_message(sender, [user], "subject 5", "content")
+            Message.new_reply(threads[0], sender, "reply")
+            second = json.loads(self.app.get(first['links']['next'], user=user).content)
+
+        self.assertEqual([str(t.uuid) for t in threads[2:0:-1]], [r['uuid'] for r in second['results']])
+
+    def test_inbox_invalid_cursor(self):
+        """A cursor that can't be decoded returns 404"""
+        user = django_messages_drf.tests.factories.UserFactory()
+        url = reverse("django_messages_drf:inbox")
+
+        with mock.patch.object(django_messages_drf.views.InboxListApiView, 'pagination_class', CursorPagination):
+            response = self.app.get(f"{url}?cursor=invalid", user=user, expect_errors=True)
+
+        self.assertEqual(404, response.status_code)
+
+    def test_inbox_query_count_is_constant(self):
+        """The number of queries of the inbox doesn't depend on the number of rows of the page"""
+        user = django_messages_drf.tests.factories.UserFactory()
+        url = reverse("django_messages_drf:inbox")
+
+        Message.new_message(django_messages_drf.tests.factories.UserFactory(), [user], "subject", "content")
+        self.app.get(url, user=user)
+        with CaptureQueriesContext(connection) as few:
+            self.app.get(url, user=user)
+
+        for i in range(5):
+            sender = django_messages_drf.tests.factories.UserFactory()
+            thread = Message.new_message(sender, [user], f"subject {i}", "content").thread
+            Message.new_reply(thread, user, "reply")
+        with CaptureQueriesContext(connection) as many:
+            response = self.app.get(url, user=user)
+
+        self.assertEqual(6, len(json.loads(response.content)['results']))
+        self.assertEqual(len(few), len(many))
+
     def test_can_get_thread_endpoint(self):
         """User can get to the thread endpoint"""
         user = django_messages_drf.tests.factories.UserFactory()
@@ -125,6 +264,100 @@ class BaseTest(WebTest):
         self.assertEqual(400, response.status_code)
         self.assertEqual(0, threads.count())
 
+    def test_can_send_to_a_group(self):
+        """A thread can be sent to many users in a constant number of queries"""
+        user = django_messages_drf.tests.factories.UserFactory()
+        url = reverse("django_messages_drf:thread-group-create")
+
+        def send(recipients):
+            params = {'subject': 'group', 'message': 'hello', 'recipients': [r.pk for r in recipients]}
+            with CaptureQueriesContext(connection) as queries:
+                response = self.app.post_json(url, params=params, user=user)
+            return response, len(queries)
+
+        recipients = [django_messages_drf.tests.factories.UserFactory() for _ in range(30)]
+        self.app.get(reverse("django_messages_drf:inbox"), user=user)
+        response, few = send(recipients[:3])
+        response, many = send(recipients + [user])
+
+        thread = Thread.objects.get(messages__uuid=json.loads(response.content)['uuid'])
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(few, many)
+        self.assertEqual(31, thread.userthread_set.count())
+        self.assertEqual(30, thread.userthread_set.filter(last_read_seq__lt=thread.seq).count())
+
+    def test_returns_400_when_a_recipient_does_not_exist(self):
+        """All the recipients must exist"""
+        user = django_messages_drf.tests.factories.UserFactory()
+        recipient = django_messages_drf.tests.factories.UserFactory()
+        url = reverse("django_messages_drf:thread-group-create")
+
+        params = {'subject': 'group', 'message': 'hello', 'recipients': [recipient.pk, 0]}
+        response = self.app.post_json(url, params=params, user=user, expect_errors=True)
+
+        self.assertEqual(400, response.status_code)
+        self.assertEqual(0, Thread.objects.count())
+
+    def test_returns_400_when_the_sender_is_the_only_recipient(self):
+        """A thread without any recipient left is not created"""
+        user = django_messages_drf.tests.factories.UserFactory()
+        url = reverse("django_messages_drf:thread-group-create")
+
+        params = {'subject': 'group', 'message': 'hello', 'recipients': [user.pk, user.pk]}
+        response = self.app.post_json(url, params=params, user=user, expect_errors=True)
+
+        self.assertEqual(400, response.status_code)
+        self.assertIn('recipients', json.loads(response.content))
+        self.assertEqual(0, Thread.objects.count())
+
+    def test_can_mark_many_threads_as_read(self):
+        """The threads given are marked as read for the user only"""
+        user = django_messages_drf.tests.factories.UserFactory()
+        other = django_messages_drf.tests.factories.UserFactory()
+        threads = [Message.new_message(other, [user], "subject", "content").thread for _ in range(3)]
+        url = reverse("django_messages_drf:thread-batch")
+
+        params = {'action': 'read', 'threads': [str(t.uuid) for t in threads[:2]]}
+        response = self.app.post_json(url, params=params, user=user)
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({'action': 'read', 'count': 2}, json.loads(response.content))
+        self.assertEqual([threads[2]], list(Thread.unread(user)))
+        self.assertEqual(0, Thread.unread(other).count())
+
+    def test_can_delete_threads_by_filter(self):
+        """A filter applies the action to every matching thread in chunks"""
+        user = django_messages_drf.tests.factories.UserFactory()
+        other = django_messages_drf.tests.factories.UserFactory()
+        for _ in range(5):
+            Message.new_message(other, [user], "subject", "content")
+        url = reverse("django_messages_drf:thread-batch")
+
+        with self.settings(DJANGO_MESSAGES_DRF_BULK_BATCH_SIZE=2):
+            response = self.app.post_json(url, params={'action': 'delete', 'filter': 'inbox'}, user=user)
+
+        self.assertEqual(5, json.loads(response.content)['count'])
+        self.assertEqual(0, Thread.inbox(user).count())
+        self.assertEqual(5, Thread.deleted(user).count())
+
+        response = self.app.post_json(url, params={'action': 'restore', 'filter': 'deleted'}, user=user)
+
+        self.assertEqual(5, json.loads(response.content)['count'])
+        self.assertEqual(5, Thread.inbox(user).count())
+
+    def test_batch_requires_threads_or_a_filter(self):
+        """Exactly one of threads or filter must be given"""
+        user = django_messages_drf.tests.factories.UserFactory()
+        url = reverse("django_messages_drf:thread-batch")
+
+        response = self.app.post_json(url, params={'action': 'read'}, user=user, expect_errors=True)
+        self.assertEqual(400, response.status_code)
+
+        params = {'action': 'read', 'filter': 'inbox', 'threads': [str(uuid.uuid4())]}
+        response = self.app.post_json(url, params=params, user=user, expect_errors=True)
+        self.assertEqual(400, response.status_code)
+
     def test_cannot_get_thread_send_reply_endpoint(self):
         """User cannot get to the thread create endpoint"""
         user = django_messages_drf.tests.factories.UserFactory()
@@ -158,6 +391,7 @@ class BaseTest(WebTest):
 
         self.assertEqual(200, response.status_code)
         self.assertEqual(1, threads.count())
+        self.assertEqual({'uuid', 'sender', 'sent_at', 'content'}, set(json.loads(response.content)))
 
     def test_returns_400_when_missing_subject_on_reply_param(self):
         """If subject not send, throws 400"""
@@ -260,6 +494,7 @@ class BaseTest(WebTest):
 
             self.assertEqual(200, response.status_code)
             self.assertEqual(1, threads.count())
+            self.assertNotIn('seq', json.loads(response.content))
 
     def test_returns_400_when_missing_content_param(self):
         """If content not send, throws 400"""
@@ -422,3 +657,689 @@ class IssueTests(BaseTest):
 
         self.assertEqual(data.get('content'), "this is a message!\n\nveronica@mars.com")
         self.assertIsNotNone(result.get('sender'))
+
+
+@override_settings(REST_FRAMEWORK={'PAGE_SIZE': 3})
+@mock.patch.object(django_messages_drf.views.ThreadListApiView, 'serializer_class', ThreadSerializer)
+class ThreadWindowTest(WebTest):
+    csrf_checks = False
+
+    def setUp(self):
+        self.user = django_messages_drf.tests.factories.UserFactory()
+        self.sender = django_messages_drf.tests.factories.UserFactory()
+        message = Message.new_message(self.user, [self.sender], "subject", "0")
+        self.thread = message.thread
+        self.messages = [message]
+        for i in range(1, 8):
+            sender = self.sender if i >= 5 else self.user
+            self.messages.append(Message.new_reply(self.thread, sender, str(i)))
+        self.url = reverse("django_messages_drf:thread", kwargs={'uuid': self.thread.uuid})
+
+    def get(self, url):
+        return json.loads(self.app.get(url, user=self.user).content)
+
+    def contents(self, data):
+        return [message['content'] for message in data['messages']]
+
+    def test_returns_the_header_and_the_newest_messages(self):
+        """By default the thread comes with the newest messages"""
+        data = self.get(self.url)
+
+        self.assertEqual(str(self.thread.uuid), data['uuid'])
+        self.assertEqual(2, len(data['participants']))
+        self.assertEqual(['5', '6', '7'], self.contents(data))
+        self.assertTrue(data['previous'])
+        self.assertFalse(data['next'])
+        self.assertIsNone(data['links']['next'])
+
+    def test_follows_the_links_before_and_after(self):
+        """The links move the window to the older and newer messages"""
+        data = self.get(self.url)
+        data = self.get(data['links']['previous'])
+
+        self.assertEqual(['2', '3', '4'], self.contents(data))
+
+        data = self.get(data['links']['previous'])
+
+        self.assertEqual(['0', '1'], self.contents(data))
+        self.assertIsNone(data['links']['previous'])
+
+        data = self.get(data['links']['next'])
+
+        self.assertEqual(['2', '3', '4'], self.contents(data))
+
+    def test_around_the_first_unread_message(self):
+        """The window can be centered on the first unread message of the user"""
+        data = self.get(f"{self.url}?around=unread")
+
+        self.assertEqual(['4', '5', '6'], self.contents(data))
+        self.assertTrue(data['previous'])
+        self.assertTrue(data['next'])
+
+    def test_falls_through_to_the_archive(self):
+        """The windows continue in the archived messages past the oldest message"""
+        archive_messages(idle_for=timedelta(0))
+
+        data = self.get(self.url)
+
+        self.assertEqual(['5', '6', '7'], self.contents(data))
+        self.assertEqual(1, self.thread.messages.count())
+
+        data = self.get(data['links']['previous'])
+        data = self.get(data['links']['previous'])
+
+        self.assertEqual(['0', '1'], self.contents(data))
+        self.assertIsNone(data['links']['previous'])
+
+        data = self.get(data['links']['next'])
+        data = self.get(data['links']['next'])
+
+        self.assertEqual(['5', '6', '7'], self.contents(data))
+        self.assertFalse(data['next'])
+
+    def test_invalid_cursor(self):
+        """An unknown message returns 404"""
+        response = self.app.get(f"{self.url}?before={uuid.uuid4()}", user=self.user, expect_errors=True)
+
+        self.assertEqual(404, response.status_code)
+
+
+@override_settings(DJANGO_MESSAGES_DRF_STREAM_TIMEOUT=0.05)
+class MessageStreamTest(WebTest):
+    csrf_checks = False
+
+    def setUp(self):
+        self.user = django_messages_drf.tests.factories.UserFactory()
+        self.url = reverse("django_messages_drf:stream")
+        self.event = {'type': 'message', 'thread': str(uuid.uuid4())}
+
+    def publish_when_subscribed(self):
+        """Publishes the event once the stream of the user is subscribed"""
+        broker = get_broker()
+
+        def publish():
+            deadline = time.monotonic() + 5
+            while str(self.user.pk) not in broker.subscriptions and time.monotonic() < deadline:
+                time.sleep(0.01)
+            broker.publish([self.user.pk], self.event)
+
+        thread = threading.Thread(target=publish)
+        thread.start()
+        return thread
+
+    @override_settings(DJANGO_MESSAGES_DRF_STREAM_TIMEOUT=5)
+    def test_long_poll_returns_the_events(self):
+        """The request waits for the events of the user"""
+        publisher = self.publish_when_subscribed()
+
+        response = self.app.get(self.url, user=self.user)
+        publisher.join()
+
+        self.assertEqual({'events': [self.event]}, json.loads(response.content))
+
+    def test_long_poll_times_out(self):
+        """Without events an empty list is returned"""
+        with CaptureQueriesContext(connection) as queries:
+            response = self.app.get(self.url, user=self.user)
+
+        self.assertEqual({'events': []}, json.loads(response.content))
+        self.assertFalse([q for q in queries if 'django_messages_drf' in q['sql']])
+
+    @override_settings(DJANGO_MESSAGES_DRF_STREAM_MAX_AGE=0.5)
+    def test_server_sent_events(self):
+        """The events are streamed with keepalives until the max age"""
+        publisher = self.publish_when_subscribed()
+
+        response = self.app.get(self.url, user=self.user, headers={'Accept': 'text/event-stream'})
+        publisher.join()
+
+        self.assertEqual('text/event-stream', response.content_type)
+        self.assertIn(f"event: message\ndata: {json.dumps(self.event)}\n\n", response.text)
+        self.assertIn(": keepalive\n\n", response.text)
+
+    def test_user_not_logged_in_cannot_stream(self):
+        """If a user is not logged in, it cannot access the stream"""
+        response = self.app.get(self.url, headers={'Accept': 'text/event-stream'}, expect_errors=True)
+
+        self.assertEqual(403, response.status_code)
+        self.assertTrue(response.text.startswith("event: error\n"))
+
+
+@override_settings(REST_FRAMEWORK={'PAGE_SIZE': 2})
+class SearchTest(WebTest):
+    csrf_checks = False
+
+    def setUp(self):
+        self.user = django_messages_drf.tests.factories.UserFactory()
+        self.other = django_messages_drf.tests.factories.UserFactory()
+        self.url = reverse("django_messages_drf:search")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.thread = Message.new_message(self.other, [self.user], "Holiday plans", "Where to go?").thread
+            self.replies = [
+                Message.new_reply(self.thread, self.user, "The beach, the beach is warm"),
+                Message.new_reply(self.thread, self.other, "The beach or the mountains"),
+                Message.new_reply(self.thread, self.user, "Mountains then"),
+            ]
+            Message.new_message(self.other, [django_messages_drf.tests.factories.UserFactory()], "Beach", "beach")
+
+    def search(self, query, url=None):
+        return json.loads(self.app.get(url or f"{self.url}?q={query}", user=self.user).content)
+
+    def test_results_are_ranked(self):
+        """The messages of the user matching every term are returned, the best ranked first"""
+        data = self.search("beach")
+
+        self.assertEqual(
+            [str(m.uuid) for m in self.replies[:2]], [r['uuid'] for r in data['results']]
+        )
+        self.assertEqual({'uuid': str(self.thread.uuid), 'subject': "Holiday plans"}, data['results'][0]['thread'])
+        self.assertEqual({'uuid', 'sender', 'thread', 'rank', 'sent_at', 'content'}, set(data['results'][0]))
+        self.assertGreater(data['results'][0]['rank'], data['results'][1]['rank'])
+        self.assertEqual([], self.search("beach warmer")['results'])
+
+    def test_subject_matches_the_first_message(self):
+        """The subject of a thread is found on its first message"""
+        data = self.search("holiday")
+
+        self.assertEqual(["Where to go?"], [r['content'] for r in data['results']])
+
+    def test_follows_the_cursor(self):
+        """The next page is given by the cursor of the last result"""
+        with self.captureOnCommitCallbacks(execute=True):
+            Message.new_reply(self.thread, self.other, "Not the beach")
+
+        data = self.search("the&page_size=2")
+
+        self.assertTrue(data['next'])
+        self.assertIsNone(data['count'])
+
+        second = self.search(None, url=data['links']['next'])
+        uuids = [r['uuid'] for r in data['results'] + second['results']]
+
+        self.assertFalse(second['next'])
+        self.assertEqual(3, len(set(uuids)))
+
+    def test_page_size_is_the_one_of_the_pagination(self):
+        """The PAGE_SIZE of REST_FRAMEWORK doesn't replace the page size of the search"""
+        with self.captureOnCommitCallbacks(execute=True):
+            Message.new_reply(self.thread, self.other, "Not the beach")
+
+        data = self.search("the")
+
+        self.assertEqual(20, data['pagination']['page_size'])
+        self.assertEqual(3, len(data['results']))
+        self.assertFalse(data['next'])
+
+    def test_edit_and_subject_change_are_indexed(self):
+        """The index follows the edits of the messages and the subjects"""
+        with self.captureOnCommitCallbacks(execute=True):
+            message = self.replies[2]
+            message.content = "Skiing then"
+            message.save()
+            self.thread.subject = "Winter plans"
+            self.thread.save(update_fields=['subject', 'modified_at'])
+
+        self.assertEqual(["Skiing then"], [r['content'] for r in self.search("skiing")['results']])
+        self.assertEqual(["Where to go?"], [r['content'] for r in self.search("winter")['results']])
+        self.assertEqual([], self.search("holiday")['results'])
+
+    def test_reply_keeping_the_subject_does_not_index_the_thread(self):
+        """The subject of a thread is indexed again only when it changes"""
+        url = reverse("django_messages_drf:thread-send", kwargs={'uuid': self.thread.uuid, 'user_id': self.other.pk})
+        backend = get_search_backend()
+
+        with mock.patch.object(backend, 'index_threads') as index_threads:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.app.post(url, user=self.user, params={'subject': "Holiday plans", 'message': "Sure"})
+
+            index_threads.assert_not_called()
+
+            with self.captureOnCommitCallbacks(execute=True):
+                self.app.post(url, user=self.user, params={'subject': "Summer plans", 'message': "Sure"})
+
+            index_threads.assert_called_once()
+
+    def test_archived_messages_are_not_searched(self):
+        """The subject of a thread moves to its oldest message not archived"""
+        archived = [self.thread.first_message, self.replies[0]]
+        Message.objects.filter(pk__in=[m.pk for m in archived]).update(sent_at=self.replies[1].sent_at - timedelta(days=40))
+        archive_messages(older_than=timedelta(days=30))
+
+        self.assertEqual([str(self.replies[1].uuid)], [r['uuid'] for r in self.search("beach")['results']])
+        self.assertEqual([str(self.replies[1].uuid)], [r['uuid'] for r in self.search("holiday")['results']])
+        self.assertEqual([], self.search("warm")['results'])
+
+    def test_requires_a_query(self):
+        """An empty search returns 400 and an invalid cursor 404"""
+        response = self.app.get(self.url, user=self.user, expect_errors=True)
+
+        self.assertEqual(400, response.status_code)
+
+        response = self.app.get(f"{self.url}?q=beach&cursor=invalid", user=self.user, expect_errors=True)
+
+        self.assertEqual(404, response.status_code)
+
+
+@override_settings(
+    DJANGO_MESSAGES_DRF_INSTRUMENTATION=True,
+    DJANGO_MESSAGES_DRF_INSTRUMENTATION_SINK='django_messages_drf.instrumentation.MemorySink',
+)
+class InstrumentationTest(WebTest):
+    csrf_checks = False
+
+    def setUp(self):
+        self.user = django_messages_drf.tests.factories.UserFactory()
+        self.other = django_messages_drf.tests.factories.UserFactory()
+        self.thread = Message.new_message(self.other, [self.user], "Timed", "Hello").thread
+        get_sink().clear()
+
+    def test_server_timing_of_the_inbox(self):
+        """The queries and the phases of the view are returned and recorded"""
+        response = self.app.get(reverse("django_messages_drf:inbox"), user=self.user)
+
+        timing = response.headers['Server-Timing']
+        self.assertRegex(timing, r'^db;dur=[\d.]+;desc="\d+ queries", paginate;dur=[\d.]+, serialize;dur=[\d.]+, view;dur=[\d.]+$')
+
+        [metrics] = get_sink().records
+        self.assertEqual(('InboxListApiView', 'GET', 200), (metrics.view, metrics.method, metrics.status))
+        self.assertGreater(metrics.queries, 0)
+        self.assertGreaterEqual(metrics.total_ms, metrics.timings['serialize'])
+        self.assertIn(f'desc="{metrics.queries} queries"', timing)
+
+    def test_errors_are_recorded(self):
+        url = reverse("django_messages_drf:thread", kwargs={'uuid': uuid.uuid4()})
+
+        response = self.app.get(url, user=self.user, expect_errors=True)
+
+        self.assertEqual(404, response.status_code)
+        self.assertIn('Server-Timing', response.headers)
+        self.assertEqual(404, get_sink().records[0].status)
+
+    @override_settings(DJANGO_MESSAGES_DRF_INSTRUMENTATION=False)
+    def test_disabled_by_default(self):
+        response = self.app.get(reverse("django_messages_drf:inbox"), user=self.user)
+
+        self.assertNotIn('Server-Timing', response.headers)
+        self.assertEqual(0, len(get_sink().records))
+
+    def test_a_failing_sink_does_not_fail_the_request(self):
+        sink = CallableSink(mock.Mock(side_effect=ValueError))
+
+        with mock.patch('django_messages_drf.instrumentation.get_sink', return_value=sink), \
+                self.assertLogs('django_messages_drf.instrumentation', 'ERROR'):
+            response = self.app.get(reverse("django_messages_drf:inbox"), user=self.user)
+
+        self.assertEqual(200, response.status_code)
+        sink.func.assert_called_once()
+
+    def test_logging_sink_logs_the_slow_requests(self):
+        metrics = RequestMetrics('InboxListApiView', 'GET', '/inbox/')
+        metrics.total_ms = 50
+
+        with self.assertLogs('django_messages_drf.instrumentation', 'INFO') as logs:
+            LoggingSink(slow_ms=10).record(metrics)
+            LoggingSink(slow_ms=100).record(metrics)
+
+        self.assertEqual(1, len(logs.records))
+        self.assertEqual('/inbox/', logs.records[0].metrics['path'])
+
+
+@override_settings(DJANGO_MESSAGES_DRF_RESPONSE_CACHE=True)
+@mock.patch.object(django_messages_drf.views.ThreadListApiView, 'serializer_class', ThreadSerializer)
+class ResponseCacheTest(WebTest):
+    csrf_checks = False
+
+    def setUp(self):
+        self.user = django_messages_drf.tests.factories.UserFactory()
+        self.other = django_messages_drf.tests.factories.UserFactory()
+        self.thread = Message.new_message(self.other, [self.user], "Cached", "Hello").thread
+        self.inbox = reverse("django_messages_drf:inbox")
+        self.window = reverse("django_messages_drf:thread", kwargs={'uuid': self.thread.uuid})
+        get_response_cache().cache.clear()
+        get_response_cache().reset_stats()
+
+    def get(self, url, user=None):
+        return json.loads(self.app.get(url, user=user or self.user).content)
+
+    def test_inbox_is_cached_until_a_message_is_sent(self):
+        """A new message bumps the versions of the participants only"""
+        first = self.get(self.inbox)
+        self.get(self.inbox, user=self.other)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(first, self.get(self.inbox))
+        self.assertFalse([q for q in queries if 'django_messages_drf_thread' in q['sql']])
+        self.assertEqual({'hits': 1, 'misses': 2}, get_response_cache().stats())
+
+        outsider = django_messages_drf.tests.factories.UserFactory()
+        with self.captureOnCommitCallbacks(execute=True):
+            Message.new_message(outsider, [self.other], "Other", "Not for the user")
+            Message.new_reply(self.thread, self.other, "Hello again")
+
+        self.assertEqual("Hello again", self.get(self.inbox)['results'][0]['last_message'])
+        self.assertEqual(2, self.get(self.inbox, user=self.other)['count'])
+        self.assertEqual({'hits': 1, 'misses': 4}, get_response_cache().stats())
+
+    @override_settings(DJANGO_MESSAGES_DRF_SIGNAL_DISPATCH='deferred')
+    def test_inbox_is_bumped_on_commit_with_a_deferred_dispatch(self):
+        """The versions are bumped by the commit, not by the receivers deferred to the backend"""
+        self.get(self.inbox)
+
+        with mock.patch('django_messages_drf.dispatch.get_backend') as get_backend:
+            with self.captureOnCommitCallbacks(execute=True):
+                Message.new_reply(self.thread, self.other, "Hello again")
+
+        self.assertEqual("Hello again", self.get(self.inbox)['results'][0]['last_message'])
+        self.assertEqual({'hits': 0, 'misses': 2}, get_response_cache().stats())
+        get_backend.return_value.submit.assert_not_called()
+
+    def test_the_query_string_is_part_of_the_key(self):
+        self.get(self.inbox)
+        self.get(f"{self.inbox}?page=1")
+
+        self.assertEqual({'hits': 0, 'misses': 2}, get_response_cache().stats())
+
+    def test_thread_is_cached_until_a_message_is_edited(self):
+        message = self.thread.messages.get()
+        self.get(self.window, user=self.other)
+        self.get(self.window, user=self.other)
+
+        self.assertEqual({'hits': 1, 'misses': 1}, get_response_cache().stats())
+
+        url = reverse("django_messages_drf:message-edit", kwargs={'user_id': self.other.pk, 'thread_id': self.thread.pk})
+        with self.captureOnCommitCallbacks(execute=True):
+            self.app.put_json(url, params={'uuid': str(message.uuid), 'content': "Edited"}, user=self.other)
+
+        self.assertEqual("Edited", self.get(self.window, user=self.other)['messages'][0]['content'])
+
+    def test_read_state_and_deletes_bump_the_user(self):
+        self.get(self.inbox)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.app.post_json(
+                reverse("django_messages_drf:thread-batch"), params={'action': 'read', 'filter': 'inbox'}, user=self.user
+            )
+        self.assertEqual(0, self.get(self.inbox)['results'][0]['total_unread'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.app.delete(reverse("django_messages_drf:thread-delete", kwargs={'uuid': self.thread.uuid}), user=self.user)
+        self.assertEqual([], self.get(self.inbox)['results'])
+
+        self.get(self.inbox, user=self.other)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.thread.mark_read(self.other)
+        self.get(self.inbox, user=self.other)
+        self.assertEqual({'hits': 0, 'misses': 5}, get_response_cache().stats())
+
+    def test_errors_are_not_cached(self):
+        url = reverse("django_messages_drf:thread", kwargs={'uuid': uuid.uuid4()})
+
+        self.app.get(url, user=self.user, expect_errors=True)
+        response = self.app.get(url, user=self.user, expect_errors=True)
+        invalid = self.app.get(reverse("django_messages_drf:thread", kwargs={'uuid': 'invalid'}), user=self.user,
+                               expect_errors=True)
+
+        self.assertEqual((404, 404), (response.status_code, invalid.status_code))
+        self.assertEqual({'hits': 0, 'misses': 2}, get_response_cache().stats())
+
+
+@override_settings(DJANGO_MESSAGES_DRF_CONDITIONAL_GET=True)
+@mock.patch.object(django_messages_drf.views.ThreadListApiView, 'serializer_class', ThreadSerializer)
+class ConditionalGetTest(WebTest):
+    csrf_checks = False
+
+    def setUp(self):
+        self.user = django_messages_drf.tests.factories.UserFactory()
+        self.other = django_messages_drf.tests.factories.UserFactory()
+        self.thread = Message.new_message(self.other, [self.user], "Conditional", "Hello").thread
+        self.inbox = reverse("django_messages_drf:inbox")
+        self.window = reverse("django_messages_drf:thread", kwargs={'uuid': self.thread.uuid})
+
+    def get(self, url, user=None, **headers):
+        return self.app.get(url, user=user or self.user, headers=headers)
+
+    def test_inbox_not_modified(self):
+        """The inbox is answered with a 304 without being built"""
+        response = self.get(self.inbox)
+        etag = response.headers['ETag']
+
+        self.assertNotIn('Last-Modified', response.headers)
+        self.assertEqual('private, no-cache', response.headers['Cache-Control'])
+
+        with mock.patch.object(django_messages_drf.views.InboxListApiView, 'get_inbox') as get_inbox:
+            response = self.get(self.inbox, **{'If-None-Match': etag})
+
+        self.assertEqual(304, response.status_code)
+        self.assertEqual(etag, response.headers['ETag'])
+        get_inbox.assert_not_called()
+        self.assertNotEqual(etag, self.get(f"{self.inbox}?page=1").headers['ETag'])
+        self.assertNotEqual(etag, self.get(self.inbox, user=self.other).headers['ETag'])
+
+    def test_inbox_is_validated_without_a_query_on_the_threads(self):
+        """The ETag of the inbox is the version of the user, not an aggregate of its threads"""
+        etag = self.get(self.inbox).headers['ETag']
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.get(self.inbox, **{'If-None-Match': etag})
+
+        self.assertEqual(304, response.status_code)
+        self.assertFalse([q for q in queries if 'django_messages_drf_' in q['sql']])
+
+    def test_inbox_changes_with_the_messages_and_the_read_state(self):
+        """The version of the user is bumped on commit even with the response cache disabled"""
+        etags = [self.get(self.inbox).headers['ETag']]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Message.new_reply(self.thread, self.other, "Again")
+        etags.append(self.get(self.inbox).headers['ETag'])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.thread.mark_read(self.user)
+        etags.append(self.get(self.inbox).headers['ETag'])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.thread.userthread_set.filter(user=self.user).update(deleted=True)
+            invalidate_users([self.user.pk])
+        etags.append(self.get(self.inbox).headers['ETag'])
+
+        self.assertEqual(4, len(set(etags)))
+        response = self.get(self.inbox, **{'If-None-Match': etags[0]})
+        self.assertEqual(200, response.status_code)
+
+    def test_inbox_changes_when_a_thread_is_deleted_and_another_restored(self):
+        """The threads of the inbox are told apart, not only counted or summed"""
+        threads = [self.thread] + [
+            Message.new_message(self.other, [self.user], f"Other {i}", "Hello").thread for i in range(3)
+        ]
+        url = reverse("django_messages_drf:thread-batch")
+        self.app.post_json(
+            url, params={'action': 'delete', 'threads': [str(t.uuid) for t in threads[1:3]]}, user=self.user
+        )
+        etag = self.get(self.inbox).headers['ETag']
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.app.post_json(
+                url, params={'action': 'restore', 'threads': [str(t.uuid) for t in threads[1:3]]}, user=self.user
+            )
+            self.app.post_json(
+                url, params={'action': 'delete', 'threads': [str(threads[0].uuid), str(threads[3].uuid)]},
+                user=self.user
+            )
+
+        response = self.get(self.inbox, **{'If-None-Match': etag})
+        self.assertEqual(200, response.status_code)
+        self.assertNotEqual(etag, response.headers['ETag'])
+
+    def test_thread_not_modified_until_edited(self):
+        response = self.get(self.window)
+        etag = response.headers['ETag']
+
+        self.assertNotIn('Last-Modified', response.headers)
+        self.assertEqual(304, self.get(self.window, **{'If-None-Match': etag}).status_code)
+
+        message = self.thread.messages.get()
+        url = reverse("django_messages_drf:message-edit", kwargs={'user_id': self.other.pk, 'thread_id': self.thread.pk})
+        self.app.put_json(url, params={'uuid': str(message.uuid), 'content': "Edited"}, user=self.other)
+
+        response = self.get(self.window, **{'If-None-Match': etag})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual("Edited", json.loads(response.content)['messages'][0]['content'])
+
+    def test_if_modified_since_is_ignored(self):
+        """A reply sent in the same second as the response is not answered with a 304"""
+        self.get(self.window)
+        Message.new_reply(self.thread, self.other, "Same second")
+
+        response = self.get(self.window, **{'If-Modified-Since': http_date()})
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(2, len(json.loads(response.content)['messages']))
+
+    def test_missing_thread_is_not_found(self):
+        url = reverse("django_messages_drf:thread", kwargs={'uuid': uuid.uuid4()})
+
+        response = self.app.get(url, user=self.user, expect_errors=True)
+
+        self.assertEqual(404, response.status_code)
+        self.assertNotIn('ETag', response.headers)
+
+    @override_settings(DJANGO_MESSAGES_DRF_CONDITIONAL_GET=False)
+    def test_disabled_by_default(self):
+        self.assertNotIn('ETag', self.get(self.inbox).headers)
+
+
+@override_settings(REST_FRAMEWORK={'PAGE_SIZE': 2})
+class CountFreePaginationTest(WebTest):
+    csrf_checks = False
+
+    def setUp(self):
+        cache.clear()
+        self.user = django_messages_drf.tests.factories.UserFactory()
+        sender = django_messages_drf.tests.factories.UserFactory()
+        self.threads = [
+            Message.new_message(sender, [self.user], f"subject {i}", "content").thread for i in range(5)
+        ]
+        self.url = reverse("django_messages_drf:inbox")
+
+    def get_pages(self, pagination_class):
+        url, pages = self.url, []
+        with mock.patch.object(django_messages_drf.views.InboxListApiView, 'pagination_class', pagination_class):
+            while url:
+                with CaptureQueriesContext(connection) as queries:
+                    data = json.loads(self.app.get(url, user=self.user).content)
+                data['queries'] = [q['sql'] for q in queries]
+                pages.append(data)
+                url = data['links']['next']
+        return pages
+
+    def test_no_count_pagination(self):
+        """The pages are fetched with one more row and without COUNT"""
+        pages = self.get_pages(NoCountPagination)
+
+        self.assertEqual(
+            [str(t.uuid) for t in reversed(self.threads)],
+            [result['uuid'] for page in pages for result in page['results']]
+        )
+        self.assertEqual([True, True, False], [page['next'] for page in pages])
+        self.assertEqual([False, True, True], [page['previous'] for page in pages])
+        self.assertNotIn('page=', pages[1]['links']['previous'])
+        for page in pages:
+            self.assertIsNone(page['count'])
+            self.assertIsNone(page['total_pages'])
+            self.assertFalse([sql for sql in page['queries'] if 'COUNT(' in sql])
+            self.assertTrue([sql for sql in page['queries'] if re.search(r'LIMIT 3\b', sql)])
+
+    def test_no_count_pagination_out_of_range(self):
+        with mock.patch.object(django_messages_drf.views.InboxListApiView, 'pagination_class', NoCountPagination):
+            for page in ('4', '0', 'last'):
+                response = self.app.get(f"{self.url}?page={page}", user=self.user, expect_errors=True)
+                self.assertEqual(404, response.status_code)
+
+    def test_estimated_count_pagination(self):
+        """The count is computed once and read from the cache afterwards"""
+        pages = self.get_pages(EstimatedCountPagination)
+
+        self.assertEqual([5, 5, 5], [page['count'] for page in pages])
+        self.assertEqual([3, 3, 3], [page['total_pages'] for page in pages])
+        self.assertEqual([1, 0, 0], [len([sql for sql in page['queries'] if 'COUNT(' in sql]) for page in pages])
+
+    def test_estimated_count_is_refreshed_when_stale(self):
+        self.get_pages(EstimatedCountPagination)
+        Message.new_message(django_messages_drf.tests.factories.UserFactory(), [self.user], "subject", "content")
+
+        with mock.patch.object(EstimatedCountPagination, 'schedule_refresh') as schedule_refresh:
+            first = self.get_pages(EstimatedCountPagination)[0]
+        schedule_refresh.assert_not_called()
+        self.assertEqual(5, first['count'])
+
+        with mock.patch.object(EstimatedCountPagination, 'count_max_age', -1), \
+                mock.patch.object(EstimatedCountPagination, 'get_backend') as get_backend:
+            get_backend.return_value.submit.side_effect = lambda func, *args: func(*args)
+            self.assertEqual(5, self.get_pages(EstimatedCountPagination)[0]['count'])
+            self.assertEqual(6, self.get_pages(EstimatedCountPagination)[0]['count'])
+
+    def test_estimated_count_is_never_below_the_rows_seen(self):
+        with mock.patch.object(EstimatedCountPagination, 'get_estimated_count', return_value=1):
+            pages = self.get_pages(EstimatedCountPagination)
+
+        self.assertEqual([3, 5, 5], [page['count'] for page in pages])
+        self.assertEqual([2, 3, 3], [page['total_pages'] for page in pages])
+
+
+@mock.patch.object(django_messages_drf.views.ThreadListApiView, 'serializer_class', ThreadSerializer)
+class QueryRequirementsTest(WebTest):
+    csrf_checks = False
+
+    def setUp(self):
+        self.user = django_messages_drf.tests.factories.UserFactory()
+        self.group = Group.objects.create(name="staff")
+        self.user.groups.add(self.group)
+        self.other = django_messages_drf.tests.factories.UserFactory()
+        self.thread = Message.new_message(self.user, [self.other], "Subject", "Hello").thread
+        self.url = reverse("django_messages_drf:thread", kwargs={'uuid': self.thread.uuid})
+
+    def add_senders(self, count):
+        for _ in range(count):
+            sender = django_messages_drf.tests.factories.UserFactory()
+            UserThread.objects.create(thread=self.thread, user=sender, deleted=False)
+            sender.groups.add(self.group)
+            Message.new_reply(self.thread, sender, "Reply")
+
+    def get(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.app.get(self.url, user=self.user)
+        return json.loads(response.content), len(queries)
+
+    @mock.patch('django_messages_drf.settings.SENDER_RECEIVER_SERIALIZER', django_messages_drf.tests.utils.GroupSenderSerializer)
+    def test_declared_requirements_are_applied(self):
+        """The relations declared by a swapped sender serializer are loaded with the messages"""
+        self.get()
+        data, few = self.get()
+        self.add_senders(4)
+        with self.assertNoLogs('django_messages_drf.requirements'), override_settings(DEBUG=True):
+            data, many = self.get()
+
+        self.assertEqual(few, many)
+        self.assertEqual(6, len(data['participants']))
+        self.assertEqual({'username': self.user.username, 'groups': ["staff"]}, data['messages'][0]['sender'])
+        self.assertEqual(["staff"], data['messages'][-1]['sender']['groups'])
+
+    @mock.patch(
+        'django_messages_drf.settings.SENDER_RECEIVER_SERIALIZER', django_messages_drf.tests.utils.UndeclaredGroupSenderSerializer
+    )
+    def test_undeclared_lazy_loads_are_logged_with_debug(self):
+        self.add_senders(2)
+
+        with self.assertNoLogs('django_messages_drf.requirements'):
+            self.get()
+        with self.assertLogs('django_messages_drf.requirements', 'WARNING') as logs, override_settings(DEBUG=True):
+            self.get()
+
+        self.assertTrue(logs.output)
+        self.assertIn("ThreadListApiView ran a query while serializing with ThreadSerializer", logs.output[0])
+
+    def test_inbox_declares_its_annotations(self):
+        view = django_messages_drf.views.InboxListApiView(request=mock.Mock(user=self.other), format_kwarg=None)
+
+        requirements = view.get_query_requirements()
+        queryset = view.apply_query_requirements(Thread.inbox(self.other))
+
+        self.assertIn('total_unread', requirements.get_annotations({'user': self.other}))
+        self.assertEqual(1, queryset.get().total_unread)
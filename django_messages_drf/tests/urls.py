@@ -2,4 +2,5 @@ from django.urls import include, path
 
 urlpatterns = [
     path("", include("django_messages_drf.urls", namespace="django_messages_drf")),
+    path("async/", include("django_messages_drf.async_urls", namespace="django_messages_drf_async")),
 ]
@@ -1,8 +1,40 @@
+from django.contrib.auth import get_user_model
+
 from rest_framework import serializers
 
+from ..requirements import QueryRequirements
+
 
 class SerializerTest(serializers.Serializer):
     """
     Test Serializer
     """
     name = serializers.CharField(required=False)
+
+
+class GroupSenderSerializer(serializers.ModelSerializer):
+    """
+    Sender rendering its groups, declared as query requirements
+    """
+    groups = serializers.SerializerMethodField()
+
+    class Meta:
+        model = get_user_model()
+        fields = ('username', 'groups')
+
+    @classmethod
+    def get_query_requirements(cls):
+        return QueryRequirements(prefetch_related=('groups',), only=('username',))
+
+    def get_groups(self, instance):
+        return [group.name for group in instance.groups.all()]
+
+
+class UndeclaredGroupSenderSerializer(GroupSenderSerializer):
+    """
+    Sender rendering its groups without declaring them
+    """
+
+    @classmethod
+    def get_query_requirements(cls):
+        return QueryRequirements()
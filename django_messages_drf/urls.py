@@ -7,8 +7,12 @@ app_name = "django_messages_drf"
 urlpatterns = [
     path('inbox/', views.InboxListApiView.as_view(), name='inbox'),
     path('message/thread/<uuid>/', views.ThreadListApiView.as_view(), name='thread'),
+    path('message/group/send/', views.GroupThreadCreateApiView.as_view(), name='thread-group-create'),
     path('message/thread/<user_id>/send/', views.ThreadCRUDApiView.as_view(), name='thread-create'),
     path('message/thread/<uuid>/<user_id>/send/', views.ThreadCRUDApiView.as_view(), name='thread-send'),
     path('message/thread/<user_id>/<thread_id>/edit/', views.EditMessageApiView.as_view(), name='message-edit'),
     path('thread/<uuid>/delete', views.ThreadCRUDApiView.as_view(), name='thread-delete'),
+    path('threads/batch/', views.ThreadBatchApiView.as_view(), name='thread-batch'),
+    path('search/', views.SearchApiView.as_view(), name='search'),
+    path('stream/', views.MessageStreamApiView.as_view(), name='stream'),
 ]
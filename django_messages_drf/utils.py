@@ -8,3 +8,6 @@ class AuditModel(models.Model):
     """A common audit model for tracking"""
     created_at = models.DateTimeField(null=False, blank=False, auto_now_add=True)
     modified_at = models.DateTimeField(null=False, blank=False, auto_now=True)
+
+    class Meta:
+        abstract = True
@@ -1,19 +1,47 @@
+import json
 import logging
+import time
+from uuid import UUID
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import F
+from django.http import StreamingHttpResponse
+from django.utils.translation import gettext_lazy as _
 
 from rest_framework import status
-from rest_framework.exceptions import NotFound, PermissionDenied
+from rest_framework.exceptions import (
+    NotFound,
+    PermissionDenied,
+    ValidationError,
+)
 from rest_framework.generics import ListAPIView
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from .mixins import RequireUserContextView, ThreadMixin
-from .models import Message, Thread
-from .pagination import Pagination
+from .brokers import get_broker
+from .cache import get_user_version, invalidate_users
+from .mixins import (
+    ConditionalGetMixin,
+    RequireUserContextView,
+    ResponseCacheMixin,
+    ThreadMixin,
+)
+from .models import Message, Thread, UserThread
 from .permissions import DjangoMessageDRFAuthMixin
+from .renderers import EventStreamRenderer
+from .search import get_search_backend
 from .serializers import MessageSerializer
 from .settings import (
     EDIT_MESSAGE_SERIALIZER,
+    GROUP_MESSAGE_SERIALIZER,
+    INBOX_PAGINATION,
     INBOX_SERIALIZER,
+    SEARCH_PAGINATION,
+    SEARCH_SERIALIZER,
+    THREAD_BATCH_SERIALIZER,
+    THREAD_PAGINATION,
     THREAD_REPLY_SERIALIZER,
     THREAD_SERIALIZER,
 )
@@ -21,31 +49,79 @@ from .settings import (
 log = logging.getLogger(__name__)
 
 
-class InboxListApiView(DjangoMessageDRFAuthMixin, RequireUserContextView, ListAPIView):
+class InboxListApiView(DjangoMessageDRFAuthMixin, ConditionalGetMixin, ResponseCacheMixin, RequireUserContextView,
+                       ListAPIView):
     """
     Returns the Inbox the logged in User
     """
     serializer_class = INBOX_SERIALIZER
-    pagination_class = Pagination
+    pagination_class = INBOX_PAGINATION
 
     def get_queryset(self):
-        queryset = Thread.inbox(self.request.user)
-        return Thread.ordered(queryset)
+        return self.apply_query_requirements(Thread.inbox(self.request.user))
+
+    def get(self, request, *args, **kwargs):
+        return self.conditional_response(
+            lambda: self.cached_response('inbox', self.get_inbox, user=request.user.pk)
+        )
+
+    def get_validators(self):
+        """The version of the user, bumped by every change of its inbox, without a query"""
+        return get_user_version(self.request.user.pk)
 
+    def get_inbox(self):
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        if page is None:
+            return Response(self.serialize(self.get_serializer(queryset, many=True)))
+        return self.get_paginated_response(self.serialize(self.get_serializer(page, many=True)))
 
-class ThreadListApiView(DjangoMessageDRFAuthMixin, ThreadMixin, RequireUserContextView, ListAPIView):
+
+class ThreadListApiView(DjangoMessageDRFAuthMixin, ThreadMixin, ConditionalGetMixin, ResponseCacheMixin,
+                        RequireUserContextView, ListAPIView):
     """
-    Gets all the messages from a given thread
+    Gets a given thread and a window of its messages, the newest by default.
     """
     serializer_class = THREAD_SERIALIZER
+    pagination_class = THREAD_PAGINATION
 
     def get(self, request, *args, **kwargs):
+        try:
+            thread_uuid = UUID(str(kwargs.get('uuid')))
+        except ValueError:
+            raise NotFound()
+        return self.conditional_response(
+            lambda: self.cached_response('thread', self.get_window, thread=thread_uuid, user=request.user.pk)
+        )
+
+    def get_validators(self):
+        """The latest message, edit and read cursor of the thread"""
+        activity = Thread.objects.filter(uuid=self.kwargs.get('uuid')).activity_for(self.request.user)
+        if activity is None:
+            return None
+        return tuple(activity.values())
+
+    def get_thread(self):
+        """Gets the thread with the query requirements of the serializer"""
+        return self.apply_query_requirements(Thread.objects.filter(uuid=self.kwargs.get('uuid'))).first()
+
+    def get_window(self):
         instance = self.get_thread()
         if not instance:
             raise NotFound()
 
-        serializer = self.serializer_class(instance, context=self.get_serializer_context())
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        self.thread = instance
+        context = self.get_serializer_context()
+        context['messages'] = self.paginate_queryset(self.apply_query_requirements(instance.messages.all(), 'messages'))
+
+        serializer = self.serializer_class(instance, context=context)
+        if context['messages'] is None:
+            return Response(self.serialize(serializer), status=status.HTTP_200_OK)
+        return self.get_paginated_response(self.serialize(serializer))
+
+    def get_archive_queryset(self):
+        """The archived messages of the thread, read by the pagination past the oldest message"""
+        return self.apply_query_requirements(self.thread.archived_messages.all(), 'messages')
 
 
 class ThreadCRUDApiView(DjangoMessageDRFAuthMixin, ThreadMixin, RequireUserContextView, APIView):
@@ -81,11 +157,13 @@ class ThreadCRUDApiView(DjangoMessageDRFAuthMixin, ThreadMixin, RequireUserConte
 
         else:
             msg = Message.new_reply(thread, self.request.user, serializer.data.get('message'))
-            thread.subject = subject
-            thread.save()
+            if subject != thread.subject:
+                # Only a new subject is saved, the search index of the thread is rewritten on save
+                thread.subject = subject
+                thread.save(update_fields=['subject', 'modified_at'])
 
         message = MessageSerializer(msg, context=self.get_serializer_context())
-        return Response(message.data, status=status.HTTP_200_OK)
+        return Response(self.serialize(message), status=status.HTTP_200_OK)
 
     def delete(self, request, *args, **kwargs):
         """
@@ -97,9 +175,166 @@ class ThreadCRUDApiView(DjangoMessageDRFAuthMixin, ThreadMixin, RequireUserConte
             raise NotFound()
 
         thread.userthread_set.filter(user=request.user).update(deleted=True)
+        invalidate_users([request.user.pk])
         return Response(status=status.HTTP_200_OK)
 
 
+class GroupThreadCreateApiView(DjangoMessageDRFAuthMixin, RequireUserContextView, APIView):
+    """
+    Creates a new thread sent to a list of users.
+
+    The recipients are validated with a single query and the participants are inserted in bulk,
+    creating the thread in a constant number of statements regardless of the number of recipients.
+    """
+    serializer_class = GROUP_MESSAGE_SERIALIZER
+
+    def post(self, request, *args, **kwargs):
+        serializer = self.serializer_class(data=request.data, context=self.get_serializer_context())
+        serializer.is_valid(raise_exception=True)
+
+        msg = Message.new_message(
+            from_user=request.user, to_users=serializer.validated_data['recipients'],
+            subject=serializer.validated_data['subject'], content=serializer.validated_data['message']
+        )
+
+        message = MessageSerializer(msg, context=self.get_serializer_context())
+        return Response(self.serialize(message), status=status.HTTP_200_OK)
+
+
+class ThreadBatchApiView(DjangoMessageDRFAuthMixin, RequireUserContextView, APIView):
+    """
+    Marks many threads of the logged in user as read, unread, deleted or restores them at once.
+
+    The threads are given by a list of uuids or by a filter ("inbox", "unread" or "deleted") and
+    the change is applied in chunks with a single UPDATE per chunk.
+    """
+    serializer_class = THREAD_BATCH_SERIALIZER
+
+    def get_values(self, action):
+        """The fields of the `UserThread` changed by each action"""
+        return {
+            'read': {'last_read_seq': UserThread.read_cursor()},
+            'unread': {'last_read_seq': UserThread.unread_cursor()},
+            'delete': {'deleted': True},
+            'restore': {'deleted': False},
+        }[action]
+
+    def get_filtered_queryset(self, queryset, filter_name):
+        return {
+            'inbox': queryset.filter(deleted=False),
+            'unread': queryset.filter(deleted=False, last_read_seq__lt=F('thread__seq')),
+            'deleted': queryset.filter(deleted=True),
+        }[filter_name]
+
+    def post(self, request, *args, **kwargs):
+        serializer = self.serializer_class(data=request.data, context=self.get_serializer_context())
+        serializer.is_valid(raise_exception=True)
+
+        action = serializer.validated_data['action']
+        values = self.get_values(action)
+        queryset = UserThread.objects.filter(user=request.user)
+
+        if 'threads' in serializer.validated_data:
+            count = queryset.update_by_threads(serializer.validated_data['threads'], **values)
+        else:
+            count = self.get_filtered_queryset(queryset, serializer.validated_data['filter']).update_in_batches(**values)
+        invalidate_users([request.user.pk])
+
+        return Response({'action': action, 'count': count}, status=status.HTTP_200_OK)
+
+
+class SearchApiView(DjangoMessageDRFAuthMixin, RequireUserContextView, ListAPIView):
+    """
+    Searches the content of the messages and the subjects of the threads of the logged in user
+    for the terms of `?q=`, with the index of `DJANGO_MESSAGES_DRF_SEARCH_BACKEND`.
+
+    The results are the best ranked first and paginated by `SearchCursorPagination`.
+    """
+    serializer_class = SEARCH_SERIALIZER
+    pagination_class = SEARCH_PAGINATION
+    query_param = 'q'
+
+    def get_queryset(self):
+        query = self.request.query_params.get(self.query_param, '').strip()
+        if not query:
+            raise ValidationError({self.query_param: [_("The search cannot be empty")]})
+        results = get_search_backend().search(self.request.user, query)
+        return results.with_queryset(self.apply_query_requirements(Message.objects.all()))
+
+    def get(self, request, *args, **kwargs):
+        page = self.paginate_queryset(self.get_queryset())
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(self.serialize(serializer))
+
+
+class MessageStreamApiView(DjangoMessageDRFAuthMixin, APIView):
+    """
+    Pushes the events of the messages sent to the threads of the logged in user, delivered by the
+    broker of `DJANGO_MESSAGES_DRF_EVENT_BROKER`.
+
+    - `Accept: text/event-stream`: the events are streamed as Server-Sent Events with a
+    keepalive comment every `DJANGO_MESSAGES_DRF_STREAM_TIMEOUT` seconds, the stream is closed
+    after `DJANGO_MESSAGES_DRF_STREAM_MAX_AGE` seconds and the client reconnects.
+    - Otherwise long-poll: waits up to `DJANGO_MESSAGES_DRF_STREAM_TIMEOUT` seconds for events and
+    returns them in `events`, an empty list on timeout.
+
+    Waiting doesn't query the database and the connections of the request are released before.
+    The stream holds a worker until it is closed, under ASGI `AsyncMessageStreamApiView` waits on
+    the event loop instead.
+    """
+    renderer_classes = [JSONRenderer, EventStreamRenderer]
+
+    def get_timeout(self):
+        return getattr(settings, 'DJANGO_MESSAGES_DRF_STREAM_TIMEOUT', 25)
+
+    def get_max_age(self):
+        return getattr(settings, 'DJANGO_MESSAGES_DRF_STREAM_MAX_AGE', 300)
+
+    def release_connections(self):
+        for connection in connections.all(initialized_only=True):
+            if not connection.in_atomic_block:
+                connection.close()
+
+    def poll(self, subscription):
+        """The first event within the timeout and the ones queued after it"""
+        event = subscription.get(timeout=self.get_timeout())
+        events = []
+        while event is not None:
+            events.append(event)
+            event = subscription.get(timeout=0)
+        return events
+
+    def stream(self, user_id):
+        deadline = time.monotonic() + self.get_max_age()
+        with get_broker().subscribe(user_id) as subscription:
+            yield ': connected\n\n'
+            while (remaining := deadline - time.monotonic()) > 0:
+                yield self.format_event(subscription.get(timeout=min(self.get_timeout(), remaining)))
+
+    def format_event(self, event):
+        """The Server-Sent Event of an event, a keepalive comment for None"""
+        if event is None:
+            return ': keepalive\n\n'
+        return f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+    def stream_response(self, stream):
+        response = StreamingHttpResponse(stream, content_type=EventStreamRenderer.media_type)
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    def get(self, request, *args, **kwargs):
+        user_id = request.user.pk
+        self.release_connections()
+
+        if request.accepted_renderer.format == EventStreamRenderer.format:
+            return self.stream_response(self.stream(user_id))
+
+        with get_broker().subscribe(user_id) as subscription:
+            events = self.poll(subscription)
+        return Response({'events': events}, status=status.HTTP_200_OK)
+
+
 class EditMessageApiView(DjangoMessageDRFAuthMixin, ThreadMixin, RequireUserContextView, APIView):
     """
     Edits a message sent from a user in a given thread
@@ -149,4 +384,4 @@ class EditMessageApiView(DjangoMessageDRFAuthMixin, ThreadMixin, RequireUserCont
         instance = serializer.save()
 
         message = MessageSerializer(instance, context=self.get_serializer_context())
-        return Response(message.data, status=status.HTTP_200_OK)
+        return Response(self.serialize(message), status=status.HTTP_200_OK)
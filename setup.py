@@ -17,7 +17,7 @@ setup(
     version=__version__,
     url="https://github.com/tiagoarasilva/django-messages-drf",
     license="MIT",
-    packages=find_packages(),
+    packages=find_packages(exclude=["benchmarks", "benchmarks.*"]),
     package_data={
         "django_messages_drf": []
     },
@@ -25,26 +25,23 @@ setup(
         "Development Status :: 5 - Production/Stable",
         "Environment :: Web Environment",
         "Framework :: Django",
-        "Framework :: Django :: 2.2",
-        "Framework :: Django :: 3.0",
-        "Framework :: Django :: 3.1",
-        "Framework :: Django :: 3.2",
-        "Framework :: Django :: 4.0",
+        "Framework :: Django :: 4.2",
         "Intended Audience :: Developers",
         "License :: OSI Approved :: MIT License",
         "Operating System :: OS Independent",
         "Programming Language :: Python",
         "Programming Language :: Python :: 3",
-        "Programming Language :: Python :: 3.7",
         "Programming Language :: Python :: 3.8",
         "Programming Language :: Python :: 3.9",
         "Programming Language :: Python :: 3.10",
+        "Programming Language :: Python :: 3.11",
         "Topic :: Software Development :: Libraries :: Python Modules",
     ],
     install_requires=[
-        "django>=2.2",
+        "asgiref>=3.6",
+        "django>=4.2",
         "django-appconf>=1.0.2",
-        "djangorestframework>=3.11.1",
+        "djangorestframework>=3.15",
     ],
     tests_require=[
         "django-nose>=1.4.6",
@@ -53,5 +50,6 @@ setup(
         "django-downloadview>=2.1.1"
     ],
     test_suite="tests.runtests",
+    python_requires=">=3.8",
     zip_safe=False
 )